@@ -1,21 +1,45 @@
-from flask import Flask, request, jsonify, render_template, redirect, make_response
-from flask_cors import CORS
+# Project modules read their settings from the environment at import time,
+# so .env has to be loaded before any of them
+from dotenv import load_dotenv
+load_dotenv()
+
+import startup
+from flask import Flask, request, jsonify, render_template, redirect, Response, stream_with_context
 import os
+import json
 import time
 import logging
 import stripe
-from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import datetime
+import sheets_client
+from sheets_client import get_sheets_service
+from sheet_index import row_index
+from sheet_queue import sheet_queue
+from sheet_writes import sheet_writes
+import sheet_format
+import read_model
+import webhook_queue
+import charges
+import ledger
+import delete_job
+import stripe_http
+import stripe_scheduler
+from lot_size import lot_size_cache, DEFAULT_LOT_SIZE
+from parcels import ParcelIndex, ParcelResolver
+from pricing import price_columns, price_quotes, price_grid
+from stripe_lookup import UpstreamTimer, iter_customers, payment_method_presence
+import structured_logging
+import metrics
+import profiling
+import health
+from cors import CORSMiddleware
+from structured_logging import setup_logging
+startup.checkpoint('imports')
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
 # Initialize Stripe with the key from environment
 stripe_key = os.getenv('STRIPE_SECRET_KEY')
 if not stripe_key:
@@ -24,24 +48,24 @@ else:
     # Remove any whitespace or newlines
     stripe_key = stripe_key.strip()
     stripe.api_key = stripe_key
-    logger.info(f"Using Stripe API key: {stripe_key[:10]}...")
-    logger.info(f"Using {'test' if 'test' in stripe_key else 'live'} mode")
+    # STRIPE_API_BASE points the SDK at a stand-in, e.g. benchmarks/fakes.py
+    stripe.api_base = os.getenv('STRIPE_API_BASE', stripe.api_base)
+    # Shared keep-alive pool, per-operation timeouts and safe retries
+    stripe_http.install()
+    logger.info("Using %s mode", 'test' if 'test' in stripe_key else 'live')
+startup.checkpoint('stripe_config')
 
 # Initialize Google Services
 GOOGLE_SERVICES_AVAILABLE = False  # Default to False
-google_credentials = None
 try:
-    # Check both local and Render paths for credentials
+    # Check both local and Render paths for credentials; parsing the key is
+    # left to first use so the Google auth stack isn't imported at boot
     credentials_paths = ['google-credentials.json', '/etc/secrets/google-credentials.json']
     
     for path in credentials_paths:
         if os.path.exists(path):
-            google_credentials = service_account.Credentials.from_service_account_file(
-                path,
-                scopes=['https://www.googleapis.com/auth/spreadsheets']
-            )
             GOOGLE_SERVICES_AVAILABLE = True
-            logger.info(f"Google credentials loaded successfully from {path}")
+            logger.info("Google credentials found at %s", path)
             break
 
     if not GOOGLE_SERVICES_AVAILABLE:
@@ -52,52 +76,63 @@ try:
     if not GOOGLE_SHEETS_ID:
         logger.error("GOOGLE_SHEETS_ID environment variable is not set")
     else:
-        logger.info(f"Using Google Sheets ID: {GOOGLE_SHEETS_ID[:10]}...")
+        logger.info("Using Google Sheets ID: %s...", GOOGLE_SHEETS_ID[:10])
 
 except Exception as e:
-    logger.error(f"Failed to load Google credentials: {str(e)}")
+    logger.error("Failed to load Google credentials: %s", e)
+startup.checkpoint('google_config')
+
+# Keep the local customer read model caught up with Stripe
+if stripe.api_key:
+    read_model.start_background_sync()
+
+# Start webhook workers, which also picks up events left unfinished by a previous run
+webhook_queue.start()
+
+# Resume any bulk deletion job a previous process left unfinished
+delete_job.start(sheets=GOOGLE_SERVICES_AVAILABLE)
+
+# Start the sheet append writer, taking over rows spooled by dead workers
+sheet_queue.start()
+startup.checkpoint('background_jobs')
+
+# Answer lot sizes from a compiled parcel dataset when one is configured
+# (see parcels.py); otherwise the default resolver is used
+PARCEL_INDEX_PATH = os.getenv('PARCEL_INDEX_PATH')
+if PARCEL_INDEX_PATH:
+    try:
+        parcel_resolver = ParcelResolver(ParcelIndex(PARCEL_INDEX_PATH))
+        lot_size_cache.set_resolver(parcel_resolver, parcel_resolver.name)
+        logger.info("Loaded %s parcels from %s", len(parcel_resolver.index), PARCEL_INDEX_PATH)
+    except Exception as e:
+        logger.error("Failed to load parcel index %s: %s", PARCEL_INDEX_PATH, e)
+    startup.checkpoint('parcel_index')
 
-# Create Flask app with CORS
+# Create Flask app; CORS is handled by the middleware below
 app = Flask(__name__)
-CORS(app, resources={
-    r"/*": {
-        "origins": [
-            "http://localhost:3000",
-            "https://lawn-peak-front.onrender.com",
-            "https://lawn-peak-api.onrender.com",
-            "https://lawn-peak-front.framer.website",
-            "https://lawnpeak.com",
-            "https://js.stripe.com"
-        ],
-        "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization", "Accept", "Stripe-Version", "Stripe-Signature"],
-        "supports_credentials": True,
-        "expose_headers": ["Content-Type", "Authorization"]
-    }
-})
-
-@app.after_request
-def after_request(response):
-    origin = request.headers.get('Origin')
-    if origin in [
-        "http://localhost:3000", 
-        "https://lawn-peak-front.onrender.com", 
-        "https://lawn-peak-api.onrender.com",
-        "https://lawn-peak-front.framer.website",
-        "https://lawnpeak.com",
-        "https://js.stripe.com"
-    ]:
-        response.headers['Access-Control-Allow-Origin'] = origin
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
-        response.headers['Access-Control-Allow-Methods'] = 'GET,POST,PUT,DELETE,OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization,Accept,Stripe-Version,Stripe-Signature'
-        response.headers['Access-Control-Expose-Headers'] = 'Content-Type,Authorization'
-    response.headers['Access-Control-Max-Age'] = '3600'
-    return response
+
+CORS_ORIGINS = (
+    "http://localhost:3000",
+    "https://lawn-peak-front.onrender.com",
+    "https://lawn-peak-api.onrender.com",
+    "https://lawn-peak-front.framer.website",
+    "https://lawnpeak.com",
+    "https://js.stripe.com"
+)
+cors = CORSMiddleware(app.wsgi_app, origins=CORS_ORIGINS)
+app.wsgi_app = cors
+
+# Request latency histograms for /metrics, and the cache/queue gauge sampler
+metrics.init_app(app)
+metrics.start()
+
+# Opt-in profiling: X-Profile: <PROFILE_TOKEN> or PROFILE_SAMPLE_RATE
+profiling.init_app(app)
+startup.checkpoint('flask_app')
 
 @app.errorhandler(Exception)
 def handle_error(error):
-    logger.error(f"Unhandled error: {str(error)}")
+    logger.error("Unhandled error: %s", error)
     response = jsonify({
         "error": "An internal server error occurred",
         "details": str(error)
@@ -108,15 +143,8 @@ def handle_error(error):
 # Admin credentials (in production, use environment variables)
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
 
-@app.route('/admin-login', methods=['POST', 'OPTIONS'])
+@app.route('/admin-login', methods=['POST'])
 def admin_login():
-    if request.method == 'OPTIONS':
-        response = make_response()
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        response.headers.add('Access-Control-Allow-Methods', 'POST')
-        return response
-
     try:
         data = request.json
         password = data.get('password')
@@ -130,23 +158,14 @@ def admin_login():
             return jsonify({'error': 'Invalid password'}), 401
 
     except Exception as e:
-        logger.error(f"Error in admin login: {str(e)}")
+        logger.error("Error in admin login: %s", e)
         return jsonify({'error': 'Server error'}), 500
 
-@app.route('/charge-customer', methods=['POST', 'OPTIONS'])
+@app.route('/charge-customer', methods=['POST'])
 def charge_customer():
-    # Handle preflight CORS request
-    if request.method == "OPTIONS":
-        response = make_response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type")
-        response.headers.add("Access-Control-Allow-Methods", "POST")
-        return response
-
     try:
-        logger.info("Received charge-customer request")
         data = request.json
-        logger.info(f"Request data: {data}")
+        logger.debug("Charge request: %s", data)
         
         customer_id = data.get('customer_id')
         amount = data.get('amount')  # Amount in dollars
@@ -155,117 +174,117 @@ def charge_customer():
             logger.error("Missing required fields")
             return jsonify({'error': 'Customer ID and amount are required'}), 400
 
-        # Get customer's default payment method
-        logger.info(f"Retrieving customer {customer_id}")
-        customer = stripe.Customer.retrieve(customer_id)
-        logger.info(f"Retrieved customer: {customer.id}")
-        
-        payment_methods = stripe.PaymentMethod.list(
-            customer=customer_id,
-            type='card'
-        )
-        logger.info(f"Found {len(payment_methods.data)} payment methods")
-        
-        if not payment_methods.data:
-            logger.error("No payment method found")
-            return jsonify({'error': 'No payment method found for customer'}), 400
-
-        # Create and confirm the payment intent
-        logger.info(f"Creating payment intent for amount {amount}")
-        payment_intent = stripe.PaymentIntent.create(
-            amount=int(float(amount) * 100),  # Convert to cents
-            currency='usd',
-            customer=customer_id,
-            payment_method=payment_methods.data[0].id,
-            off_session=True,
-            confirm=True,
-            metadata=customer.metadata
-        )
-        logger.info(f"Payment intent created: {payment_intent.id}")
-        
-        # Update customer metadata to store charge date
-        current_time = time.strftime('%d.%m.%Y %H:%M')  # Added time in 24-hour format
-        customer_metadata = dict(customer.metadata)  # Convert from StripeObject to dict
-        customer_metadata['charge_date'] = current_time
-        
-        # Update customer with new metadata
-        logger.info("Updating customer metadata")
-        stripe.Customer.modify(
+        # Charge the customer's saved card and stamp the charge date
+        customer, payment_intent, current_time = charges.charge_customer(
             customer_id,
-            metadata=customer_metadata
+            amount,
+            idempotency_key=data.get('idempotency_key'),
+            allow_duplicate=bool(data.get('allow_duplicate'))
         )
-        logger.info("Customer metadata updated")
-        
-        # Get customer data from Google Sheets
-        service = get_sheets_service()
-        SPREADSHEET_ID = os.getenv('GOOGLE_SHEETS_ID', '19AqlhJ54zBXsED3J3vkY8_WolSnundLakNdfBAJdMXA')
-        
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A:I'
-        ).execute()
-        values = result.get('values', [])
+        logger.info("Charged customer %s: %s", customer_id, payment_intent.id)
         
-        # Find the customer's row
-        customer_row = None
-        for i, row in enumerate(values):
-            if len(row) > 2 and row[2] == customer.email:  # Email is in column C (index 2)
-                customer_row = i
-                break
+        # Update the Charged Date column; the buffer finds the row and
+        # batches it with other requests' cell writes
+        charges.queue_charged_date(customer)
         
-        if customer_row is not None:
-            # Update the Charged Date column
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            update_range = f'I{customer_row + 1}'  # +1 because sheets are 1-indexed
-            
-            service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=update_range,
-                valueInputOption='USER_ENTERED',
-                body={'values': [[now]]}
-            ).execute()
-            
-            logger.info(f"Updated charge date for customer {customer.email}")
-        else:
-            logger.warning(f"Customer {customer.email} not found in sheet")
-        
-        response = jsonify({
+        return jsonify({
             'success': True,
             'payment_intent_id': payment_intent.id,
             'amount': amount,
             'status': payment_intent.status,
             'charge_date': current_time
         })
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        logger.info("Charge completed successfully")
-        return response
-
-    except stripe.error.CardError as e:
-        logger.error(f"Card error: {str(e)}")
-        error_response = jsonify({'error': 'Card was declined', 'details': str(e)})
-        error_response.headers.add('Access-Control-Allow-Origin', '*')
-        error_response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        return error_response, 400
+
     except Exception as e:
-        logger.error(f"Error charging customer: {str(e)}")
-        error_response = jsonify({'error': 'An unexpected error occurred', 'details': str(e)})
-        error_response.headers.add('Access-Control-Allow-Origin', '*')
-        error_response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        return error_response, 500
+        body, status = charge_error(e)
+        return jsonify(body), status
+
+def charge_error(e):
+    """(body, status) for an error from charging a customer; the ASGI route answers the same way."""
+    if isinstance(e, charges.NoPaymentMethodError):
+        logger.error("No payment method found")
+        return {'error': str(e)}, 400
+    if isinstance(e, ledger.DuplicateChargeError):
+        logger.warning("Refused duplicate charge: %s", e)
+        return {'error': str(e), 'existing': e.existing}, 409
+    if isinstance(e, stripe.error.CardError):
+        logger.error("Card error: %s", e)
+        return {'error': 'Card was declined', 'details': str(e)}, 400
+    logger.error("Error charging customer: %s", e)
+    return {'error': 'An unexpected error occurred', 'details': str(e)}, 500
+
+@app.route('/charge-customers', methods=['POST'])
+def charge_customers():
+    """
+    Charge a list of customers. Body: {"charges": [{"customer_id", "amount"}, ...],
+    "concurrency": n, "batch_id": "..."}. Results stream back as NDJSON, one
+    line per customer as it finishes, then a summary line.
+    """
+    data = request.json or {}
+    items = data.get('charges') or []
+    if not items:
+        return jsonify({'error': 'charges must be a non-empty list'}), 400
+    
+    logger.info("Bulk charging %s customers", len(items))
+    results = charges.charge_many(
+        items,
+        concurrency=data.get('concurrency'),
+        batch_id=data.get('batch_id')
+    )
+    return Response(
+        stream_with_context(json.dumps(result) + '\n' for result in results),
+        mimetype='application/x-ndjson'
+    )
+
+@app.route('/api/charges', methods=['GET'])
+def list_charges():
+    """
+    Charge attempts from the local ledger, newest first. Query: since, until
+    (unix seconds or YYYY-MM-DD; since defaults to the start of this week),
+    customer_id, status.
+    """
+    try:
+        since = ledger.parse_time(request.args.get('since'), ledger.start_of_week())
+        until = ledger.parse_time(request.args.get('until'))
+    except ValueError:
+        return jsonify({'error': 'since and until must be unix seconds or YYYY-MM-DD'}), 400
+    return jsonify({
+        'charges': ledger.list_charges(
+            since, until,
+            customer_id=request.args.get('customer_id'),
+            status=request.args.get('status')
+        ),
+        'customers': ledger.charged_customers(since, until)
+    })
+
+@app.route('/api/charges/revenue', methods=['GET'])
+def charges_revenue():
+    try:
+        since = ledger.parse_time(request.args.get('since'), ledger.start_of_week())
+        until = ledger.parse_time(request.args.get('until'))
+    except ValueError:
+        return jsonify({'error': 'since and until must be unix seconds or YYYY-MM-DD'}), 400
+    return jsonify(ledger.revenue(since, until))
 
 @app.route('/')
 def home():
-    routes = [str(rule) for rule in app.url_map.iter_rules()]
-    logger.info(f"Available routes: {routes}")
     return jsonify({
         'status': 'Lawn Peak Backend API is running',
         'version': '1.0',
-        'routes': routes,
+        'routes': ROUTES,
         'stripe_key_present': bool(stripe.api_key),
         'stripe_key_length': len(stripe.api_key) if stripe.api_key else 0
     })
 
+@app.route('/health', methods=['GET'])
+def health_check():
+    return Response(health.HEALTH_BODY, mimetype='application/json')
+
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    body, ready = health.readiness()
+    return jsonify(body), 200 if ready else 503
+
 @app.route('/debug')
 def debug():
     """Debug endpoint to check configuration"""
@@ -276,7 +295,7 @@ def debug():
             'PORT': os.getenv('PORT'),
             'STRIPE_KEY_LENGTH': len(os.getenv('STRIPE_SECRET_KEY', '')) if os.getenv('STRIPE_SECRET_KEY') else 0
         },
-        'routes': [str(rule) for rule in app.url_map.iter_rules()],
+        'routes': ROUTES,
         'stripe_key_present': bool(stripe.api_key),
         'stripe_key_last_4': stripe.api_key[-4:] if stripe.api_key else None
     })
@@ -389,15 +408,8 @@ def create_payment_intent():
         print('Error creating payment intent:', str(e))
         return jsonify({'error': 'An unexpected error occurred'}), 500
 
-@app.route('/create-setup-intent', methods=['POST', 'OPTIONS'])
+@app.route('/create-setup-intent', methods=['POST'])
 def create_setup_intent():
-    if request.method == "OPTIONS":
-        response = make_response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type")
-        response.headers.add("Access-Control-Allow-Methods", "POST")
-        return response
-
     try:
         data = request.json
         required_fields = ['price', 'service_type', 'address', 'lot_size', 'phone']
@@ -406,7 +418,6 @@ def create_setup_intent():
             if field not in data:
                 return jsonify({'error': f'Missing required field: {field}'}), 400
 
-        logger.info("Creating customer in Stripe...")
         # Create a customer first
         customer = stripe.Customer.create(
             email=data.get('metadata', {}).get('email'),
@@ -422,7 +433,8 @@ def create_setup_intent():
                 'charge_date': ''
             }
         )
-        logger.info(f"Created customer: {customer.id}")
+        logger.info("Created customer: %s", customer.id)
+        read_model.upsert_customer(customer)
 
         # Create Stripe Checkout Session with the customer
         checkout_session = stripe.checkout.Session.create(
@@ -433,11 +445,11 @@ def create_setup_intent():
             cancel_url=data.get('cancel_url', request.host_url)
         )
         
-        logger.info(f"Created checkout session: {checkout_session.id}")
+        logger.info("Created checkout session: %s", checkout_session.id)
         return jsonify({'setupIntentUrl': checkout_session.url}), 200
 
     except Exception as e:
-        logger.error(f"Error creating setup intent: {str(e)}")
+        logger.error("Error creating setup intent: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/webhook', methods=['POST'])
@@ -456,13 +468,24 @@ def webhook():
     except stripe.error.SignatureVerificationError as e:
         return jsonify({'error': 'Invalid signature'}), 400
 
-    # Handle the event
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        print('Payment succeeded:', payment_intent['id'])
-        # Here you can add logic to update your database, send confirmation emails, etc.
+    # Persist and acknowledge straight away; handlers run on the webhook workers
+    is_new = webhook_queue.enqueue(event, payload)
     
-    return jsonify({'status': 'success'})
+    return jsonify({'status': 'success', 'duplicate': not is_new})
+
+@app.route('/webhook/stats', methods=['GET'])
+def webhook_stats():
+    return jsonify(webhook_queue.stats())
+
+# Keep the local customer read model and the charge ledger current
+webhook_queue.register(read_model.EVENT_TYPES, read_model.apply_event)
+webhook_queue.register(ledger.EVENT_TYPES, ledger.apply_event)
+
+@webhook_queue.handler('payment_intent.succeeded')
+def handle_payment_succeeded(event):
+    payment_intent = event['data']['object']
+    logger.info("Payment succeeded: %s", payment_intent['id'])
+    # Here you can add logic to update your database, send confirmation emails, etc.
 
 @app.route('/api/lot-size', methods=['POST'])
 def lot_size_endpoint():
@@ -483,9 +506,91 @@ def lot_size_endpoint():
         })
         
     except Exception as e:
-        logger.error(f'Error in lot_size_endpoint: {str(e)}')
+        logger.error('Error in lot_size_endpoint: %s', e)
         return jsonify({'error': str(e)}), 500
 
+# Upper bound on quotes priced in one /quotes/batch request
+QUOTES_BATCH_MAX = int(os.getenv('QUOTES_BATCH_MAX', 100000))
+
+@app.route('/quotes/batch', methods=['POST'])
+def quotes_batch():
+    """
+    Price many quotes at once. Body is either {"quotes": [{"lot_size" or
+    "square_feet", "service_type"}, ...]} or parallel lists {"service_types",
+    "lot_sizes" and/or "square_feet"}. Prices are returned in input order.
+    """
+    try:
+        data = request.json or {}
+        if 'service_types' in data:
+            # Columnar form: parallel lists, cheapest for large batches
+            service_types = data['service_types']
+            count = len(service_types)
+            for column in ('lot_sizes', 'square_feet'):
+                if column in data and len(data[column]) != count:
+                    return jsonify({'error': f'{column} must have the same length as service_types'}), 400
+        else:
+            quotes = data.get('quotes')
+            if not isinstance(quotes, list) or not quotes:
+                return jsonify({'error': 'quotes must be a non-empty list'}), 400
+            count = len(quotes)
+        if count > QUOTES_BATCH_MAX:
+            return jsonify({'error': f'At most {QUOTES_BATCH_MAX} quotes per request'}), 400
+        
+        if 'service_types' in data:
+            lot_sizes, prices = price_columns(
+                service_types,
+                lot_sizes=data.get('lot_sizes'),
+                square_feet=data.get('square_feet')
+            )
+        else:
+            lot_sizes, prices = price_quotes(quotes)
+        return jsonify({
+            'count': len(prices),
+            'lot_sizes': lot_sizes,
+            'prices': prices
+        })
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({'error': f'Invalid quote data: {str(e)}'}), 400
+    except Exception as e:
+        logger.error('Error in quotes_batch: %s', e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/quotes/grid', methods=['GET'])
+def quotes_grid():
+    return jsonify(price_grid())
+
+@app.route('/stripe/http-stats', methods=['GET'])
+def stripe_http_stats():
+    client = stripe_http.client()
+    return jsonify(client.stats() if client else {'installed': False})
+
+@app.route('/stripe/scheduler-stats', methods=['GET'])
+def stripe_scheduler_stats():
+    return jsonify(stripe_scheduler.scheduler.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@app.route('/startup/stats', methods=['GET'])
+def startup_stats():
+    return jsonify(startup.stats())
+
+@app.route('/profiling/stats', methods=['GET'])
+def profiling_stats():
+    if not profiling.authorized(request.headers.get('X-Profile')):
+        return jsonify({'error': 'Invalid profile token'}), 403
+    return jsonify({**profiling.stats(), 'recent': profiling.list_profiles()})
+
+@app.route('/logging/stats', methods=['GET'])
+def logging_stats():
+    return jsonify(structured_logging.stats())
+
+@app.route('/api/lot-size/stats', methods=['GET'])
+def lot_size_stats():
+    return jsonify(lot_size_cache.stats())
+
 @app.route('/test-stripe')
 def test_stripe():
     logger.info("Test Stripe endpoint called")
@@ -493,14 +598,14 @@ def test_stripe():
         logger.info("Testing Stripe connection...")
         customers = stripe.Customer.list(limit=3)
         account = stripe.Account.retrieve()
-        logger.info(f"Stripe test successful. Account: {account.id}")
+        logger.info("Stripe test successful. Account: %s", account.id)
         return jsonify({
             'success': True,
             'stripe_account': account.id,
             'customer_count': len(customers.data)
         })
     except Exception as e:
-        logger.error(f"Error testing Stripe connection: {str(e)}")
+        logger.error("Error testing Stripe connection: %s", e)
         return jsonify({
             'error': str(e),
             'stripe_key_present': bool(stripe.api_key),
@@ -551,7 +656,7 @@ def create_test_customer():
             name="Test Customer",
             metadata={'test': 'true'}
         )
-        logger.info(f"Created test customer: {customer.id}")
+        logger.info("Created test customer: %s", customer.id)
         return jsonify({
             'success': True,
             'customer': {
@@ -561,7 +666,7 @@ def create_test_customer():
             }
         })
     except Exception as e:
-        logger.error(f"Error creating test customer: {str(e)}")
+        logger.error("Error creating test customer: %s", e)
         return jsonify({
             'error': str(e),
             'stripe_key_present': bool(stripe.api_key)
@@ -569,247 +674,81 @@ def create_test_customer():
 
 @app.route('/delete-all-customers', methods=['DELETE'])
 def delete_all_customers():
-    """Delete all customers from Stripe."""
+    """
+    Start a background job that deletes every customer from Stripe and their
+    rows from the sheet. Poll /delete-jobs/<id> for progress.
+    """
     try:
-        # List all customers
-        customers = stripe.Customer.list(limit=100)
-        
-        # Delete each customer
-        for customer in customers.data:
-            stripe.Customer.delete(customer.id)
-            
+        data = request.get_json(silent=True) or {}
+        job_id = delete_job.create_job(concurrency=data.get('concurrency') or request.args.get('concurrency'))
         return jsonify({
             'success': True,
-            'message': f'Successfully deleted {len(customers.data)} customers'
-        })
+            'job_id': job_id,
+            'status_url': f'/delete-jobs/{job_id}',
+            'message': 'Deletion job started'
+        }), 202
         
     except Exception as e:
-        logger.error(f"Error deleting all customers: {str(e)}")
+        logger.error("Error deleting all customers: %s", e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/delete-jobs', methods=['GET'])
+def list_delete_jobs():
+    return jsonify({'jobs': delete_job.list_jobs()})
+
+@app.route('/delete-jobs/<job_id>', methods=['GET'])
+def get_delete_job(job_id):
+    job = delete_job.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job['failures'] = delete_job.failed_items(job_id)
+    return jsonify(job)
+
+@app.route('/delete-jobs/<job_id>/cancel', methods=['POST'])
+def cancel_delete_job(job_id):
+    if not delete_job.cancel_job(job_id):
+        return jsonify({'error': 'Job not found or already finished'}), 404
+    return jsonify({'success': True})
+
 @app.route('/format-sheet', methods=['POST'])
 def format_sheet():
+    """
+    Remove empty rows and format rows added since the last run, in a single
+    batchUpdate. ?full=1 rescans and reformats the whole sheet.
+    """
     try:
-        logger.info("Creating Google Sheets service...")
         service = get_sheets_service()
-        SPREADSHEET_ID = os.getenv('GOOGLE_SHEETS_ID', '19AqlhJ54zBXsED3J3vkY8_WolSnundLakNdfBAJdMXA')
-
-        # First, get all values
-        result = service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A:I'
-        ).execute()
-        values = result.get('values', [])
-
-        if len(values) == 0:
-            return jsonify({'message': 'Sheet is empty'}), 200
-
-        # Remove empty rows and keep only non-empty ones
-        non_empty_rows = [row for row in values if any(cell.strip() for cell in row if cell)]
-        
-        # Clear the entire sheet first
-        service.spreadsheets().values().clear(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A:I',
-            body={}
-        ).execute()
-
-        # Update with clean data
-        service.spreadsheets().values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A1',
-            valueInputOption='USER_ENTERED',
-            body={'values': non_empty_rows}
-        ).execute()
-
-        current_row = len(non_empty_rows)
-
-        # Update headers
-        headers = [
-            'Timestamp',
-            'Customer Name',
-            'Email',
-            'Service Type',
-            'Phone Number',
-            'Address',
-            'Lot Size',
-            'Price ($)',
-            'Charged Date'
-        ]
-        
-        service.spreadsheets().values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range='A1:I1',
-            valueInputOption='USER_ENTERED',
-            body={'values': [headers]}
-        ).execute()
-
-        # Apply formatting
-        requests = [
-            # Format headers
-            {
-                "repeatCell": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": 0,
-                        "endRowIndex": 1,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": 9
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {
-                                "red": 0.2,
-                                "green": 0.5,
-                                "blue": 0.3
-                            },
-                            "textFormat": {
-                                "bold": True,
-                                "foregroundColor": {
-                                    "red": 1.0,
-                                    "green": 1.0,
-                                    "blue": 1.0
-                                }
-                            }
-                        }
-                    },
-                    "fields": "userEnteredFormat(backgroundColor,textFormat)"
-                }
-            },
-            # Add borders
-            {
-                "updateBorders": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": 0,
-                        "endRowIndex": current_row + 1,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": 9
-                    },
-                    "top": {"style": "SOLID"},
-                    "bottom": {"style": "SOLID"},
-                    "left": {"style": "SOLID"},
-                    "right": {"style": "SOLID"},
-                    "innerHorizontal": {"style": "SOLID"},
-                    "innerVertical": {"style": "SOLID"}
-                }
-            },
-            # Auto-resize columns
-            {
-                "autoResizeDimensions": {
-                    "dimensions": {
-                        "sheetId": 0,
-                        "dimension": "COLUMNS",
-                        "startIndex": 0,
-                        "endIndex": 9
-                    }
-                }
-            },
-            # Format price column as currency
-            {
-                "repeatCell": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": 1,
-                        "endRowIndex": current_row + 1,
-                        "startColumnIndex": 7,
-                        "endColumnIndex": 8
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "numberFormat": {
-                                "type": "CURRENCY",
-                                "pattern": "$#,##0.00"
-                            }
-                        }
-                    },
-                    "fields": "userEnteredFormat.numberFormat"
-                }
-            },
-            # Format date columns (Timestamp and Charged Date)
-            {
-                "repeatCell": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": 1,
-                        "endRowIndex": current_row + 1,
-                        "startColumnIndex": 0,  # Timestamp column
-                        "endColumnIndex": 1
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "numberFormat": {
-                                "type": "DATE_TIME",
-                                "pattern": "yyyy-mm-dd hh:mm:ss"
-                            }
-                        }
-                    },
-                    "fields": "userEnteredFormat.numberFormat"
-                }
-            },
-            {
-                "repeatCell": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": 1,
-                        "endRowIndex": current_row + 1,
-                        "startColumnIndex": 8,  # Charged Date column
-                        "endColumnIndex": 9
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "numberFormat": {
-                                "type": "DATE_TIME",
-                                "pattern": "yyyy-mm-dd hh:mm:ss"
-                            }
-                        }
-                    },
-                    "fields": "userEnteredFormat.numberFormat"
-                }
-            },
-            # Freeze header row
-            {
-                "updateSheetProperties": {
-                    "properties": {
-                        "sheetId": 0,
-                        "gridProperties": {
-                            "frozenRowCount": 1
-                        }
-                    },
-                    "fields": "gridProperties.frozenRowCount"
-                }
-            },
-            # Center align all cells
-            {
-                "repeatCell": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": 0,
-                        "endRowIndex": current_row + 1,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": 9
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "horizontalAlignment": "CENTER",
-                            "verticalAlignment": "MIDDLE"
-                        }
-                    },
-                    "fields": "userEnteredFormat(horizontalAlignment,verticalAlignment)"
-                }
-            }
-        ]
+        summary = sheet_format.run(service, full=request.args.get('full') in ('1', 'true'))
+        return jsonify({'success': True, 'message': 'Sheet formatted successfully', **summary})
+    except sheet_format.FormatInProgress as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        logger.error("Error formatting sheet: %s", e)
+        return jsonify({'error': str(e)}), 500
 
-        # Apply all formatting
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=SPREADSHEET_ID,
-            body={"requests": requests}
-        ).execute()
+@app.route('/format-sheet', methods=['GET'])
+def format_sheet_state():
+    return jsonify(sheet_format.state())
 
-        logger.info("Successfully formatted existing sheet")
-        return jsonify({'success': True, 'message': 'Sheet formatted successfully'})
+@app.route('/reconcile-sheet', methods=['POST'])
+def reconcile_sheet():
+    """
+    Compare Stripe customers with the sheet and report the differences.
+    A dry run unless ?apply=1; ?append_missing=1 also adds rows for customers
+    with none.
+    """
+    import reconcile
+    try:
+        report = reconcile.run(
+            get_sheets_service(),
+            dry_run=request.args.get('apply') not in ('1', 'true'),
+            append_missing=request.args.get('append_missing') in ('1', 'true')
+        )
+        return jsonify({'success': True, **report})
+    except sheet_format.FormatInProgress as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
-        logger.error(f"Error formatting sheet: {str(e)}")
+        logger.error("Error reconciling sheet: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/append-to-sheet', methods=['POST'])
@@ -821,52 +760,53 @@ def append_to_sheet_endpoint():
         else:
             return jsonify({'error': 'Failed to append data to sheet'}), 500
     except Exception as e:
-        logger.error(f"Error appending to sheet: {str(e)}")
+        logger.error("Error appending to sheet: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def build_sheet_row(data):
+    """
+    Format quote data as a sheet row, in sheet_format.HEADERS order.
+    """
+    # Get current timestamp
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    return [
+        timestamp,  # Timestamp
+        data.get('name', 'Not provided'),  # Customer Name
+        data.get('email', 'Not provided'),  # Email
+        data.get('service_type', ''),  # Service Type
+        data.get('phone', ''),  # Phone Number
+        data.get('address', ''),  # Address
+        data.get('lot_size', ''),  # Lot Size
+        str(data.get('price', 0)),  # Price ($)
+        data.get('charged_date', ''),  # Charged Date
+        data.get('start_date', 'Not provided'),  # Start Date
+        data.get('payment_status', 'Pending')  # Payment Status
+    ]
+
 def append_to_sheet(data):
     """
     Append a row to the Google Sheet with the quote data.
     """
     try:
-        logger.info("=== START: Append to Sheet ===")
-        logger.info(f"Appending data: {data}")
         
         service = get_sheets_service()
         if not service:
             raise Exception("Failed to get Google Sheets service")
 
-        # Get current timestamp
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
         # Format data for sheet
-        row = [
-            timestamp,  # Timestamp
-            data.get('name', 'Not provided'),  # Name
-            data.get('email', 'Not provided'),  # Email
-            data.get('phone', ''),  # Phone
-            data.get('address', ''),  # Address
-            data.get('lot_size', ''),  # Lot Size
-            data.get('service_type', ''),  # Service Type
-            str(data.get('price', 0)),  # Price
-            data.get('start_date', 'Not provided'),  # Start Date
-            data.get('payment_status', 'Pending'),  # Payment Status
-            data.get('charged_date', '')  # Charged Date
-        ]
-        
-        logger.info(f"Formatted row: {row}")
+        row = build_sheet_row(data)
+        logger.debug("Appending row: %s", row)
         
         # Get the spreadsheet ID from environment variable
         SPREADSHEET_ID = os.getenv('GOOGLE_SHEETS_ID')
         if not SPREADSHEET_ID:
             raise Exception("GOOGLE_SHEETS_ID environment variable not set")
-            
-        logger.info(f"Using spreadsheet ID: {SPREADSHEET_ID}")
         
         # Append the row
         result = service.spreadsheets().values().append(
             spreadsheetId=SPREADSHEET_ID,
-            range='A:K',  # Append to columns A through K
+            range=f'A:{sheet_format.LAST_COLUMN}',
             valueInputOption='RAW',
             insertDataOption='INSERT_ROWS',
             body={
@@ -874,83 +814,63 @@ def append_to_sheet(data):
             }
         ).execute()
         
-        logger.info(f"Append result: {result}")
-        logger.info("=== END: Append to Sheet ===")
+        logger.debug("Append result: %s", result)
+        row_index.record_append(result.get('updates', {}).get('updatedRange'), [row[2]])
         
         return result
         
     except Exception as e:
-        logger.error(f"Error in append_to_sheet: {str(e)}")
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error in append_to_sheet: %s", e)
         raise
 
-@app.route('/config', methods=['GET', 'OPTIONS'])
-def get_config():
-    if request.method == "OPTIONS":
-        response = make_response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Headers", "Content-Type")
-        response.headers.add("Access-Control-Allow-Methods", "GET")
-        return response
+@app.route('/sheet-queue', methods=['GET'])
+def sheet_queue_status():
+    return jsonify(sheet_queue.stats())
+
+@app.route('/sheet-writes', methods=['GET'])
+def sheet_writes_status():
+    return jsonify(sheet_writes.stats())
 
+@app.route('/config', methods=['GET'])
+def get_config():
     stripe_config = {
         'publishableKey': os.getenv('STRIPE_PUBLISHABLE_KEY')
     }
     return jsonify(stripe_config)
 
-@app.route('/delete-customer/<customer_id>', methods=['DELETE', 'OPTIONS'])
-def delete_customer(customer_id):
-    if request.method == 'OPTIONS':
-        response = make_response()
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        response.headers.add('Access-Control-Allow-Methods', 'DELETE')
-        return response
+# How long a request waits for a sheet format run before skipping the sheet
+SHEET_LEASE_WAIT = float(os.getenv('SHEET_LEASE_WAIT', 5))
 
+@app.route('/delete-customer/<customer_id>', methods=['DELETE'])
+def delete_customer(customer_id):
     try:
+        # Look up the email first; the deleted customer object doesn't carry it
+        customer = stripe.Customer.retrieve(customer_id)
+        
         # Delete customer from Stripe
-        customer = stripe.Customer.delete(customer_id)
+        stripe.Customer.delete(customer_id)
+        read_model.mark_deleted(customer_id)
         
         # Delete customer from Google Sheets
-        if GOOGLE_SERVICES_AVAILABLE:
-            service = get_sheets_service()
-            SPREADSHEET_ID = os.getenv('GOOGLE_SHEETS_ID', '19AqlhJ54zBXsED3J3vkY8_WolSnundLakNdfBAJdMXA')
-            
-            result = service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range='A:I'
-            ).execute()
-            values = result.get('values', [])
-            
-            # Find and delete the customer's row
-            customer_row = None
-            for i, row in enumerate(values):
-                if len(row) > 2 and row[2] == customer.email:  # Email is in column C (index 2)
-                    customer_row = i + 1  # +1 because sheets are 1-indexed
-                    break
-            
-            if customer_row:
-                # Clear the row
-                service.spreadsheets().values().clear(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=f'A{customer_row}:I{customer_row}'
-                ).execute()
+        clear_customer_sheet_row(customer)
         
         return jsonify({'success': True, 'message': f'Customer {customer_id} deleted successfully'})
     except Exception as e:
-        logger.error(f"Error deleting customer: {str(e)}")
+        logger.error("Error deleting customer: %s", e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/update-customer-service', methods=['POST', 'OPTIONS'])
-def update_customer_service():
-    if request.method == 'OPTIONS':
-        response = make_response()
-        response.headers.add('Access-Control-Allow-Origin', '*')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-        response.headers.add('Access-Control-Allow-Methods', 'POST')
-        return response
+def clear_customer_sheet_row(customer):
+    """Clear a deleted customer's sheet row, if Sheets is configured; shared with the ASGI route."""
+    if not GOOGLE_SERVICES_AVAILABLE or not customer.email:
+        return
+    try:
+        # Found and cleared under the format lease, so the row can't move in between
+        sheet_format.clear_customer_rows(get_sheets_service(), [customer.email], wait=SHEET_LEASE_WAIT)
+    except sheet_format.FormatInProgress as e:
+        logger.warning("Sheet row for deleted customer %s not cleared: %s", customer.id, e)
 
+@app.route('/update-customer-service', methods=['POST'])
+def update_customer_service():
     try:
         data = request.json
         customer_id = data.get('customer_id')
@@ -961,43 +881,21 @@ def update_customer_service():
             return jsonify({'error': 'Missing required fields'}), 400
             
         # Update customer metadata in Stripe
-        stripe.Customer.modify(
+        updated_customer = stripe.Customer.modify(
             customer_id,
             metadata={
                 'service_type': new_service_type,
                 'price': str(new_price)
             }
         )
+        read_model.upsert_customer(updated_customer)
         
         # Update Google Sheets if available
-        if GOOGLE_SERVICES_AVAILABLE:
-            service = get_sheets_service()
-            SPREADSHEET_ID = os.getenv('GOOGLE_SHEETS_ID', '19AqlhJ54zBXsED3J3vkY8_WolSnundLakNdfBAJdMXA')
-            
-            result = service.spreadsheets().values().get(
-                spreadsheetId=SPREADSHEET_ID,
-                range='A:I'
-            ).execute()
-            values = result.get('values', [])
-            
-            # Find the customer's row
-            customer_row = None
-            customer = stripe.Customer.retrieve(customer_id)
-            for i, row in enumerate(values):
-                if len(row) > 2 and row[2] == customer.email:
-                    customer_row = i + 1
-                    break
-            
-            if customer_row:
-                # Update service type and price
-                service.spreadsheets().values().update(
-                    spreadsheetId=SPREADSHEET_ID,
-                    range=f'D{customer_row}:E{customer_row}',  # Assuming D is service type and E is price
-                    valueInputOption='RAW',
-                    body={
-                        'values': [[new_service_type, str(new_price)]]
-                    }
-                ).execute()
+        if GOOGLE_SERVICES_AVAILABLE and updated_customer.email:
+            row_index.register_customer(updated_customer.id, updated_customer.email)
+            # The buffer finds the customer's row when it flushes
+            sheet_writes.write(updated_customer.email, 'Service Type', new_service_type, 'RAW')
+            sheet_writes.write(updated_customer.email, 'Price ($)', str(new_price), 'RAW')
         
         return jsonify({
             'success': True,
@@ -1005,215 +903,197 @@ def update_customer_service():
         })
         
     except Exception as e:
-        logger.error(f"Error updating customer service: {str(e)}")
+        logger.error("Error updating customer service: %s", e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/submit-quote', methods=['POST', 'OPTIONS'])
-def submit_quote():
-    if request.method == 'OPTIONS':
-        return '', 204
+QUOTE_REQUIRED_FIELDS = ['phone', 'address', 'lot_size', 'service_type', 'price']
+
+def map_quote(data):
+    """
+    Map a submitted quote to the sheet's fields. Returns (mapped_data, missing_fields).
+    """
+    mapped_data = {
+        'name': data.get('name', 'Not provided'),
+        'email': data.get('email', 'Not provided'),
+        'phone': data.get('phone', ''),
+        'address': data.get('address', ''),
+        'lot_size': data.get('lot_size', ''),
+        'service_type': data.get('service_type', ''),
+        'price': data.get('price', 0),
+        'start_date': data.get('start_date', 'Not provided'),
+        'payment_status': data.get('payment_status', 'Pending'),
+        'charged_date': data.get('charged_date', ''),
+        'submission_date': data.get('submission_date', datetime.datetime.now().isoformat())
+    }
+    return mapped_data, [field for field in QUOTE_REQUIRED_FIELDS if not mapped_data.get(field)]
 
+@app.route('/submit-quote', methods=['POST'])
+def submit_quote():
     try:
-        logger.info("=== START: Quote Submission ===")
-        logger.info(f"Headers: {dict(request.headers)}")
-        logger.info("Received quote submission request")
-        
         data = request.json
-        logger.info(f"Quote data received: {data}")
-        
-        # Add default values for optional fields
-        data['name'] = data.get('name', 'Not provided')
-        data['email'] = data.get('email', 'Not provided')
-        
-        # Map frontend field names to backend field names
-        mapped_data = {
-            'name': data.get('name', 'Not provided'),
-            'email': data.get('email', 'Not provided'),
-            'phone': data.get('phone', ''),
-            'address': data.get('address', ''),
-            'lot_size': data.get('lot_size', ''),
-            'service_type': data.get('service_type', ''),
-            'price': data.get('price', 0),
-            'start_date': data.get('start_date', 'Not provided'),
-            'payment_status': data.get('payment_status', 'Pending'),
-            'charged_date': data.get('charged_date', ''),
-            'submission_date': data.get('submission_date', datetime.datetime.now().isoformat())
-        }
-        
-        logger.info(f"Mapped data: {mapped_data}")
-        
-        required_fields = ['phone', 'address', 'lot_size', 'service_type', 'price']
-        missing_fields = [field for field in required_fields if not mapped_data.get(field)]
+        logger.debug("Quote data received: %s", data)
         
+        mapped_data, missing_fields = map_quote(data)
         if missing_fields:
-            logger.error(f"Missing required fields: {missing_fields}")
+            logger.error("Missing required fields: %s", missing_fields)
             return jsonify({'error': f'Missing required fields: {missing_fields}'}), 400
             
-        # Try to store in Google Sheets
-        logger.info("Attempting to store in Google Sheets...")
+        # Queue the row for Google Sheets; the background writer batches appends
         try:
-            logger.info("Getting sheets service...")
-            service = get_sheets_service()
-            logger.info("Got sheets service, appending data...")
-            append_to_sheet(mapped_data)
-            logger.info("Successfully stored in Google Sheets")
+            sheet_queue.enqueue(build_sheet_row(mapped_data))
         except Exception as sheets_error:
-            logger.error(f"Failed to store in Google Sheets: {str(sheets_error)}")
-            # Log the full error traceback
-            import traceback
-            logger.error(f"Full traceback: {traceback.format_exc()}")
+            logger.exception("Failed to queue for Google Sheets: %s", sheets_error)
             # Continue anyway - we don't want to block the quote submission just because of sheets
             
-        logger.info("=== END: Quote Submission ===")
         # Return success since we have the data
         return jsonify({'success': True, 'message': 'Quote submitted successfully'})
             
     except Exception as e:
-        logger.error(f"Error in submit_quote: {str(e)}")
-        # Log the full error traceback
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error in submit_quote: %s", e)
         return jsonify({'error': str(e)}), 500
 
+def format_customers(customers):
+    """
+    Shape customer rows (from the read model or a live listing) for the dashboard.
+    """
+    formatted_customers = []
+    for customer in customers:
+        has_payment_method = customer['has_payment_method']
+        
+        # Get price from metadata and ensure it's a valid number
+        price = customer['metadata'].get('price', '0')
+        try:
+            # Try to convert to float and back to string to ensure valid number
+            price = str(float(price))
+        except (ValueError, TypeError):
+            price = '0'
+        
+        # Ensure metadata values are strings and present
+        metadata = {
+            'service_type': customer['metadata'].get('service_type', ''),
+            'payment_type': customer['metadata'].get('payment_type', ''),
+            'address': customer['metadata'].get('address', ''),
+            'lot_size': customer['metadata'].get('lot_size', ''),
+            'phone': customer['metadata'].get('phone', ''),
+            'price': price,  # Use the validated price
+            'charged': customer['metadata'].get('charged', 'false'),
+            'charge_date': customer['metadata'].get('charge_date', '')
+        }
+        
+        formatted_customers.append({
+            'id': customer['id'],
+            'email': customer['email'] or '',
+            'metadata': metadata,
+            'created': customer['created'],
+            'has_payment_method': has_payment_method,
+            'charged': metadata['charged'].lower() == 'true'
+        })
+    return formatted_customers
+
 @app.route('/list-customers', methods=['GET'])
 def list_customers():
     try:
-        logger.info("Received request to /list-customers")
+        request_start = time.perf_counter()
+        timer = UpstreamTimer()
         
-        # List all customers
-        logger.info("Fetching customers from Stripe...")
-        customers = stripe.Customer.list(limit=100)
-        logger.info(f"Found {len(customers.data)} customers")
-        
-        # Format customer data
-        formatted_customers = []
-        for customer in customers.data:
-            # Get payment methods for customer
-            payment_methods = stripe.PaymentMethod.list(
-                customer=customer.id,
-                type='card'
-            )
-            
-            has_payment_method = len(payment_methods.data) > 0
-            logger.info(f"Customer {customer.id} has payment method: {has_payment_method}")
-            
-            # Get price from metadata and ensure it's a valid number
-            price = customer.metadata.get('price', '0')
-            try:
-                # Try to convert to float and back to string to ensure valid number
-                price = str(float(price))
-            except (ValueError, TypeError):
-                price = '0'
-            
-            # Ensure metadata values are strings and present
-            metadata = {
-                'service_type': customer.metadata.get('service_type', ''),
-                'payment_type': customer.metadata.get('payment_type', ''),
-                'address': customer.metadata.get('address', ''),
-                'lot_size': customer.metadata.get('lot_size', ''),
-                'phone': customer.metadata.get('phone', ''),
-                'price': price,  # Use the validated price
-                'charged': customer.metadata.get('charged', 'false'),
-                'charge_date': customer.metadata.get('charge_date', '')
-            }
-            
-            # Print debug information
-            logger.info(f"Customer {customer.id} metadata: {customer.metadata}")
-            logger.info(f"Original price: {customer.metadata.get('price')}")
-            logger.info(f"Formatted price: {metadata['price']}")
+        # Serve from the local read model once it has been synced, unless the
+        # caller explicitly asks for a live read
+        if request.args.get('source') != 'stripe' and read_model.ready():
+            source = 'local'
+            customers = read_model.list_customers()
+        else:
+            source = 'stripe'
+            # List all customers, following pagination. This fans out to
+            # many calls, so it runs behind checkout traffic
+            sync_started = int(time.time())
+            with stripe_scheduler.priority(stripe_scheduler.BATCH):
+                stripe_customers = list(iter_customers(timer=timer))
+                
+                # Resolve payment method presence for every customer in one pass
+                payment_method_flags = payment_method_presence(stripe_customers, timer=timer)
+            read_model.store_snapshot(stripe_customers, payment_method_flags, sync_started)
             
-            customer_data = {
+            customers = [{
                 'id': customer.id,
-                'email': customer.email or '',
-                'metadata': metadata,
+                'email': customer.email,
                 'created': customer.created,
-                'has_payment_method': has_payment_method,
-                'charged': metadata['charged'].lower() == 'true'
-            }
-            formatted_customers.append(customer_data)
+                'metadata': customer.metadata,
+                'has_payment_method': payment_method_flags.get(customer.id, False)
+            } for customer in stripe_customers]
+        
+        formatted_customers = format_customers(customers)
         
-        logger.info(f"Returning {len(formatted_customers)} formatted customers")
-        return jsonify({'customers': formatted_customers})
+        upstream = timer.as_dict()
+        upstream['total_ms'] = round((time.perf_counter() - request_start) * 1000, 1)
+        logger.info("Listed %s customers", len(formatted_customers), extra={'source': source, 'upstream': upstream})
+        return jsonify({'customers': formatted_customers, 'source': source, 'upstream': upstream})
             
     except stripe.error.StripeError as e:
-        logger.error(f"Stripe error in list_customers: {str(e)}")
+        logger.error("Stripe error in list_customers: %s", e)
         return jsonify({'error': str(e.user_message)}), 400
     except Exception as e:
-        logger.error(f"Error listing customers: {str(e)}")
+        logger.error("Error listing customers: %s", e)
         return jsonify({'error': 'An unexpected error occurred'}), 500
 
 @app.errorhandler(404)
 def not_found_error(error):
-    routes = [str(rule) for rule in app.url_map.iter_rules()]
-    logger.error(f"404 Error. Available routes: {routes}")
+    logger.warning("404 Not Found: %s", request.path)
     return jsonify({
         'error': 'Not Found',
         'message': 'The requested URL was not found on the server.',
-        'available_routes': routes
+        'available_routes': ROUTES
     }), 404
 
 @app.errorhandler(500)
 def internal_error(error):
-    logger.error(f"500 Error: {str(error)}")
+    logger.error("500 Error: %s", error)
     return jsonify({
         'error': 'Internal Server Error',
         'message': str(error)
     }), 500
 
-def calculate_price(lot_size_range, service_type='ONE_TIME'):
-    # Base prices for different lot sizes
-    base_prices = {
-        'SMALL': 60,    # Up to 5,000 sq ft
-        'MEDIUM': 70,   # 5,000 - 10,000 sq ft
-        'LARGE': 75,    # 10,000 - 15,000 sq ft
-        'XLARGE': 80    # Over 15,000 sq ft
-    }
-    
-    # Service type discounts
-    service_discounts = {
-        'ONE_TIME': 0,      # No discount
-        'MONTHLY': 0,       # No discount
-        'BI_WEEKLY': 0.10,  # 10% discount
-        'WEEKLY': 0.20      # 20% discount
-    }
-    
-    base_price = base_prices.get(lot_size_range, base_prices['XLARGE'])
-    discount = service_discounts.get(service_type, 0)
-    
-    # Apply discount and round to nearest $5
-    final_price = base_price * (1 - discount)
-    return round(final_price / 5) * 5
-
 def get_lot_size(address):
     """
     Determine lot size category based on address.
     Returns one of: SMALL, MEDIUM, LARGE, XLARGE
     """
+    if not (address or '').strip():
+        return None
     try:
-        # For now, return a default category
-        # In production, this would use Google Maps API to get actual lot size
-        return "MEDIUM"
+        # Served from the lot size cache; only misses reach the resolver.
+        # An address it can't place gets the default tier, as before parcels.
+        return lot_size_cache.lookup(address) or DEFAULT_LOT_SIZE
         
     except Exception as e:
-        logger.error(f'Error in get_lot_size: {str(e)}')
-        return None
+        logger.error('Error in get_lot_size: %s', e)
+        return DEFAULT_LOT_SIZE
 
-def get_sheets_service():
-    credentials = service_account.Credentials.from_service_account_info({
-        "type": "service_account",
-        "project_id": "lawn-quote-calculator",
-        "private_key_id": os.getenv('GOOGLE_SHEETS_PRIVATE_KEY_ID'),
-        "private_key": os.getenv('GOOGLE_SHEETS_PRIVATE_KEY').replace('\\n', '\n'),
-        "client_email": os.getenv('GOOGLE_SHEETS_CLIENT_EMAIL'),
-        "client_id": os.getenv('GOOGLE_SHEETS_CLIENT_ID'),
-        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-        "token_uri": "https://oauth2.googleapis.com/token",
-        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-        "client_x509_cert_url": os.getenv('GOOGLE_SHEETS_CLIENT_X509_CERT_URL')
-    })
-    return build('sheets', 'v4', credentials=credentials)
+def warm_sheets():
+    row_index.ensure_built(get_sheets_service())
+
+def warm_stripe():
+    # Opens the first pooled connection (TCP + TLS) at batch priority
+    with stripe_scheduler.priority(stripe_scheduler.BATCH):
+        stripe.Account.retrieve()
+
+# Do the first request's setup now rather than on the first request
+WARMUP_STEPS = []
+if sheets_client.configured():
+    WARMUP_STEPS.append(('sheets', warm_sheets))
+if stripe.api_key:
+    WARMUP_STEPS.append(('stripe', warm_stripe))
+
+# Every route is registered by now, so list them once for /, /debug and 404s
+ROUTES = [str(rule) for rule in app.url_map.iter_rules()]
+
+startup.checkpoint('routes')
+startup.ready()
+startup.start(WARMUP_STEPS)
+
+# Background readiness snapshot served by /ready
+health.start()
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8080))
-    logger.info(f"Starting app on port {port}")
+    logger.info("Starting app on port %s", port)
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,389 @@
+"""
+ASGI serving mode.
+
+The endpoints that spend their time waiting on Stripe run here as
+coroutines on an async HTTP client, so a customer listing's fan-out or a
+charge's round trips hold no thread:
+
+    GET    /list-customers
+    POST   /charge-customer
+    POST   /submit-quote
+    DELETE /delete-customer/<id>
+
+Every other route, and CORS preflights, goes to the Flask app unchanged on
+a small thread pool (a2wsgi). Run with:
+
+    uvicorn asgi:app --workers 2 --host 0.0.0.0 --port $PORT
+
+Stripe calls take tokens from the same scheduler as the sync client and use
+its timeouts; errors come back as the SDK's own exception types. SQLite and
+spool writes are short and run in the default executor, as does clearing a
+deleted customer's sheet row, which has to hold the sheet_format lease.
+"""
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+from urllib.parse import urlencode, parse_qsl
+
+import httpx
+import stripe
+from a2wsgi import WSGIMiddleware
+from stripe import convert_to_stripe_object
+from stripe._api_requestor import APIRequestor
+from stripe._encode import _api_encode
+
+import app as flask_app
+import charges
+import metrics
+import read_model
+import stripe_http
+import stripe_scheduler
+from sheet_queue import sheet_queue
+from stripe_lookup import UpstreamTimer, LOOKUP_WORKERS, PAGE_SIZE, has_expanded_payment_method
+
+logger = logging.getLogger(__name__)
+
+# Threads serving the Flask routes; async routes don't use them
+WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', stripe_http.GUNICORN_THREADS))
+RETRY_STATUSES = frozenset({409, 429, 500, 502, 503, 504})
+
+
+class AsyncStripe:
+    """Stripe API calls over one httpx.AsyncClient per process."""
+
+    def __init__(self, pool_size=stripe_http.POOL_SIZE, max_retries=stripe_http.MAX_NETWORK_RETRIES):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self._client = None
+        self._requestor = None
+        self.counts = {'requests': 0, 'retries': 0, 'errors': 0}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._requestor = APIRequestor()
+            self._client = httpx.AsyncClient(
+                base_url=stripe.api_base,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+
+    def _sleep_seconds(self, num_retries, response):
+        # Same schedule as the sync client: jittered, never under Retry-After
+        delay = min(stripe_http.PooledStripeClient.INITIAL_DELAY * 2 ** (num_retries - 1),
+                    stripe_http.PooledStripeClient.MAX_DELAY)
+        delay *= 0.5 + random.random() / 2
+        retry_after = self._retry_after(response) if response is not None else None
+        if retry_after is not None and retry_after <= stripe_http.PooledStripeClient.MAX_RETRY_AFTER:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _should_retry(self, response, num_retries):
+        if num_retries >= self.max_retries:
+            return False
+        if response is None:
+            return True
+        if response.headers.get('stripe-should-retry') == 'false':
+            return False
+        if response.headers.get('stripe-should-retry') == 'true':
+            return True
+        return response.status_code in RETRY_STATUSES
+
+    async def request(self, method, path, params=None, idempotency_key=None, priority=stripe_scheduler.INTERACTIVE):
+        """
+        Call the Stripe API and return a StripeObject. Every POST carries an
+        idempotency key, so every call here is safe to retry.
+        """
+        client = self.client
+        headers = self._requestor.request_headers(stripe.api_key, method)
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        encoded = urlencode(list(_api_encode(params or {}))).replace('%5B', '[').replace('%5D', ']')
+        url, body = path, None
+        if method == 'post':
+            body = encoded
+        elif encoded:
+            url = f'{path}?{encoded}'
+        op = stripe_http.operation(method, path)
+        timeout = httpx.Timeout(stripe_http.READ_TIMEOUTS[op], connect=stripe_http.CONNECT_TIMEOUT)
+
+        num_retries = 0
+        while True:
+            await stripe_scheduler.scheduler.acquire_async(method, priority)
+            self.counts['requests'] += 1
+            response = error = None
+            with metrics.upstream_call('stripe', metrics.stripe_resource(path), method) as call:
+                try:
+                    response = await client.request(method.upper(), url, content=body, headers=headers, timeout=timeout)
+                    call.status = response.status_code
+                except httpx.TransportError as e:
+                    error = e
+            if response is not None and response.status_code == 429:
+                stripe_scheduler.scheduler.throttle(method, self._retry_after(response))
+            failed = error is not None or response.status_code >= 500
+            if failed:
+                self.counts['errors'] += 1
+            if (failed or response.status_code >= 400) and self._should_retry(response, num_retries):
+                num_retries += 1
+                self.counts['retries'] += 1
+                await asyncio.sleep(self._sleep_seconds(num_retries, response))
+                continue
+            break
+
+        if error is not None:
+            raise stripe.error.APIConnectionError(f'Error communicating with Stripe: {error}', should_retry=True)
+        resp = self._requestor.interpret_response(response.content, response.status_code, response.headers)
+        return convert_to_stripe_object(resp, stripe.api_key, None, None, params)
+
+
+stripe_client = AsyncStripe()
+
+
+# -- routes ----------------------------------------------------------------
+
+async def list_customers(request):
+    request_start = time.perf_counter()
+    timer = UpstreamTimer()
+
+    async def timed(*args, **kwargs):
+        with timer.measure():
+            return await stripe_client.request(*args, priority=stripe_scheduler.BATCH, **kwargs)
+
+    try:
+        if request.query.get('source') != 'stripe' and await asyncio.to_thread(read_model.ready):
+            source = 'local'
+            customers = await asyncio.to_thread(read_model.list_customers)
+        else:
+            source = 'stripe'
+            sync_started = int(time.time())
+            stripe_customers = []
+            params = {'limit': PAGE_SIZE, 'expand': ['data.invoice_settings.default_payment_method']}
+            while True:
+                page = await timed('get', '/v1/customers', params)
+                stripe_customers.extend(page.data)
+                if not page.has_more or not page.data:
+                    break
+                params['starting_after'] = page.data[-1].id
+
+            # Only customers without an expanded default need a lookup; all
+            # of them are in flight at once, up to the usual worker bound
+            flags = {c.id: True for c in stripe_customers if has_expanded_payment_method(c)}
+            pending = [c.id for c in stripe_customers if c.id not in flags]
+            semaphore = asyncio.Semaphore(LOOKUP_WORKERS)
+
+            async def lookup(customer_id):
+                async with semaphore:
+                    payment_methods = await timed(
+                        'get', '/v1/payment_methods', {'customer': customer_id, 'type': 'card', 'limit': 1}
+                    )
+                flags[customer_id] = len(payment_methods.data) > 0
+
+            await asyncio.gather(*(lookup(customer_id) for customer_id in pending))
+            await asyncio.to_thread(read_model.store_snapshot, stripe_customers, flags, sync_started)
+            customers = [{
+                'id': customer.id,
+                'email': customer.email,
+                'created': customer.created,
+                'metadata': customer.metadata,
+                'has_payment_method': flags.get(customer.id, False)
+            } for customer in stripe_customers]
+
+        formatted_customers = flask_app.format_customers(customers)
+        upstream = timer.as_dict()
+        upstream['total_ms'] = round((time.perf_counter() - request_start) * 1000, 1)
+        logger.info("Listed %s customers", len(formatted_customers), extra={'source': source, 'upstream': upstream})
+        return 200, {'customers': formatted_customers, 'source': source, 'upstream': upstream}
+    except stripe.error.StripeError as e:
+        logger.error("Stripe error in list_customers: %s", e)
+        return 400, {'error': str(e.user_message)}
+    except Exception as e:
+        logger.error("Error listing customers: %s", e)
+        return 500, {'error': 'An unexpected error occurred'}
+
+
+async def charge_customer(request):
+    # The steps of charges.charge_customer, with its Stripe calls on the async client
+    try:
+        data = request.json()
+        customer_id = data.get('customer_id')
+        amount = data.get('amount')
+        if not all([customer_id, amount]):
+            logger.error("Missing required fields")
+            return 400, {'error': 'Customer ID and amount are required'}
+        key = data.get('idempotency_key') or charges.new_idempotency_key()
+
+        # The customer and its card are independent reads; fetch them together
+        customer, payment_methods = await asyncio.gather(
+            stripe_client.request('get', f'/v1/customers/{customer_id}'),
+            stripe_client.request('get', '/v1/payment_methods', {'customer': customer_id, 'type': 'card', 'limit': 1})
+        )
+        params = await asyncio.to_thread(
+            charges.prepare_charge, key, customer, payment_methods, amount,
+            allow_duplicate=bool(data.get('allow_duplicate'))
+        )
+        try:
+            payment_intent = await stripe_client.request('post', '/v1/payment_intents', params, idempotency_key=key)
+        except stripe.error.StripeError as e:
+            existing = await asyncio.to_thread(charges.recorded_payment_intent_id, key, e)
+            if existing is None:
+                await asyncio.to_thread(charges.record_charge_error, key, e)
+                raise
+            payment_intent = await stripe_client.request('get', f'/v1/payment_intents/{existing}')
+        charge_date, customer_metadata = await asyncio.to_thread(charges.complete_charge, key, customer, payment_intent)
+        logger.info("Charged customer %s: %s", customer_id, payment_intent.id)
+
+        updated_customer = await stripe_client.request(
+            'post', f'/v1/customers/{customer_id}', {'metadata': customer_metadata},
+            idempotency_key=f'{key}-metadata'
+        )
+        await asyncio.to_thread(charges.record_customer_update, customer, updated_customer)
+        # Coalesced with other requests' cell writes; doesn't block
+        charges.queue_charged_date(customer)
+
+        return 200, {
+            'success': True,
+            'payment_intent_id': payment_intent.id,
+            'amount': amount,
+            'status': payment_intent.status,
+            'charge_date': charge_date
+        }
+    except Exception as e:
+        body, status = flask_app.charge_error(e)
+        return status, body
+
+
+async def submit_quote(request):
+    try:
+        mapped_data, missing_fields = flask_app.map_quote(request.json())
+        if missing_fields:
+            logger.error("Missing required fields: %s", missing_fields)
+            return 400, {'error': f'Missing required fields: {missing_fields}'}
+        try:
+            await asyncio.to_thread(sheet_queue.enqueue, flask_app.build_sheet_row(mapped_data))
+        except Exception as sheets_error:
+            logger.exception("Failed to queue for Google Sheets: %s", sheets_error)
+        return 200, {'success': True, 'message': 'Quote submitted successfully'}
+    except Exception as e:
+        logger.exception("Error in submit_quote: %s", e)
+        return 500, {'error': str(e)}
+
+
+async def delete_customer(request, customer_id):
+    try:
+        customer = await stripe_client.request('get', f'/v1/customers/{customer_id}')
+        await stripe_client.request('delete', f'/v1/customers/{customer_id}')
+        await asyncio.to_thread(read_model.mark_deleted, customer_id)
+        # Holds the sheet_format lease, so it runs in the default executor
+        await asyncio.to_thread(flask_app.clear_customer_sheet_row, customer)
+
+        return 200, {'success': True, 'message': f'Customer {customer_id} deleted successfully'}
+    except Exception as e:
+        logger.error("Error deleting customer: %s", e)
+        return 500, {'error': str(e)}
+
+
+async def async_stats(request):
+    return 200, {'stripe': dict(stripe_client.counts), 'routes': dict(ROUTE_COUNTS)}
+
+
+# (method, Flask-style rule for metrics labels, pattern, handler)
+ROUTES = [
+    ('GET', '/list-customers', re.compile(r'^/list-customers$'), list_customers),
+    ('POST', '/charge-customer', re.compile(r'^/charge-customer$'), charge_customer),
+    ('POST', '/submit-quote', re.compile(r'^/submit-quote$'), submit_quote),
+    ('DELETE', '/delete-customer/<customer_id>', re.compile(r'^/delete-customer/([^/]+)$'), delete_customer),
+    ('GET', '/async/stats', re.compile(r'^/async/stats$'), async_stats)
+]
+ROUTE_COUNTS = {handler.__name__: 0 for _, _, _, handler in ROUTES}
+
+
+# -- server ----------------------------------------------------------------
+
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+
+    def json(self):
+        return json.loads(self.body or b'{}') or {}
+
+
+class AsyncApp:
+    def __init__(self, wsgi_app, cors):
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=WSGI_THREADS)
+        self.cors = cors
+
+    def _match(self, method, path):
+        for route_method, rule, pattern, handler in ROUTES:
+            if route_method == method:
+                match = pattern.match(path)
+                if match:
+                    return rule, handler, match.groups()
+        return None, None, ()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        handler = None
+        if scope['type'] == 'http':
+            rule, handler, args = self._match(scope['method'], scope['path'])
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+        ROUTE_COUNTS[handler.__name__] += 1
+        start = time.perf_counter()
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        try:
+            status, payload = await handler(request, *args)
+        except Exception as e:
+            logger.error("Unhandled error: %s", e)
+            status, payload = 500, {'error': 'An internal server error occurred', 'details': str(e)}
+        finally:
+            metrics.REQUESTS_IN_FLIGHT.dec()
+        metrics.REQUEST_DURATION.labels(rule, scope['method'], str(status)).observe(time.perf_counter() - start)
+
+        content = json.dumps(payload).encode()
+        headers = [(b'content-type', b'application/json'), (b'content-length', str(len(content)).encode())]
+        origin = request.headers.get('origin')
+        if origin:
+            headers.extend((k.lower().encode(), v.encode()) for k, v in self.cors.headers_for(origin))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await stripe_client.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = AsyncApp(flask_app.app, flask_app.cors)
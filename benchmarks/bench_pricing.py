@@ -0,0 +1,82 @@
+"""
+Compare the scalar calculate_price loop against the batch pricing engine.
+
+    python benchmarks/bench_pricing.py --count 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pricing import LOT_SIZES, SERVICE_TYPES, calculate_price, lot_size_tier, price_columns, price_quotes
+
+
+def make_quotes(count, seed):
+    rng = random.Random(seed)
+    services = list(SERVICE_TYPES) + ['UNKNOWN']
+    quotes = []
+    for _ in range(count):
+        if rng.random() < 0.5:
+            quotes.append({'square_feet': rng.uniform(500, 30000), 'service_type': rng.choice(services)})
+        else:
+            quotes.append({'lot_size': rng.choice(LOT_SIZES + ('',)), 'service_type': rng.choice(services)})
+    return quotes
+
+
+def scalar(quotes):
+    lot_sizes, prices = [], []
+    for quote in quotes:
+        if 'square_feet' in quote:
+            lot_size = lot_size_tier(quote['square_feet'])
+        else:
+            lot_size = quote['lot_size']
+        lot_sizes.append(lot_size if lot_size in LOT_SIZES else 'XLARGE')
+        prices.append(calculate_price(lot_size, quote['service_type']))
+    return lot_sizes, prices
+
+
+def best_of(fn, quotes, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(quotes)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    quotes = make_quotes(args.count, args.seed)
+    scalar_time, expected = best_of(scalar, quotes, args.repeat)
+    batch_time, actual = best_of(price_quotes, quotes, args.repeat)
+    columns = {
+        'service_types': [q['service_type'] for q in quotes],
+        'lot_sizes': [q.get('lot_size', '') for q in quotes],
+        'square_feet': [q.get('square_feet') for q in quotes]
+    }
+    columnar_time, columnar = best_of(lambda c: price_columns(**c), columns, args.repeat)
+
+    for name, result in (('batch', actual), ('columnar', columnar)):
+        if result != expected:
+            mismatches = sum(1 for a, b in zip(result[1], expected[1]) if a != b)
+            print(f"MISMATCH: {mismatches} {name} prices differ from calculate_price")
+            sys.exit(1)
+
+    print(f"quotes:   {args.count}")
+    print(f"scalar:   {scalar_time * 1000:.1f} ms")
+    print(f"batch:    {batch_time * 1000:.1f} ms ({scalar_time / batch_time:.1f}x)")
+    print(f"columnar: {columnar_time * 1000:.1f} ms ({scalar_time / columnar_time:.1f}x)")
+    print("results identical to calculate_price")
+
+
+if __name__ == '__main__':
+    main()
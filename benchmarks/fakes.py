@@ -0,0 +1,518 @@
+"""
+In-process stand-ins for the Stripe and Google Sheets APIs.
+
+Each fake is a threaded HTTP server on 127.0.0.1 that keeps its state in
+memory, adds a configurable latency to every response and can inject 500s
+and 429s. Calls are counted per route (e.g. 'GET /v1/customers/{id}') so a
+benchmark can report how many upstream calls each endpoint makes.
+
+Point the app at them with STRIPE_API_BASE, SHEETS_API_ROOT and
+SHEETS_ACCESS_TOKEN; see load.py.
+"""
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+
+class Injection:
+    """Latency and failure settings for a fake; safe to change while it runs."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """Return (delay_seconds, fault) for one request; fault is None, 500 or 429."""
+        with self._lock:
+            delay = max(0.0, self._rng.gauss(self.latency_ms, self.jitter_ms)) / 1000
+            roll = self._rng.random()
+        if roll < self.error_rate:
+            return delay, 500
+        if roll < self.error_rate + self.rate_limit_rate:
+            return delay, 429
+        return delay, None
+
+    def as_dict(self):
+        return {
+            'latency_ms': self.latency_ms,
+            'jitter_ms': self.jitter_ms,
+            'error_rate': self.error_rate,
+            'rate_limit_rate': self.rate_limit_rate
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        fake = self.server.fake
+        parts = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        route, handler, params = fake.route(self.command, unquote(parts.path))
+
+        delay, fault = fake.injection.draw()
+        if delay:
+            time.sleep(delay)
+        fake.count(route, fault)
+        if handler is None:
+            status, payload, headers = fake.not_found(self.command, parts.path)
+        elif fault is not None:
+            status, payload, headers = fake.fault(fault)
+        else:
+            request = {
+                'query': parse_qsl(parts.query, keep_blank_values=True),
+                'body': body,
+                'headers': self.headers
+            }
+            status, payload, headers = handler(request, *params)
+
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class FakeServer:
+    """Base for the fakes: routing, counting and the server thread."""
+
+    def __init__(self, injection=None):
+        self.injection = injection or Injection()
+        self.calls = Counter()
+        self.faults = Counter()
+        self._count_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._routes = [
+            (method, re.compile('^' + re.sub(r'\{\w+\}', r'([^/]+)', pattern) + '$'), f'{method} {pattern}', handler)
+            for method, pattern, handler in self.routes()
+        ]
+        self._server = None
+
+    def routes(self):
+        return []
+
+    def route(self, method, path):
+        for route_method, regex, name, handler in self._routes:
+            if route_method == method:
+                match = regex.match(path)
+                if match:
+                    return name, handler, match.groups()
+        return f'{method} (unmatched)', None, ()
+
+    def count(self, route, fault):
+        with self._count_lock:
+            self.calls[route] += 1
+            if fault is not None:
+                self.faults[route] += 1
+
+    def snapshot(self):
+        with self._count_lock:
+            return Counter(self.calls), Counter(self.faults)
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+
+# -- stripe ----------------------------------------------------------------
+
+def _form(body):
+    """Decode Stripe's form encoding (metadata[key]=v, expand[]=x) into a dict."""
+    data = {}
+    for key, value in parse_qsl(body.decode(), keep_blank_values=True):
+        match = re.match(r'^(\w+)\[(\w*)\]$', key)
+        if match is None:
+            data[key] = value
+        elif match.group(2):
+            data.setdefault(match.group(1), {})[match.group(2)] = value
+        else:
+            data.setdefault(match.group(1), []).append(value)
+    return data
+
+
+def _stripe_error(status, error_type, message, code=None):
+    error = {'type': error_type, 'message': message}
+    if code:
+        error['code'] = code
+    return status, {'error': error}, None
+
+
+class FakeStripe(FakeServer):
+    """Customers, payment methods, payment intents, checkout sessions and events."""
+
+    def __init__(self, injection=None):
+        super().__init__(injection)
+        self.customers = {}
+        self.cards = {}
+        self.payment_intents = {}
+        self._idempotent = {}
+
+    def routes(self):
+        return [
+            ('GET', '/v1/customers', self.list_customers),
+            ('POST', '/v1/customers', self.create_customer),
+            ('GET', '/v1/customers/{id}', self.get_customer),
+            ('POST', '/v1/customers/{id}', self.update_customer),
+            ('DELETE', '/v1/customers/{id}', self.delete_customer),
+            ('GET', '/v1/payment_methods', self.list_payment_methods),
+            ('POST', '/v1/payment_intents', self.create_payment_intent),
+            ('GET', '/v1/payment_intents/{id}', self.get_payment_intent),
+            ('POST', '/v1/checkout/sessions', self.create_checkout_session),
+            ('GET', '/v1/events', self.list_events),
+            ('GET', '/v1/account', self.get_account)
+        ]
+
+    def not_found(self, method, path):
+        return _stripe_error(404, 'invalid_request_error', f'Unrecognized request URL ({method}: {path})')
+
+    def fault(self, status):
+        if status == 429:
+            return _stripe_error(429, 'invalid_request_error', 'Injected rate limit', 'rate_limit')
+        return _stripe_error(500, 'api_error', 'Injected server error')
+
+    def seed(self, count, card_rate=0.9, expanded_rate=0.5, seed=1):
+        """
+        Add count customers. card_rate of them have a card; expanded_rate of
+        those have it as their default, so a listing expands it.
+        """
+        rng = random.Random(seed)
+        created = int(time.time()) - count
+        with self._lock:
+            for i in range(count):
+                customer = self._new_customer({
+                    'email': f'customer{i}@example.com',
+                    'metadata': {'service_type': 'WEEKLY', 'price': '45', 'lot_size': 'SMALL', 'charged': 'false'}
+                }, created + i)
+                if rng.random() < card_rate:
+                    card = f'pm_{uuid.uuid4().hex[:14]}'
+                    self.cards[customer['id']] = card
+                    if rng.random() < expanded_rate:
+                        customer['invoice_settings']['default_payment_method'] = {
+                            'id': card, 'object': 'payment_method', 'type': 'card'
+                        }
+        return list(self.customers)
+
+    def customers_with_cards(self):
+        with self._lock:
+            return [customer_id for customer_id in self.customers if customer_id in self.cards]
+
+    def _new_customer(self, data, created=None):
+        customer = {
+            'id': f'cus_{uuid.uuid4().hex[:14]}',
+            'object': 'customer',
+            'created': created or int(time.time()),
+            'email': data.get('email'),
+            'phone': data.get('phone'),
+            'metadata': data.get('metadata') or {},
+            'invoice_settings': {'default_payment_method': None},
+            'default_source': None
+        }
+        self.customers[customer['id']] = customer
+        return customer
+
+    def _replay(self, request, create):
+        # Honour Idempotency-Key like Stripe: same key, same response, and a
+        # reused key with different parameters is refused
+        key = request['headers'].get('Idempotency-Key')
+        params = _form(request['body'])
+        with self._lock:
+            if key and key in self._idempotent:
+                sent, response = self._idempotent[key]
+                if sent != params:
+                    return _stripe_error(
+                        400, 'idempotency_error',
+                        'Keys for idempotent requests can only be used with the same parameters they were first '
+                        f'used with. Try using a key other than {key} if you meant to execute a different request.'
+                    )
+                return response
+            response = create()
+            if key:
+                self._idempotent[key] = (params, response)
+            return response
+
+    def list_customers(self, request):
+        query = dict(request['query'])
+        limit = int(query.get('limit', 10))
+        with self._lock:
+            customers = sorted(self.customers.values(), key=lambda c: c['created'], reverse=True)
+        start = 0
+        if 'starting_after' in query:
+            ids = [c['id'] for c in customers]
+            start = ids.index(query['starting_after']) + 1 if query['starting_after'] in ids else len(ids)
+        page = customers[start:start + limit]
+        return 200, {
+            'object': 'list',
+            'url': '/v1/customers',
+            'data': page,
+            'has_more': start + limit < len(customers)
+        }, None
+
+    def create_customer(self, request):
+        return self._replay(request, lambda: (200, self._new_customer(_form(request['body'])), None))
+
+    def get_customer(self, request, customer_id):
+        customer = self.customers.get(customer_id)
+        if customer is None:
+            return _stripe_error(404, 'invalid_request_error', f'No such customer: {customer_id}', 'resource_missing')
+        return 200, customer, None
+
+    def update_customer(self, request, customer_id):
+        def update():
+            customer = self.customers.get(customer_id)
+            if customer is None:
+                return _stripe_error(404, 'invalid_request_error', f'No such customer: {customer_id}', 'resource_missing')
+            data = _form(request['body'])
+            customer['metadata'].update(data.pop('metadata', {}))
+            customer.update({k: v for k, v in data.items() if k in ('email', 'phone')})
+            return 200, customer, None
+        return self._replay(request, update)
+
+    def delete_customer(self, request, customer_id):
+        with self._lock:
+            if self.customers.pop(customer_id, None) is None:
+                return _stripe_error(404, 'invalid_request_error', f'No such customer: {customer_id}', 'resource_missing')
+            self.cards.pop(customer_id, None)
+        return 200, {'id': customer_id, 'object': 'customer', 'deleted': True}, None
+
+    def list_payment_methods(self, request):
+        card = self.cards.get(dict(request['query']).get('customer'))
+        data = [{'id': card, 'object': 'payment_method', 'type': 'card'}] if card else []
+        return 200, {'object': 'list', 'url': '/v1/payment_methods', 'data': data, 'has_more': False}, None
+
+    def create_payment_intent(self, request):
+        data = _form(request['body'])
+
+        def create():
+            payment_intent = {
+                'id': f'pi_{uuid.uuid4().hex[:14]}',
+                'object': 'payment_intent',
+                'amount': int(data.get('amount', 0)),
+                'currency': data.get('currency', 'usd'),
+                'customer': data.get('customer'),
+                'created': int(time.time()),
+                'status': 'succeeded' if str(data.get('confirm')).lower() == 'true' else 'requires_payment_method',
+                'client_secret': f'pi_secret_{uuid.uuid4().hex[:14]}',
+                'metadata': data.get('metadata') or {}
+            }
+            self.payment_intents[payment_intent['id']] = payment_intent
+            return 200, payment_intent, None
+        return self._replay(request, create)
+
+    def get_payment_intent(self, request, payment_intent_id):
+        payment_intent = self.payment_intents.get(payment_intent_id)
+        if payment_intent is None:
+            return _stripe_error(404, 'invalid_request_error', f'No such payment_intent: {payment_intent_id}',
+                                 'resource_missing')
+        return 200, payment_intent, None
+
+    def create_checkout_session(self, request):
+        session_id = f'cs_test_{uuid.uuid4().hex[:14]}'
+        return self._replay(request, lambda: (200, {
+            'id': session_id,
+            'object': 'checkout.session',
+            'url': f'https://checkout.stripe.com/c/pay/{session_id}'
+        }, None))
+
+    def list_events(self, request):
+        return 200, {'object': 'list', 'url': '/v1/events', 'data': [], 'has_more': False}, None
+
+    def get_account(self, request):
+        return 200, {'id': 'acct_benchmark', 'object': 'account'}, None
+
+
+# -- sheets ----------------------------------------------------------------
+
+_A1 = re.compile(r'^(?:[^!]*!)?([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$')
+
+
+def _column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+def _column_letters(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+class FakeSheets(FakeServer):
+    """One sheet's values, with the values() calls and row deletes the app makes."""
+
+    WIDTH = 26
+
+    def __init__(self, injection=None):
+        super().__init__(injection)
+        self.rows = []
+
+    def routes(self):
+        return [
+            ('GET', '/v4/spreadsheets/{id}/values:batchGet', self.batch_get),
+            ('POST', '/v4/spreadsheets/{id}/values:batchUpdate', self.values_batch_update),
+            ('GET', '/v4/spreadsheets/{id}/values/{range}', self.get),
+            ('PUT', '/v4/spreadsheets/{id}/values/{range}', self.update),
+            ('POST', '/v4/spreadsheets/{id}/values/{range}:append', self.append),
+            ('POST', '/v4/spreadsheets/{id}/values/{range}:clear', self.clear),
+            ('POST', '/v4/spreadsheets/{id}:batchUpdate', self.batch_update)
+        ]
+
+    def route(self, method, path):
+        # ':append' and ':clear' would otherwise match as part of {range}
+        for suffix in (':append', ':clear'):
+            if path.endswith(suffix):
+                name = f'{method} /v4/spreadsheets/{{id}}/values/{{range}}{suffix}'
+                handler = self.append if suffix == ':append' else self.clear
+                prefix = path[:-len(suffix)].rsplit('/values/', 1)
+                if method == 'POST' and len(prefix) == 2:
+                    return name, handler, ('', prefix[1])
+        return super().route(method, path)
+
+    def not_found(self, method, path):
+        return 404, {'error': {'code': 404, 'message': f'Not found: {method} {path}', 'status': 'NOT_FOUND'}}, None
+
+    def fault(self, status):
+        if status == 429:
+            return 429, {'error': {'code': 429, 'message': 'Injected quota error', 'status': 'RESOURCE_EXHAUSTED'}}, None
+        return 500, {'error': {'code': 500, 'message': 'Injected server error', 'status': 'INTERNAL'}}, None
+
+    def seed(self, header, rows):
+        with self._lock:
+            self.rows = [list(header)] + [list(row) for row in rows]
+
+    def _bounds(self, a1_range):
+        """(first_row, last_row, first_col, last_col), 0-based and inclusive."""
+        match = _A1.match(a1_range)
+        if match is None:
+            raise ValueError(f'Bad range {a1_range}')
+        start_col, start_row, end_col, end_row = match.groups()
+        is_span = ':' in a1_range
+        first_col = _column_index(start_col) if start_col else 0
+        first_row = int(start_row) - 1 if start_row else 0
+        if is_span:
+            last_col = _column_index(end_col) if end_col else self.WIDTH - 1
+            last_row = int(end_row) - 1 if end_row else max(len(self.rows) - 1, first_row)
+        else:
+            last_col = first_col if start_col else self.WIDTH - 1
+            last_row = first_row if start_row else max(len(self.rows) - 1, first_row)
+        return first_row, last_row, first_col, last_col
+
+    def _read(self, a1_range):
+        first_row, last_row, first_col, last_col = self._bounds(a1_range)
+        values = []
+        for row in self.rows[first_row:last_row + 1]:
+            cells = row[first_col:last_col + 1]
+            while cells and cells[-1] in ('', None):
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        result = {'range': a1_range, 'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def _write(self, first_row, first_col, values):
+        for r, row_values in enumerate(values):
+            index = first_row + r
+            while len(self.rows) <= index:
+                self.rows.append([])
+            row = self.rows[index]
+            for c, value in enumerate(row_values):
+                column = first_col + c
+                while len(row) <= column:
+                    row.append('')
+                row[column] = value if isinstance(value, str) else json.dumps(value)
+
+    def _range_name(self, first_row, last_row, first_col, last_col):
+        return f'Sheet1!{_column_letters(first_col)}{first_row + 1}:{_column_letters(last_col)}{last_row + 1}'
+
+    def get(self, request, spreadsheet_id, a1_range):
+        with self._lock:
+            return 200, self._read(a1_range), None
+
+    def batch_get(self, request, spreadsheet_id):
+        ranges = [value for key, value in request['query'] if key == 'ranges']
+        with self._lock:
+            return 200, {'valueRanges': [self._read(a1_range) for a1_range in ranges]}, None
+
+    def update(self, request, spreadsheet_id, a1_range):
+        values = json.loads(request['body'] or b'{}').get('values', [])
+        with self._lock:
+            first_row, _, first_col, _ = self._bounds(a1_range)
+            self._write(first_row, first_col, values)
+        return 200, {'updatedRange': a1_range, 'updatedRows': len(values)}, None
+
+    def values_batch_update(self, request, spreadsheet_id):
+        data = json.loads(request['body'] or b'{}').get('data', [])
+        with self._lock:
+            for item in data:
+                first_row, _, first_col, _ = self._bounds(item['range'])
+                self._write(first_row, first_col, item.get('values', []))
+        return 200, {'totalUpdatedRanges': len(data)}, None
+
+    def append(self, request, spreadsheet_id, a1_range):
+        values = json.loads(request['body'] or b'{}').get('values', [])
+        with self._lock:
+            _, _, first_col, _ = self._bounds(a1_range)
+            first_row = len(self.rows)
+            while first_row and not any(self.rows[first_row - 1]):
+                first_row -= 1
+            self._write(first_row, first_col, values)
+            width = max((len(row) for row in values), default=1)
+            updated = self._range_name(first_row, first_row + len(values) - 1, first_col, first_col + width - 1)
+        return 200, {'updates': {'updatedRange': updated, 'updatedRows': len(values)}}, None
+
+    def clear(self, request, spreadsheet_id, a1_range):
+        with self._lock:
+            first_row, last_row, first_col, last_col = self._bounds(a1_range)
+            for row in self.rows[first_row:last_row + 1]:
+                for column in range(first_col, min(last_col + 1, len(row))):
+                    row[column] = ''
+        return 200, {'clearedRange': a1_range}, None
+
+    def batch_update(self, request, spreadsheet_id):
+        # Only row deletes change values; formatting requests are accepted as-is
+        requests = json.loads(request['body'] or b'{}').get('requests', [])
+        with self._lock:
+            for item in requests:
+                dimension = item.get('deleteDimension', {}).get('range')
+                if dimension and dimension.get('dimension') == 'ROWS':
+                    del self.rows[dimension['startIndex']:dimension['endIndex']]
+        return 200, {'spreadsheetId': spreadsheet_id, 'replies': [{} for _ in requests]}, None
@@ -0,0 +1,423 @@
+"""
+End-to-end load test of app.py against in-process Stripe and Sheets fakes.
+
+    python benchmarks/load.py --concurrency 16 --duration 30
+    python benchmarks/load.py --stripe-latency 120 --error-rate 0.02 --save baseline.json
+    python benchmarks/load.py --compare baseline.json
+
+The app runs in this process on a fixed pool of request threads (like one
+gunicorn gthread worker) with its database and spool in a temp directory.
+Before the timed run, each endpoint in the mix is called on its own a few
+times to measure how many upstream calls one request makes. The timed run
+then drives the weighted mix at fixed concurrency and reports p50/p95/p99
+latency and throughput per endpoint, and the upstream calls made.
+
+Results are written as JSON (default benchmarks/results/<commit>.json).
+--compare checks p95 and throughput against an earlier result and exits
+non-zero if either regressed by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fakes import FakeSheets, FakeStripe, Injection
+
+DEFAULT_MIX = 'quote=50,setup_intent=20,list=10,charge=20'
+# sheet_format.HEADERS; not imported, since app modules read their env at import
+SHEET_HEADER = ['Timestamp', 'Customer Name', 'Email', 'Service Type', 'Phone Number', 'Address', 'Lot Size',
+                'Price ($)', 'Charged Date', 'Start Date', 'Payment Status']
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 1)
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint in --mix: {name} (choose from {', '.join(ENDPOINTS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+# -- traffic ---------------------------------------------------------------
+
+class Traffic:
+    """Builds requests for each endpoint in the mix."""
+
+    def __init__(self, base_url, customers):
+        from pricing import LOT_SIZES, SERVICE_TYPES
+        self.base_url = base_url
+        self.customers = customers
+        self.lot_sizes = list(LOT_SIZES)
+        self.service_types = list(SERVICE_TYPES)
+
+    def _quote_fields(self, rng):
+        return {
+            'phone': f'555-{rng.randint(1000, 9999)}',
+            'address': f'{rng.randint(1, 9999)} Benchmark Ave',
+            'lot_size': rng.choice(self.lot_sizes),
+            'service_type': rng.choice(self.service_types),
+            'price': rng.choice([35, 45, 60, 80])
+        }
+
+    def quote(self, session, rng):
+        data = self._quote_fields(rng)
+        data.update({'name': 'Load Test', 'email': f'quote-{uuid.uuid4().hex[:10]}@example.com'})
+        return session.post(f'{self.base_url}/submit-quote', json=data)
+
+    def setup_intent(self, session, rng):
+        data = self._quote_fields(rng)
+        data.update({
+            'metadata': {'email': f'setup-{uuid.uuid4().hex[:10]}@example.com'},
+            'success_url': 'https://example.com/success',
+            'cancel_url': 'https://example.com/cancel'
+        })
+        return session.post(f'{self.base_url}/create-setup-intent', json=data)
+
+    def list(self, session, rng):
+        return session.get(f'{self.base_url}/list-customers')
+
+    def charge(self, session, rng):
+        return session.post(f'{self.base_url}/charge-customer', json={
+            'customer_id': rng.choice(self.customers),
+            'amount': rng.choice([35, 45, 60, 80]),
+            # Random draws repeat customer and amount; that's load, not a mistake
+            'allow_duplicate': True
+        })
+
+
+ENDPOINTS = ('quote', 'setup_intent', 'list', 'charge')
+
+
+# -- app server --------------------------------------------------------------
+
+def serve_app(threads):
+    """Serve app.app on a fixed pool of request threads; returns (server, url)."""
+    from werkzeug.serving import BaseWSGIServer
+    import app as flask_app
+
+    class PooledWSGIServer(BaseWSGIServer):
+        multithread = True
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='app')
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._process, request, client_address)
+
+        def _process(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    server = PooledWSGIServer('127.0.0.1', 0, flask_app.app)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def upstream_delta(fakes, before):
+    """Calls and injected faults per upstream route since before."""
+    delta = {}
+    for name, fake in fakes.items():
+        calls, faults = fake.snapshot()
+        calls.subtract(before[name][0])
+        faults.subtract(before[name][1])
+        delta[name] = {
+            route: {'calls': count, 'faults': faults[route]}
+            for route, count in sorted(calls.items()) if count
+        }
+    return delta
+
+
+def snapshots(fakes):
+    return {name: fake.snapshot() for name, fake in fakes.items()}
+
+
+def flush_background():
+    """Push out work the app defers, so it is counted against the right phase."""
+    from sheet_queue import sheet_queue
+    try:
+        sheet_queue.flush()
+    except Exception:
+        pass  # an injected fault; the queue retries the batch itself
+
+
+def calibrate(traffic, mix, fakes, count, seed):
+    """
+    Upstream calls per request for each endpoint, measured one at a time
+    with fault injection paused, so retries don't blur the counts.
+    """
+    rates = {name: (fake.injection.error_rate, fake.injection.rate_limit_rate) for name, fake in fakes.items()}
+    for fake in fakes.values():
+        fake.injection.error_rate = fake.injection.rate_limit_rate = 0.0
+    result = {}
+    session = requests.Session()
+    rng = random.Random(seed)
+    for endpoint in mix:
+        before = snapshots(fakes)
+        statuses = Counter()
+        for _ in range(count):
+            statuses[getattr(traffic, endpoint)(session, rng).status_code] += 1
+        flush_background()
+        delta = upstream_delta(fakes, before)
+        result[endpoint] = {
+            'requests': count,
+            'statuses': {str(k): v for k, v in statuses.items()},
+            'upstream_calls_per_request': {
+                name: {route: round(c['calls'] / count, 2) for route, c in routes.items()}
+                for name, routes in delta.items()
+            }
+        }
+    for name, fake in fakes.items():
+        fake.injection.error_rate, fake.injection.rate_limit_rate = rates[name]
+    return result
+
+
+def run(traffic, mix, concurrency, duration, max_requests, seed):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    samples = defaultdict(list)
+    statuses = defaultdict(Counter)
+    issued = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            with lock:
+                if max_requests and issued[0] >= max_requests:
+                    return
+                issued[0] += 1
+            endpoint = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = getattr(traffic, endpoint)(session, rng).status_code
+            except requests.RequestException:
+                status = 'connection_error'
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                samples[endpoint].append(elapsed)
+                statuses[endpoint][status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load') as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - started
+
+    def summary(latencies, codes):
+        errors = sum(n for code, n in codes.items() if code == 'connection_error' or code >= 500)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'error_rate': round(errors / len(latencies), 4) if latencies else None,
+            'statuses': {str(code): n for code, n in codes.items()},
+            'throughput_rps': round(len(latencies) / wall, 2),
+            'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': round(max(latencies), 1) if latencies else None
+        }
+
+    endpoints = {name: summary(samples[name], statuses[name]) for name in names if samples[name]}
+    everything = [s for name in names for s in samples[name]]
+    overall_statuses = Counter()
+    for codes in statuses.values():
+        overall_statuses.update(codes)
+    return endpoints, summary(everything, overall_statuses), round(wall, 2)
+
+
+# -- comparison --------------------------------------------------------------
+
+def compare(result, baseline, tolerance):
+    """Print a comparison; returns the list of regressions."""
+    regressions = []
+    print(f"\nvs baseline {baseline['meta']['commit']} ({baseline['meta']['timestamp']}):")
+    print(f"{'endpoint':<14}{'p95 ms':>24}{'p99 ms':>24}{'rps':>24}")
+    for name, current in {**result['endpoints'], 'overall': result['overall']}.items():
+        previous = baseline['endpoints'].get(name) if name != 'overall' else baseline['overall']
+        if not previous:
+            continue
+
+        def cell(key):
+            before, after = previous.get(key), current.get(key)
+            if not before or after is None:
+                return f"{after!s:>24}"
+            return f"{before:>7} → {after:<7}{(after / before - 1) * 100:+.0f}%".rjust(24)
+
+        print(f"{name:<14}{cell('p95_ms')}{cell('p99_ms')}{cell('throughput_rps')}")
+        if previous.get('p95_ms') and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name} p95 {previous['p95_ms']} → {current['p95_ms']} ms")
+        if previous.get('throughput_rps') and current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name} throughput {previous['throughput_rps']} → {current['throughput_rps']} rps")
+    return regressions
+
+
+def print_report(result):
+    print(f"\n{'endpoint':<14}{'requests':>9}{'errors':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (ms)")
+    for name, s in {**result['endpoints'], 'overall': result['overall']}.items():
+        print(f"{name:<14}{s['requests']:>9}{s['errors']:>8}{s['throughput_rps']:>9}"
+              f"{s['p50_ms']!s:>9}{s['p95_ms']!s:>9}{s['p99_ms']!s:>9}{s['max_ms']!s:>9}")
+    print("\nupstream calls per request (measured alone):")
+    for name, calibration in result['calibration'].items():
+        calls = ', '.join(
+            f"{route} ×{n}" for routes in calibration['upstream_calls_per_request'].values()
+            for route, n in routes.items()
+        )
+        print(f"  {name:<14}{calls or '-'}")
+    print("\nupstream calls during the run:")
+    for fake, routes in result['upstream'].items():
+        for route, counts in routes.items():
+            print(f"  {fake:<8}{route:<52}{counts['calls']:>7}  faults {counts['faults']}")
+
+
+# -- main --------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'weighted endpoints (default {DEFAULT_MIX})')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of load')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests')
+    parser.add_argument('--app-threads', type=int, default=int(os.getenv('GUNICORN_THREADS', 4)))
+    parser.add_argument('--customers', type=int, default=200, help='customers seeded in the fake Stripe')
+    parser.add_argument('--stripe-latency', type=float, default=60.0, help='mean ms per Stripe call')
+    parser.add_argument('--sheets-latency', type=float, default=120.0, help='mean ms per Sheets call')
+    parser.add_argument('--jitter', type=float, default=0.25, help='latency std dev as a share of the mean')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream calls answered 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='share answered 429')
+    parser.add_argument('--calibrate', type=int, default=5, help='requests per endpoint in the calibration pass')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='result path (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='earlier result to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95/throughput regression')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    # The app runs from a temp directory; resolve paths given on the command line first
+    args.save = os.path.abspath(args.save) if args.save else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+
+    def injection(latency, seed):
+        return Injection(latency, latency * args.jitter, args.error_rate, args.rate_limit_rate, seed)
+
+    fakes = {
+        'stripe': FakeStripe(injection(args.stripe_latency, args.seed)).start(),
+        'sheets': FakeSheets(injection(args.sheets_latency, args.seed + 1)).start()
+    }
+    fakes['stripe'].seed(args.customers, seed=args.seed)
+    fakes['sheets'].seed(SHEET_HEADER, [
+        ['2024-01-01 00:00:00', 'Customer', customer['email'], 'WEEKLY', '555-0100', '1 Main St', 'SMALL', '45', '',
+         '2024-01-08', 'Pending']
+        for customer in fakes['stripe'].customers.values()
+    ])
+
+    workdir = tempfile.mkdtemp(prefix='lawn-peak-bench-')
+    os.environ.update({
+        'STRIPE_SECRET_KEY': 'sk_test_benchmark',
+        'STRIPE_API_BASE': fakes['stripe'].url,
+        'SHEETS_API_ROOT': fakes['sheets'].url + '/',
+        'SHEETS_ACCESS_TOKEN': 'benchmark-token',
+        'GOOGLE_SHEETS_ID': 'benchmark-sheet',
+        'PAYMENTS_DB_PATH': os.path.join(workdir, 'payments.db'),
+        'SHEET_SPOOL_DIR': os.path.join(workdir, 'spool'),
+        'GUNICORN_THREADS': str(args.app_threads)
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.chdir(workdir)
+
+    server, base_url = serve_app(args.app_threads)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    import read_model
+    # Let the initial customer sync finish so it isn't measured as load
+    deadline = time.time() + 60
+    while not read_model.ready() and time.time() < deadline:
+        time.sleep(0.2)
+
+    traffic = Traffic(base_url, fakes['stripe'].customers_with_cards())
+    print(f"app {base_url} ({args.app_threads} threads), stripe {fakes['stripe'].url}, sheets {fakes['sheets'].url}")
+    calibration = calibrate(traffic, mix, fakes, args.calibrate, args.seed)
+
+    print(f"running {args.mix} at concurrency {args.concurrency} for {args.duration}s ...")
+    before = snapshots(fakes)
+    endpoints, overall, wall = run(traffic, mix, args.concurrency, args.duration, args.requests, args.seed)
+    flush_background()
+
+    import stripe_http
+    import stripe_scheduler
+    result = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'args': vars(args),
+            'wall_s': wall,
+            'upstream': {name: fake.injection.as_dict() for name, fake in fakes.items()}
+        },
+        'endpoints': endpoints,
+        'overall': overall,
+        'calibration': calibration,
+        'upstream': upstream_delta(fakes, before),
+        'app': {
+            'stripe_http': stripe_http.client().stats() if stripe_http.client() else None,
+            'stripe_scheduler': stripe_scheduler.scheduler.stats()
+        }
+    }
+    print_report(result)
+
+    path = args.save or os.path.join(ROOT, 'benchmarks', 'results', f"{result['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nsaved {path}")
+
+    server.shutdown()
+    for fake in fakes.values():
+        fake.stop()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("\nREGRESSIONS:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nno regressions beyond tolerance")
+
+
+if __name__ == '__main__':
+    main()
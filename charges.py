@@ -0,0 +1,256 @@
+import os
+import time
+import uuid
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import stripe
+
+import ledger
+import read_model
+import stripe_scheduler
+from sheet_index import row_index
+from sheet_writes import sheet_writes
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = int(os.getenv('BULK_CHARGE_MAX_CONCURRENCY', 8))
+DEFAULT_CONCURRENCY = int(os.getenv('BULK_CHARGE_CONCURRENCY', 4))
+
+
+# Customer metadata a charge writes, kept out of the PaymentIntent's copy
+CHARGE_METADATA = ('charge_date',)
+
+
+class NoPaymentMethodError(Exception):
+    pass
+
+
+def to_cents(amount):
+    return int(round(float(amount) * 100))
+
+
+def idempotency_key(customer_id, amount, batch_id=None):
+    """
+    Stable key for charging a customer an amount. Without a batch id the key
+    is scoped to the current UTC day, so a retried route never charges twice
+    (Stripe keeps idempotency keys for 24 hours).
+    """
+    scope = batch_id or datetime.datetime.utcnow().strftime('%Y-%m-%d')
+    return f'charge-{scope}-{customer_id}-{to_cents(amount)}'
+
+
+def new_idempotency_key():
+    """Key for a one-off charge, so its ledger row and Stripe retries share it."""
+    return f'charge-{uuid.uuid4().hex}'
+
+
+def charge_customer(customer_id, amount, idempotency_key=None, batch_id=None, allow_duplicate=False):
+    """
+    Charge a customer's saved card and stamp the charge date on the customer.
+    The attempt is recorded in the ledger under its idempotency key; a second
+    charge of the same amount within ledger.DUPLICATE_WINDOW raises
+    ledger.DuplicateChargeError unless allow_duplicate is set.
+    Returns (customer, payment_intent, charge_date).
+
+    The steps are shared with the ASGI route, which makes the same Stripe
+    calls on its async client.
+    """
+    idempotency_key = idempotency_key or new_idempotency_key()
+    customer = stripe.Customer.retrieve(customer_id)
+
+    payment_methods = stripe.PaymentMethod.list(
+        customer=customer_id,
+        type='card',
+        limit=1
+    )
+    params = prepare_charge(idempotency_key, customer, payment_methods, amount, batch_id, allow_duplicate)
+
+    # Create and confirm the payment intent
+    try:
+        payment_intent = stripe.PaymentIntent.create(**params, idempotency_key=idempotency_key)
+    except stripe.error.StripeError as e:
+        existing = recorded_payment_intent_id(idempotency_key, e)
+        if existing is None:
+            record_charge_error(idempotency_key, e)
+            raise
+        payment_intent = stripe.PaymentIntent.retrieve(existing)
+    charge_date, customer_metadata = complete_charge(idempotency_key, customer, payment_intent)
+
+    updated_customer = stripe.Customer.modify(
+        customer_id,
+        metadata=customer_metadata,
+        idempotency_key=f'{idempotency_key}-metadata'
+    )
+    record_customer_update(customer, updated_customer)
+    return customer, payment_intent, charge_date
+
+
+def prepare_charge(idempotency_key, customer, payment_methods, amount, batch_id=None, allow_duplicate=False):
+    """
+    Open the ledger row for charging the customer's first card.
+    Returns the PaymentIntent create parameters.
+    """
+    if not payment_methods.data:
+        raise NoPaymentMethodError('No payment method found for customer')
+
+    ledger.begin(
+        idempotency_key, customer.id, to_cents(amount), email=customer.email, batch_id=batch_id,
+        duplicate_window=0 if allow_duplicate else ledger.DUPLICATE_WINDOW
+    )
+    return {
+        'amount': to_cents(amount),
+        'currency': 'usd',
+        'customer': customer.id,
+        'payment_method': payment_methods.data[0].id,
+        'off_session': True,
+        'confirm': True,
+        # Without the fields a charge changes, so a retry under the same key
+        # sends the same parameters
+        'metadata': {k: v for k, v in (customer.metadata or {}).items() if k not in CHARGE_METADATA}
+    }
+
+
+def record_charge_error(idempotency_key, error):
+    """Settle the ledger row after a failed PaymentIntent create."""
+    # Only a 4xx is a definite no; after a network error or 5xx the row
+    # stays pending until a retry with the same key or a webhook settles it.
+    # An idempotency error or conflict is about the request, not the charge
+    # the key already made.
+    if isinstance(error, stripe.error.IdempotencyError) or error.http_status == 409:
+        return
+    if error.http_status is not None and error.http_status < 500:
+        declined = error.error.get('payment_intent') if error.error else None
+        ledger.record_failure(idempotency_key, error.user_message or str(error), declined['id'] if declined else None)
+
+
+def recorded_payment_intent_id(idempotency_key, error):
+    """
+    The PaymentIntent an earlier attempt under the key created, when Stripe
+    refused the retry because its parameters changed (e.g. the customer's
+    metadata was edited in between). None otherwise.
+    """
+    if not isinstance(error, stripe.error.IdempotencyError):
+        return None
+    charge = ledger.get_charge(idempotency_key)
+    return charge['payment_intent_id'] if charge else None
+
+
+def complete_charge(idempotency_key, customer, payment_intent):
+    """Record the PaymentIntent. Returns (charge_date, customer metadata update)."""
+    ledger.record_result(idempotency_key, payment_intent)
+
+    # Derive the charge date from the payment intent, and send only the keys
+    # that change (Stripe merges metadata), so a replayed update sends
+    # identical parameters under the same idempotency key
+    charge_date = time.strftime('%d.%m.%Y %H:%M', time.localtime(payment_intent.created))
+    return charge_date, {'charge_date': charge_date}
+
+
+def record_customer_update(customer, updated_customer):
+    read_model.upsert_customer(updated_customer)
+    row_index.register_customer(customer.id, customer.email)
+
+
+def queue_charged_date(customer):
+    """Queue the Charged Date cell of the customer's sheet row in the write buffer."""
+    if not customer.email:
+        logger.warning("Customer %s has no email to find in the sheet", customer.id)
+        return None
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return sheet_writes.write(customer.email, 'Charged Date', now)
+
+
+def write_charged_dates(emails, charged_at, timeout=30):
+    """
+    Set the Charged Date column for each email's row through the sheet write
+    buffer, flushing it now. Returns the number of rows written.
+    """
+    futures = [sheet_writes.write(email, 'Charged Date', charged_at) for email in dict.fromkeys(emails) if email]
+    sheet_writes.flush()
+    return sum(1 for future in futures if future.result(timeout=timeout) is not None)
+
+
+def _charge_one(item, batch_id):
+    customer_id = item.get('customer_id')
+    amount = item.get('amount')
+    result = {'customer_id': customer_id, 'amount': amount}
+    if not customer_id or not amount:
+        result.update({'success': False, 'error': 'Customer ID and amount are required'})
+        return result, None
+
+    key = item.get('idempotency_key') or idempotency_key(customer_id, amount, batch_id)
+    try:
+        customer, payment_intent, charge_date = charge_customer(customer_id, amount, idempotency_key=key,
+                                                                batch_id=batch_id)
+        result.update({
+            'success': True,
+            'payment_intent_id': payment_intent.id,
+            'status': payment_intent.status,
+            'charge_date': charge_date,
+            'idempotency_key': key
+        })
+        return result, customer.email
+    except stripe.error.CardError as e:
+        result.update({'success': False, 'error': 'Card was declined', 'details': str(e)})
+    except (NoPaymentMethodError, ledger.DuplicateChargeError) as e:
+        result.update({'success': False, 'error': str(e)})
+    except Exception as e:
+        logger.error("Error charging customer %s: %s", customer_id, e)
+        result.update({'success': False, 'error': 'An unexpected error occurred', 'details': str(e)})
+    result['idempotency_key'] = key
+    return result, None
+
+
+def charge_many(items, concurrency=None, batch_id=None):
+    """
+    Charge many customers with bounded concurrency, yielding each result as
+    it finishes and a summary last. Charged Date cells for all successful
+    charges are written to the sheet in a single batch at the end, even if
+    the caller stops reading early (e.g. the client disconnected).
+    """
+    concurrency = max(1, min(int(concurrency or DEFAULT_CONCURRENCY), MAX_CONCURRENCY))
+    started = time.perf_counter()
+    charged_emails = []
+    succeeded = 0
+    sheet_rows = 0
+    sheet_error = None
+
+    def collect(future):
+        # Runs for every finished charge, whether or not its result was read
+        result, email = future.result()
+        if result['success'] and email:
+            charged_emails.append(email)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bulk-charge') as pool:
+            charge_one = stripe_scheduler.bind(_charge_one, stripe_scheduler.BATCH)
+            futures = [pool.submit(charge_one, item, batch_id) for item in items]
+            for future in futures:
+                future.add_done_callback(collect)
+            for future in as_completed(futures):
+                result, _ = future.result()
+                if result['success']:
+                    succeeded += 1
+                yield result
+    finally:
+        # Leaving the pool waited for every submitted charge
+        if charged_emails:
+            try:
+                now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                sheet_rows = write_charged_dates(charged_emails, now)
+            except Exception as e:
+                logger.error("Error writing charge dates to sheet: %s", e)
+                sheet_error = str(e)
+
+    yield {
+        'summary': {
+            'total': len(items),
+            'succeeded': succeeded,
+            'failed': len(items) - succeeded,
+            'sheet_rows_updated': sheet_rows,
+            'sheet_error': sheet_error,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+        }
+    }
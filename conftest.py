@@ -0,0 +1,58 @@
+"""
+Test setup: the app is pointed at the in-process Stripe and Sheets fakes
+from benchmarks/fakes.py and a throwaway payments.db before any project
+module is imported, since most of them read their settings at import.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+
+from fakes import FakeSheets, FakeStripe  # noqa: E402
+
+FAKE_STRIPE = FakeStripe().start()
+FAKE_SHEETS = FakeSheets().start()
+WORKDIR = tempfile.mkdtemp(prefix='lawn-peak-tests-')
+
+os.environ.update({
+    'STRIPE_SECRET_KEY': 'sk_test_tests',
+    'STRIPE_API_BASE': FAKE_STRIPE.url,
+    'SHEETS_API_ROOT': FAKE_SHEETS.url + '/',
+    'SHEETS_ACCESS_TOKEN': 'test-token',
+    'GOOGLE_SHEETS_ID': 'test-sheet',
+    'PAYMENTS_DB_PATH': os.path.join(WORKDIR, 'payments.db'),
+    'SHEET_SPOOL_DIR': os.path.join(WORKDIR, 'spool'),
+    'PROFILE_DIR': os.path.join(WORKDIR, 'profiles'),
+    'STARTUP_WARMUP': '0',
+    'LOG_LEVEL': 'WARNING'
+})
+
+
+def sheet_row(email, service_type='WEEKLY', charged_date=''):
+    return ['2024-01-01 00:00:00', 'Customer', email, service_type, '555-0100', '1 Main St', 'SMALL', '45',
+            charged_date, '2024-01-08', 'Pending']
+
+
+@pytest.fixture
+def flask_app(monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'GOOGLE_SERVICES_AVAILABLE', True)
+    return app
+
+
+@pytest.fixture
+def customers():
+    """Fresh fake Stripe customers, all with a card, each with a sheet row."""
+    import sheet_format
+    from sheet_index import row_index
+
+    with FAKE_STRIPE._lock:
+        FAKE_STRIPE.customers.clear()
+        FAKE_STRIPE.cards.clear()
+    ids = FAKE_STRIPE.seed(4, card_rate=1.0)
+    FAKE_SHEETS.seed(sheet_format.HEADERS, [sheet_row(FAKE_STRIPE.customers[i]['email']) for i in ids])
+    row_index.invalidate()
+    return [FAKE_STRIPE.customers[i] for i in ids]
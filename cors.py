@@ -0,0 +1,72 @@
+"""
+CORS as a single WSGI middleware. Origins are checked against a frozenset
+and every header list is built once per allowed origin, so a preflight is
+answered before Flask routing with no per-request work.
+"""
+
+DEFAULT_METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'OPTIONS')
+DEFAULT_ALLOW_HEADERS = ('Content-Type', 'Authorization', 'Accept', 'Stripe-Version', 'Stripe-Signature')
+DEFAULT_EXPOSE_HEADERS = ('Content-Type', 'Authorization')
+
+
+class CORSMiddleware:
+    def __init__(self, app, origins, methods=DEFAULT_METHODS, allow_headers=DEFAULT_ALLOW_HEADERS,
+                 expose_headers=DEFAULT_EXPOSE_HEADERS, supports_credentials=True, max_age=3600):
+        self.app = app
+        self.origins = frozenset(origins)
+        self.counts = {'preflight': 0, 'preflight_rejected': 0, 'requests': 0}
+
+        self._response_headers = {}
+        self._preflight_headers = {}
+        for origin in self.origins:
+            headers = [('Access-Control-Allow-Origin', origin), ('Vary', 'Origin')]
+            if supports_credentials:
+                headers.append(('Access-Control-Allow-Credentials', 'true'))
+            self._response_headers[origin] = headers + [
+                ('Access-Control-Expose-Headers', ','.join(expose_headers))
+            ]
+            self._preflight_headers[origin] = headers + [
+                ('Access-Control-Allow-Methods', ','.join(methods)),
+                ('Access-Control-Allow-Headers', ','.join(allow_headers)),
+                ('Access-Control-Max-Age', str(max_age)),
+                ('Content-Length', '0')
+            ]
+        self._rejected_preflight_headers = [('Vary', 'Origin'), ('Content-Length', '0')]
+
+    def __call__(self, environ, start_response):
+        origin = environ.get('HTTP_ORIGIN')
+        if origin is None:
+            return self.app(environ, start_response)
+
+        if environ['REQUEST_METHOD'] == 'OPTIONS' and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ:
+            headers = self._preflight_headers.get(origin)
+            if headers is None:
+                self.counts['preflight_rejected'] += 1
+                headers = self._rejected_preflight_headers
+            else:
+                self.counts['preflight'] += 1
+            start_response('204 No Content', list(headers))
+            return [b'']
+
+        cors_headers = self.headers_for(origin)
+        if not cors_headers:
+            return self.app(environ, start_response)
+
+        def cors_start_response(status, headers, exc_info=None):
+            # This layer owns the CORS headers; drop any a view set itself
+            headers = [h for h in headers if not h[0].lower().startswith('access-control-')]
+            headers.extend(cors_headers)
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, cors_start_response)
+
+    def headers_for(self, origin):
+        """Headers to add to a non-preflight response for origin; empty if it isn't allowed."""
+        headers = self._response_headers.get(origin)
+        if headers is None:
+            return []
+        self.counts['requests'] += 1
+        return headers
+
+    def stats(self):
+        return {**self.counts, 'origins': len(self.origins)}
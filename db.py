@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import threading
+
+DB_PATH = os.getenv('PAYMENTS_DB_PATH', 'payments.db')
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_applied_schemas = set()
+
+
+def get_connection():
+    """
+    Return this thread's connection to payments.db.
+    sqlite3 connections can't be shared between threads, and must not be
+    carried across a fork, so each thread in each process opens its own.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'pid', None) == os.getpid():
+        return conn
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside the one writer instead of waiting on it;
+    # with WAL, synchronous=NORMAL is still safe against corruption
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def ensure_schema(name, ddl):
+    """Run a module's CREATE ... IF NOT EXISTS script once per process."""
+    key = (os.getpid(), name)
+    if key in _applied_schemas:
+        return
+    with _schema_lock:
+        if key in _applied_schemas:
+            return
+        get_connection().executescript(ddl)
+        _applied_schemas.add(key)
+
+
+def ensure_column(table, column, definition):
+    """Add a column missing from a table created by an older schema (once per process)."""
+    key = (os.getpid(), f'{table}.{column}')
+    if key in _applied_schemas:
+        return
+    with _schema_lock:
+        if key in _applied_schemas:
+            return
+        conn = get_connection()
+        if column not in {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}:
+            try:
+                with conn:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError as e:
+                # Another process added it first
+                if 'duplicate column' not in str(e):
+                    raise
+        _applied_schemas.add(key)
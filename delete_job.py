@@ -0,0 +1,352 @@
+"""
+Background bulk deletion of Stripe customers.
+
+A job runs in three checkpointed phases, each resumable after a restart:
+
+    collect  page through every customer, saving id and email per page
+    delete   delete the saved customers with bounded concurrency
+    sheet    delete all of their sheet rows in one batchUpdate
+
+Progress lives in payments.db. A job is leased by one process at a time;
+if that process dies, the lease expires and another worker resumes the job.
+"""
+import os
+import time
+import uuid
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+
+import read_model
+import stripe_scheduler
+import sheet_format
+from db import get_connection, ensure_schema, ensure_column
+from sheets_client import get_sheets_service
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = int(os.getenv('DELETE_JOB_MAX_CONCURRENCY', 8))
+DEFAULT_CONCURRENCY = int(os.getenv('DELETE_JOB_CONCURRENCY', 4))
+LEASE_SECONDS = int(os.getenv('DELETE_JOB_LEASE_SECONDS', 60))
+POLL_INTERVAL = int(os.getenv('DELETE_JOB_POLL_INTERVAL', 15))
+MAX_ATTEMPTS = 5
+# A job that errors this many runs in a row is marked failed
+JOB_MAX_ATTEMPTS = int(os.getenv('DELETE_JOB_MAX_ATTEMPTS', 5))
+PAGE_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS delete_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    phase TEXT NOT NULL DEFAULT 'collect',
+    cursor TEXT,
+    concurrency INTEGER NOT NULL,
+    collected INTEGER NOT NULL DEFAULT 0,
+    sheet_rows_deleted INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS delete_job_items (
+    job_id TEXT NOT NULL,
+    customer_id TEXT NOT NULL,
+    email TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    PRIMARY KEY (job_id, customer_id)
+);
+CREATE INDEX IF NOT EXISTS idx_delete_job_items_status ON delete_job_items (job_id, status);
+"""
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_state = {'pid': None, 'sheets': True}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def _conn():
+    ensure_schema('delete_job', SCHEMA)
+    ensure_column('delete_jobs', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+    return get_connection()
+
+
+# -- api -------------------------------------------------------------------
+
+def create_job(concurrency=None):
+    """Queue a job that deletes every customer. Returns the job id."""
+    concurrency = max(1, min(int(concurrency or DEFAULT_CONCURRENCY), MAX_CONCURRENCY))
+    job_id = uuid.uuid4().hex
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'INSERT INTO delete_jobs (id, concurrency, created_at) VALUES (?, ?, ?)',
+            (job_id, concurrency, time.time())
+        )
+    start()
+    _wake.set()
+    return job_id
+
+
+def cancel_job(job_id):
+    conn = _conn()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE delete_jobs SET status = 'cancelled', finished_at = ? "
+            "WHERE id = ? AND status IN ('pending', 'running')",
+            (time.time(), job_id)
+        )
+    return cursor.rowcount > 0
+
+
+def get_job(job_id):
+    """Progress of a job, or None if there is no such job."""
+    conn = _conn()
+    job = conn.execute('SELECT * FROM delete_jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is None:
+        return None
+    counts = dict(conn.execute(
+        'SELECT status, COUNT(*) FROM delete_job_items WHERE job_id = ? GROUP BY status', (job_id,)
+    ).fetchall())
+    done = counts.get('deleted', 0) + counts.get('failed', 0)
+    end = job['finished_at'] or time.time()
+    elapsed = end - job['started_at'] if job['started_at'] else 0
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'phase': job['phase'],
+        'concurrency': job['concurrency'],
+        'collected': job['collected'],
+        'deleted': counts.get('deleted', 0),
+        'failed': counts.get('failed', 0),
+        'pending': counts.get('pending', 0),
+        'progress': round(done / job['collected'], 3) if job['collected'] and job['phase'] != 'collect' else None,
+        'sheet_rows_deleted': job['sheet_rows_deleted'],
+        'attempts': job['attempts'],
+        'deleted_per_second': round(counts.get('deleted', 0) / elapsed, 2) if elapsed else None,
+        'last_error': job['last_error'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at']
+    }
+
+
+def list_jobs(limit=20):
+    rows = _conn().execute('SELECT id FROM delete_jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+    return [get_job(row['id']) for row in rows]
+
+
+def failed_items(job_id, limit=100):
+    rows = _conn().execute(
+        "SELECT customer_id, error FROM delete_job_items WHERE job_id = ? AND status = 'failed' LIMIT ?",
+        (job_id, limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+# -- runner ----------------------------------------------------------------
+
+def _claim():
+    """Lease the oldest runnable job whose lease has expired, or return None."""
+    now = time.time()
+    conn = _conn()
+    with conn:
+        row = conn.execute(
+            "SELECT id FROM delete_jobs WHERE status IN ('pending', 'running') AND lease_until < ? "
+            "ORDER BY created_at LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row is None:
+            return None
+        claimed = conn.execute(
+            "UPDATE delete_jobs SET status = 'running', lease_until = ?, started_at = COALESCE(started_at, ?) "
+            "WHERE id = ? AND status IN ('pending', 'running') AND lease_until < ?",
+            (now + LEASE_SECONDS, now, row['id'], now)
+        ).rowcount
+    return row['id'] if claimed else None
+
+
+def _renew(job_id):
+    """Extend the lease; stops the run if the job was cancelled or taken over."""
+    conn = _conn()
+    with conn:
+        job = conn.execute('SELECT status, lease_until FROM delete_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job['status'] == 'cancelled':
+            raise JobCancelled(job_id)
+        if job['lease_until'] < time.time():
+            raise LeaseLost(job_id)
+        conn.execute('UPDATE delete_jobs SET lease_until = ? WHERE id = ?', (time.time() + LEASE_SECONDS, job_id))
+
+
+def _set(job_id, **fields):
+    conn = _conn()
+    with conn:
+        conn.execute(
+            f"UPDATE delete_jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+            (*fields.values(), job_id)
+        )
+
+
+def _with_backoff(fn, *args, **kwargs):
+    """Call a Stripe API, backing off with jitter when rate limited."""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return fn(*args, **kwargs)
+        except (stripe.error.RateLimitError, stripe.error.APIConnectionError):
+            if attempt == MAX_ATTEMPTS:
+                raise
+            time.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+
+
+def _collect(job_id, cursor):
+    conn = _conn()
+    while True:
+        _renew(job_id)
+        params = {'limit': PAGE_SIZE}
+        if cursor:
+            params['starting_after'] = cursor
+        page = _with_backoff(stripe.Customer.list, **params)
+        if not page.data:
+            break
+        cursor = page.data[-1].id
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO delete_job_items (job_id, customer_id, email) VALUES (?, ?, ?)',
+                [(job_id, customer.id, customer.email) for customer in page.data]
+            )
+            collected = conn.execute(
+                'SELECT COUNT(*) FROM delete_job_items WHERE job_id = ?', (job_id,)
+            ).fetchone()[0]
+            conn.execute('UPDATE delete_jobs SET cursor = ?, collected = ? WHERE id = ?', (cursor, collected, job_id))
+        if not page.has_more:
+            break
+    _set(job_id, phase='delete')
+
+
+def _delete_one(job_id, customer_id):
+    try:
+        _with_backoff(stripe.Customer.delete, customer_id)
+        status, error = 'deleted', None
+    except stripe.error.InvalidRequestError as e:
+        # Already gone, e.g. deleted by a previous run that died before saving
+        if getattr(e, 'code', None) == 'resource_missing':
+            status, error = 'deleted', None
+        else:
+            status, error = 'failed', str(e)
+    except Exception as e:
+        status, error = 'failed', str(e)
+    if status == 'deleted':
+        read_model.mark_deleted(customer_id)
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'UPDATE delete_job_items SET status = ?, error = ? WHERE job_id = ? AND customer_id = ?',
+            (status, error, job_id, customer_id)
+        )
+
+
+def _delete(job_id, concurrency):
+    pending = [
+        row['customer_id'] for row in _conn().execute(
+            "SELECT customer_id FROM delete_job_items WHERE job_id = ? AND status = 'pending'", (job_id,)
+        )
+    ]
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='delete-job') as pool:
+        # Submit in windows so the lease is renewed (and a cancel noticed) as work finishes
+        for start in range(0, len(pending), concurrency * 10):
+            _renew(job_id)
+            window = pending[start:start + concurrency * 10]
+            list(pool.map(stripe_scheduler.bind(lambda customer_id: _delete_one(job_id, customer_id)), window))
+    _set(job_id, phase='sheet')
+
+
+def _delete_sheet_rows(job_id):
+    emails = [
+        row['email'] for row in _conn().execute(
+            "SELECT email FROM delete_job_items WHERE job_id = ? AND status = 'deleted' AND email IS NOT NULL",
+            (job_id,)
+        )
+    ]
+    deleted = 0
+    if emails and not _state['sheets']:
+        logger.info("Delete job %s: Google Sheets not configured, skipping sheet rows", job_id)
+    elif emails:
+        service = get_sheets_service()
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            _renew(job_id)
+            try:
+                deleted = sheet_format.delete_customer_rows(service, emails)
+                break
+            except sheet_format.FormatInProgress:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+                time.sleep(sheet_format.LEASE_SECONDS / MAX_ATTEMPTS)
+    _set(job_id, phase='done', status='done', sheet_rows_deleted=deleted, finished_at=time.time(), lease_until=0)
+
+
+def _run(job_id):
+    job = _conn().execute('SELECT * FROM delete_jobs WHERE id = ?', (job_id,)).fetchone()
+    logger.info("Running delete job %s from phase %s", job_id, job['phase'])
+    try:
+        if job['phase'] == 'collect':
+            _collect(job_id, job['cursor'])
+        if job['phase'] in ('collect', 'delete'):
+            _delete(job_id, job['concurrency'])
+        _delete_sheet_rows(job_id)
+        logger.info("Delete job %s finished", job_id, extra={'job': get_job(job_id)})
+    except JobCancelled:
+        logger.info("Delete job %s cancelled", job_id)
+    except LeaseLost:
+        logger.warning("Delete job %s lease lost to another worker", job_id)
+    except Exception as e:
+        attempts = job['attempts'] + 1
+        if attempts >= JOB_MAX_ATTEMPTS:
+            logger.error("Delete job %s failed after %s attempts: %s", job_id, attempts, e)
+            _set(job_id, status='failed', attempts=attempts, last_error=str(e), finished_at=time.time(), lease_until=0)
+        else:
+            # Leave the job running; it is retried once the lease expires
+            logger.error("Delete job %s failed (attempt %s): %s", job_id, attempts, e)
+            _set(job_id, attempts=attempts, last_error=str(e))
+
+
+def _loop():
+    # Bulk deletes only use Stripe capacity that checkouts leave free
+    with stripe_scheduler.priority(stripe_scheduler.BATCH):
+        while True:
+            try:
+                job_id = _claim()
+                if job_id is not None:
+                    _run(job_id)
+                    continue
+            except Exception as e:
+                logger.error("Delete job runner error: %s", e)
+            _wake.wait(POLL_INTERVAL)
+            _wake.clear()
+
+
+def start(sheets=None):
+    """
+    Start this process's job runner (once per pid); resumes unfinished jobs.
+    sheets=False (no Google credentials) makes jobs skip the sheet phase.
+    """
+    if sheets is not None:
+        _state['sheets'] = sheets
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        _state['pid'] = os.getpid()
+        threading.Thread(target=_loop, name='delete-job', daemon=True).start()
@@ -0,0 +1,29 @@
+"""
+gunicorn settings. Loaded automatically from the working directory.
+
+Sets up prometheus_client's multiprocess mode: every worker writes metrics
+to files in PROMETHEUS_MULTIPROC_DIR and /metrics sums them. The directory
+must be set before any worker imports prometheus_client, is emptied when
+the master starts, and a dead worker's live gauges are removed on exit.
+"""
+import os
+import shutil
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/lawn-peak-metrics')
+
+
+def on_starting(server):
+    # Files left by a previous run would be counted as if those workers were alive
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,127 @@
+"""
+Liveness and readiness.
+
+/health answers from a constant and touches nothing, so keep-alive pings and
+platform health checks cost next to nothing. /ready serves the last snapshot
+taken by a background thread in each process: Stripe and Sheets reachability
+(one cheap authenticated read each), queue depths and whether the caches are
+warm. Probes run every READY_REFRESH_INTERVAL seconds whatever the request
+rate, so polling /ready never adds upstream calls.
+
+The process is ready when every configured upstream answered its last probe
+and the snapshot is fresh; a snapshot older than three intervals means the
+refresher has stopped and is reported as not ready.
+"""
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+READY_REFRESH_INTERVAL = float(os.getenv('READY_REFRESH_INTERVAL', 30))
+READY_MAX_AGE = READY_REFRESH_INTERVAL * 3
+HEALTH_BODY = b'{"status":"ok"}\n'
+
+_state = {'pid': None, 'snapshot': None}
+_lock = threading.Lock()
+
+
+def _probe_stripe():
+    import stripe
+    import stripe_scheduler
+    if not stripe.api_key:
+        return False
+    with stripe_scheduler.priority(stripe_scheduler.BATCH):
+        stripe.Account.retrieve()
+    return True
+
+
+def _probe_sheets():
+    from sheets_client import configured, get_sheets_service, spreadsheet_id
+    if not configured():
+        return False
+    get_sheets_service().spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id(),
+        range='A1:A1'
+    ).execute()
+    return True
+
+
+def _probe(fn):
+    start = time.perf_counter()
+    try:
+        if not fn():
+            return {'configured': False, 'ok': True}
+        result = {'configured': True, 'ok': True}
+    except Exception as e:
+        result = {'configured': True, 'ok': False, 'error': str(e)[:200]}
+    result['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def collect():
+    """Probe the upstreams and read queue and cache state into a snapshot."""
+    from lot_size import lot_size_cache
+    from sheet_index import row_index
+    from sheet_queue import sheet_queue
+    import read_model
+    import startup
+    import webhook_queue
+
+    upstream = {'stripe': _probe(_probe_stripe), 'sheets': _probe(_probe_sheets)}
+    lot_size_stats = lot_size_cache.stats()
+    read_model_stats = read_model.stats()
+    return {
+        'checked_at': time.time(),
+        'upstream_ok': all(probe['ok'] for probe in upstream.values()),
+        'upstream': upstream,
+        'queues': {
+            'sheet_queue': sheet_queue.depth(),
+            'webhook_queue': webhook_queue.depth()
+        },
+        'caches': {
+            'sheet_row_index': {'built': row_index.built, 'entries': len(row_index)},
+            'lot_size': {'entries': lot_size_stats['memory_entries'], 'hit_rate': lot_size_stats['hit_rate']},
+            'read_model': {
+                'customers': read_model_stats['customers'],
+                'synced': read_model_stats['full_sync'] is not None
+            },
+            'warmup': startup.stats()['warmup']
+        }
+    }
+
+
+def refresh():
+    try:
+        _state['snapshot'] = collect()
+    except Exception as e:
+        logger.warning("Readiness refresh failed: %s", e)
+
+
+def _refresh_loop():
+    while True:
+        refresh()
+        time.sleep(READY_REFRESH_INTERVAL)
+
+
+def start():
+    """Start this process's readiness refresher (once per pid)."""
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        _state['pid'] = os.getpid()
+        _state['snapshot'] = None
+        threading.Thread(target=_refresh_loop, name='readiness', daemon=True).start()
+
+
+def readiness():
+    """Return (body, ready) from the last snapshot, without probing anything."""
+    snapshot = _state['snapshot']
+    if snapshot is None:
+        return {'ready': False, 'status': 'starting'}, False
+    age = time.time() - snapshot['checked_at']
+    ready = snapshot['upstream_ok'] and age <= READY_MAX_AGE
+    return {**snapshot, 'ready': ready, 'age_s': round(age, 1)}, ready
@@ -0,0 +1,249 @@
+"""
+Local ledger of charge attempts, in payments.db.
+
+One row per attempt, keyed by its Stripe idempotency key. The row is written
+as 'pending' before the PaymentIntent is created, then updated with the
+PaymentIntent id and status when Stripe answers, and again by
+payment_intent.* webhooks. Retrying with the same key updates the same row,
+so the ledger never counts a replay twice.
+
+Questions like who was charged this week, revenue over a period, or whether
+a customer was just charged the same amount are answered by indexed queries
+here instead of scans of Stripe.
+"""
+import os
+import time
+import datetime
+import logging
+
+from db import get_connection, ensure_schema
+
+logger = logging.getLogger(__name__)
+
+# A second charge of the same amount to the same customer within this many
+# seconds, under a different idempotency key, is refused. 0 disables the check.
+DUPLICATE_WINDOW = int(os.getenv('CHARGE_DUPLICATE_WINDOW', 600))
+
+EVENT_TYPES = [
+    'payment_intent.succeeded',
+    'payment_intent.payment_failed',
+    'payment_intent.processing',
+    'payment_intent.requires_action',
+    'payment_intent.canceled'
+]
+
+# Attempts that may have taken (or may still take) the customer's money
+LIVE_STATUSES = ('pending', 'processing', 'requires_action', 'succeeded')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS charges (
+    idempotency_key TEXT PRIMARY KEY,
+    customer_id TEXT NOT NULL,
+    email TEXT,
+    amount_cents INTEGER NOT NULL,
+    currency TEXT NOT NULL DEFAULT 'usd',
+    batch_id TEXT,
+    payment_intent_id TEXT UNIQUE,
+    status TEXT NOT NULL,
+    error TEXT,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL,
+    status_at INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_charges_customer ON charges (customer_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_charges_created ON charges (created_at);
+"""
+
+_COLUMNS = (
+    'idempotency_key, customer_id, email, amount_cents, currency, batch_id, '
+    'payment_intent_id, status, error, created_at, updated_at'
+)
+
+
+class DuplicateChargeError(Exception):
+    def __init__(self, existing):
+        self.existing = existing
+        super().__init__(
+            f"Customer {existing['customer_id']} was already charged {existing['amount_cents'] / 100:.2f} at "
+            f"{datetime.datetime.fromtimestamp(existing['created_at']).strftime('%Y-%m-%d %H:%M')} "
+            f"({existing['status']})"
+        )
+
+
+def _conn():
+    ensure_schema('ledger', SCHEMA)
+    return get_connection()
+
+
+def _now():
+    return int(time.time())
+
+
+def _row(row):
+    return dict(row) if row is not None else None
+
+
+# -- writes ----------------------------------------------------------------
+
+def begin(key, customer_id, amount_cents, email=None, batch_id=None, duplicate_window=DUPLICATE_WINDOW):
+    """
+    Record an attempt before it is sent to Stripe. Raises DuplicateChargeError
+    if a live charge of the same amount to the same customer was recorded
+    under another key within duplicate_window seconds. Returns False if this
+    key was already recorded, i.e. the call is a retry.
+    """
+    now = _now()
+    conn = _conn()
+    with conn:
+        # Check and insert in one write transaction so two concurrent
+        # attempts can't both pass the check
+        conn.execute('BEGIN IMMEDIATE')
+        if duplicate_window:
+            existing = conn.execute(
+                f'SELECT {_COLUMNS} FROM charges WHERE customer_id = ? AND created_at >= ? '
+                f'AND amount_cents = ? AND idempotency_key != ? '
+                f'AND status IN ({", ".join("?" * len(LIVE_STATUSES))}) '
+                'ORDER BY created_at DESC LIMIT 1',
+                (customer_id, now - duplicate_window, amount_cents, key, *LIVE_STATUSES)
+            ).fetchone()
+            if existing is not None:
+                raise DuplicateChargeError(_row(existing))
+        cursor = conn.execute(
+            'INSERT INTO charges (idempotency_key, customer_id, email, amount_cents, batch_id, status, '
+            'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(idempotency_key) DO NOTHING',
+            (key, customer_id, email, amount_cents, batch_id, 'pending', now, now)
+        )
+    return cursor.rowcount == 1
+
+
+def record_result(key, payment_intent):
+    """Store the PaymentIntent Stripe returned for an attempt."""
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'UPDATE charges SET payment_intent_id = ?, status = ?, error = NULL, updated_at = ?, '
+            'status_at = MAX(status_at, ?) WHERE idempotency_key = ?',
+            (payment_intent.id, payment_intent.status, _now(), payment_intent.created, key)
+        )
+
+
+def record_failure(key, error, payment_intent_id=None):
+    """
+    Mark an attempt failed, e.g. declined or rejected by Stripe. An attempt
+    already recorded as succeeded or processing is left alone.
+    """
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'UPDATE charges SET status = ?, error = ?, payment_intent_id = COALESCE(?, payment_intent_id), '
+            "updated_at = ? WHERE idempotency_key = ? AND status NOT IN ('succeeded', 'processing')",
+            ('failed', str(error)[:500], payment_intent_id, _now(), key)
+        )
+
+
+def apply_event(event):
+    """Update an attempt's status from a payment_intent.* webhook."""
+    payment_intent = event['data']['object']
+    status = 'failed' if event['type'] == 'payment_intent.payment_failed' else payment_intent.get('status')
+    error = (payment_intent.get('last_payment_error') or {}).get('message')
+    created = event.get('created') or _now()
+    conn = _conn()
+    with conn:
+        # Events can arrive out of order; an older one never overwrites a newer status
+        cursor = conn.execute(
+            'UPDATE charges SET status = ?, error = COALESCE(?, error), updated_at = ?, status_at = ? '
+            'WHERE payment_intent_id = ? AND status_at <= ?',
+            (status, error, _now(), created, payment_intent['id'], created)
+        )
+        if cursor.rowcount == 0 and payment_intent.get('customer'):
+            # The process may have died before Stripe's answer was recorded
+            conn.execute(
+                'UPDATE charges SET payment_intent_id = ?, status = ?, error = ?, updated_at = ?, status_at = ? '
+                'WHERE idempotency_key = (SELECT idempotency_key FROM charges WHERE payment_intent_id IS NULL '
+                'AND status = ? AND customer_id = ? AND amount_cents = ? ORDER BY created_at DESC LIMIT 1)',
+                (payment_intent['id'], status, error, _now(), created,
+                 'pending', payment_intent['customer'], payment_intent.get('amount'))
+            )
+
+
+# -- reads -----------------------------------------------------------------
+
+def start_of_week(now=None):
+    """Unix time of the most recent local Monday 00:00."""
+    today = datetime.date.fromtimestamp(now or time.time())
+    monday = today - datetime.timedelta(days=today.weekday())
+    return int(time.mktime(monday.timetuple()))
+
+
+def parse_time(value, default=None):
+    """Accept unix seconds or a YYYY-MM-DD date (local midnight)."""
+    if value in (None, ''):
+        return default
+    if str(value).isdigit():
+        return int(value)
+    return int(time.mktime(datetime.datetime.strptime(value, '%Y-%m-%d').timetuple()))
+
+
+def get_charge(key):
+    """The attempt recorded under an idempotency key, or None."""
+    return _row(_conn().execute(f'SELECT {_COLUMNS} FROM charges WHERE idempotency_key = ?', (key,)).fetchone())
+
+
+def list_charges(since=None, until=None, customer_id=None, status=None, limit=500):
+    """Charge attempts, newest first."""
+    clauses, params = [], []
+    if customer_id:
+        clauses.append('customer_id = ?')
+        params.append(customer_id)
+    if since is not None:
+        clauses.append('created_at >= ?')
+        params.append(since)
+    if until is not None:
+        clauses.append('created_at < ?')
+        params.append(until)
+    if status:
+        clauses.append('status = ?')
+        params.append(status)
+    where = f"WHERE {' AND '.join(clauses)} " if clauses else ''
+    rows = _conn().execute(
+        f'SELECT {_COLUMNS} FROM charges {where}ORDER BY created_at DESC LIMIT ?',
+        (*params, limit)
+    ).fetchall()
+    return [_row(row) for row in rows]
+
+
+def charged_customers(since, until=None):
+    """Customers with a succeeded charge in the period, with their totals."""
+    rows = _conn().execute(
+        'SELECT customer_id, MAX(email) AS email, COUNT(*) AS charges, SUM(amount_cents) AS amount_cents, '
+        'MAX(created_at) AS last_charged_at FROM charges '
+        'WHERE created_at >= ? AND created_at < ? AND status = ? '
+        'GROUP BY customer_id ORDER BY last_charged_at DESC',
+        (since, until if until is not None else _now() + 1, 'succeeded')
+    ).fetchall()
+    return [_row(row) for row in rows]
+
+
+def revenue(since, until=None):
+    """Succeeded charge totals for the period, overall and per local day."""
+    until = until if until is not None else _now() + 1
+    conn = _conn()
+    days = conn.execute(
+        "SELECT date(created_at, 'unixepoch', 'localtime') AS day, COUNT(*) AS charges, "
+        'SUM(amount_cents) AS amount_cents FROM charges '
+        'WHERE created_at >= ? AND created_at < ? AND status = ? GROUP BY day ORDER BY day',
+        (since, until, 'succeeded')
+    ).fetchall()
+    by_status = dict(conn.execute(
+        'SELECT status, COUNT(*) FROM charges WHERE created_at >= ? AND created_at < ? GROUP BY status',
+        (since, until)
+    ).fetchall())
+    return {
+        'since': since,
+        'until': until,
+        'charges': sum(day['charges'] for day in days),
+        'amount_cents': sum(day['amount_cents'] for day in days),
+        'by_day': [_row(day) for day in days],
+        'attempts_by_status': by_status
+    }
@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from db import get_connection, ensure_schema
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = int(os.getenv('LOT_SIZE_CACHE_TTL', 30 * 24 * 3600))
+# Addresses the resolver found nothing for are remembered this long
+NEGATIVE_TTL = int(os.getenv('LOT_SIZE_NEGATIVE_TTL', 24 * 3600))
+# Tier quoted when an address can't be resolved
+DEFAULT_LOT_SIZE = 'MEDIUM'
+# Stored in place of a tier for a negative result
+_NOT_FOUND = ''
+MEMORY_CACHE_SIZE = int(os.getenv('LOT_SIZE_MEMORY_CACHE_SIZE', 10000))
+# How long a caller waits on another thread's in-flight lookup
+RESOLVE_TIMEOUT = float(os.getenv('LOT_SIZE_RESOLVE_TIMEOUT', 15))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lot_size_cache (
+    address_key TEXT PRIMARY KEY,
+    lot_size TEXT NOT NULL,
+    resolver TEXT NOT NULL,
+    resolved_at REAL NOT NULL
+);
+"""
+
+_ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'road': 'rd', 'drive': 'dr', 'boulevard': 'blvd',
+    'lane': 'ln', 'court': 'ct', 'place': 'pl', 'terrace': 'ter', 'circle': 'cir',
+    'highway': 'hwy', 'parkway': 'pkwy', 'square': 'sq', 'trail': 'trl',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+    'apartment': 'apt', 'suite': 'ste'
+}
+_COUNTRY_SUFFIX = re.compile(r'\s*(usa|us|united states|united states of america)$')
+
+
+def normalize_address(address):
+    """Canonical cache key for an address: lowercased, unpunctuated, abbreviated."""
+    key = (address or '').lower()
+    key = re.sub(r'[.,#]', ' ', key)
+    key = re.sub(r'\s+', ' ', key).strip()
+    key = _COUNTRY_SUFFIX.sub('', key)
+    return ' '.join(_ABBREVIATIONS.get(word, word) for word in key.split())
+
+
+def default_resolver(address):
+    # For now, return a default category
+    # In production, this would use Google Maps API to get actual lot size
+    return DEFAULT_LOT_SIZE
+
+
+class StaticResolver:
+    """Local stand-in for the real resolver, for tests and benchmarks."""
+
+    def __init__(self, lot_sizes=None, default='MEDIUM', delay=0.0):
+        self.lot_sizes = {normalize_address(a): s for a, s in (lot_sizes or {}).items()}
+        self.default = default
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, address):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return self.lot_sizes.get(normalize_address(address), self.default)
+
+
+class LotSizeCache:
+    """
+    Address -> lot size tier, resolved through an in-memory LRU with TTL, then
+    a persistent SQLite cache, then the (slow) resolver. Concurrent lookups of
+    the same address share one resolver call. When the resolver finds
+    nothing, that is cached for NEGATIVE_TTL and lookup() returns None.
+    """
+
+    def __init__(self, resolver=default_resolver, resolver_name='default'):
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._inflight = {}
+        self._latencies = deque(maxlen=1000)
+        self.resolver = resolver
+        self.resolver_name = resolver_name
+        self.counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0, 'not_found': 0, 'errors': 0}
+
+    def set_resolver(self, resolver, name):
+        """
+        Swap the resolver. Cached entries are tagged with the resolver name,
+        so answers from a previous resolver are not served after a swap.
+        """
+        with self._lock:
+            self.resolver = resolver
+            self.resolver_name = name
+            self._memory.clear()
+
+    # -- tiers -------------------------------------------------------------
+
+    def _memory_get(self, key, now):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            lot_size, expires_at = entry
+            if expires_at <= now:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return lot_size
+
+    def _memory_put(self, key, lot_size, expires_at):
+        with self._lock:
+            self._memory[key] = (lot_size, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > MEMORY_CACHE_SIZE:
+                self._memory.popitem(last=False)
+
+    def _disk_get(self, key, now):
+        ensure_schema('lot_size', SCHEMA)
+        row = get_connection().execute(
+            'SELECT lot_size, resolved_at FROM lot_size_cache WHERE address_key = ? AND resolver = ?',
+            (key, self.resolver_name)
+        ).fetchone()
+        if row is None:
+            return None
+        expires_at = row['resolved_at'] + (CACHE_TTL if row['lot_size'] != _NOT_FOUND else NEGATIVE_TTL)
+        if expires_at <= now:
+            return None
+        return row['lot_size'], expires_at
+
+    def _disk_put(self, key, lot_size, now):
+        ensure_schema('lot_size', SCHEMA)
+        conn = get_connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO lot_size_cache (address_key, lot_size, resolver, resolved_at) '
+                'VALUES (?, ?, ?, ?)',
+                (key, lot_size, self.resolver_name, now)
+            )
+
+    # -- lookup ------------------------------------------------------------
+
+    def lookup(self, address):
+        start = time.perf_counter()
+        try:
+            return self._lookup(address)
+        finally:
+            self._latencies.append(time.perf_counter() - start)
+
+    def _lookup(self, address):
+        key = normalize_address(address)
+        if not key:
+            return None
+        now = time.time()
+
+        lot_size = self._memory_get(key, now)
+        if lot_size is not None:
+            self.counts['memory_hits'] += 1
+            return lot_size or None
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.counts['coalesced'] += 1
+        if not owner:
+            return future.result(timeout=RESOLVE_TIMEOUT)
+
+        try:
+            cached = self._disk_get(key, now)
+            if cached is not None:
+                self.counts['disk_hits'] += 1
+                lot_size, expires_at = cached
+            else:
+                self.counts['misses'] += 1
+                lot_size = self.resolver(address)
+                if lot_size is None:
+                    self.counts['not_found'] += 1
+                    lot_size = _NOT_FOUND
+                expires_at = now + (CACHE_TTL if lot_size != _NOT_FOUND else NEGATIVE_TTL)
+                self._disk_put(key, lot_size, now)
+            self._memory_put(key, lot_size, expires_at)
+            future.set_result(lot_size or None)
+            return lot_size or None
+        except Exception as e:
+            self.counts['errors'] += 1
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        lookups = self.counts['memory_hits'] + self.counts['disk_hits'] + self.counts['misses'] + self.counts['coalesced']
+        hits = lookups - self.counts['misses']
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+
+        return {
+            **self.counts,
+            'lookups': lookups,
+            'hit_rate': round(hits / lookups, 3) if lookups else None,
+            'memory_entries': len(self._memory),
+            'resolver': self.resolver_name,
+            'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99)}
+        }
+
+
+lot_size_cache = LotSizeCache()
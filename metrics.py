@@ -0,0 +1,214 @@
+"""
+Prometheus metrics, served at /metrics.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py does) so every
+worker writes its samples to shared mmap files and a scrape of any worker
+returns the sum over all of them. Without it, metrics cover this process.
+
+Recording is a dict lookup and an mmap write, so it stays on in production.
+Cache and queue sizes are sampled into gauges by a background thread in
+each process rather than computed on the request path.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from urllib.parse import urlsplit
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess
+)
+
+logger = logging.getLogger(__name__)
+
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+REFRESH_INTERVAL = float(os.getenv('METRICS_REFRESH_INTERVAL', 15))
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Request latency by route, method and status',
+    ['route', 'method', 'status'], buckets=BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being handled', multiprocess_mode='livesum')
+
+UPSTREAM_DURATION = Histogram(
+    'upstream_request_duration_seconds', 'Outbound call latency by service, resource and method',
+    ['service', 'resource', 'method'], buckets=BUCKETS
+)
+UPSTREAM_ERRORS = Counter(
+    'upstream_errors_total', 'Failed outbound calls; kind is the status class or connection',
+    ['service', 'resource', 'method', 'kind']
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    'upstream_requests_in_flight', 'Outbound calls waiting on a response', ['service'], multiprocess_mode='livesum'
+)
+
+SHEET_QUEUE_DEPTH = Gauge('sheet_queue_depth', 'Rows waiting to be appended', multiprocess_mode='livesum')
+SHEET_WRITES_PENDING = Gauge('sheet_writes_pending_cells', 'Cell updates waiting to be flushed',
+                             multiprocess_mode='livesum')
+SHEET_WRITE_FLUSH_CELLS = Histogram('sheet_write_flush_cells', 'Cells sent per coalesced values.batchUpdate',
+                                    buckets=(1, 2, 5, 10, 25, 50, 100, 200, 500))
+WEBHOOK_QUEUE_DEPTH = Gauge('webhook_queue_depth', 'Webhook events waiting for a worker', multiprocess_mode='livesum')
+LOT_SIZE_CACHE_ENTRIES = Gauge('lot_size_cache_entries', 'Lot sizes in memory', multiprocess_mode='livesum')
+LOT_SIZE_CACHE_HIT_RATIO = Gauge('lot_size_cache_hit_ratio', 'Share of lookups answered from cache',
+                                 multiprocess_mode='liveall')
+SHEET_ROW_INDEX_ENTRIES = Gauge('sheet_row_index_entries', 'Emails in the sheet row index', multiprocess_mode='livemax')
+STRIPE_POOL_CONNECTIONS = Gauge('stripe_pool_connections_opened', 'Connections opened by the Stripe pool',
+                                multiprocess_mode='livesum')
+STRIPE_RATE_TOKENS = Gauge('stripe_rate_tokens', 'Tokens left in each Stripe rate bucket', ['bucket'],
+                           multiprocess_mode='liveall')
+STRIPE_RATE_WAITING = Gauge('stripe_rate_waiting', 'Calls waiting for a Stripe rate token', ['bucket', 'priority'],
+                            multiprocess_mode='livesum')
+
+_STRIPE_ID = re.compile(r'[a-z_]+$')
+_SHEETS_ACTION = re.compile(r':(append|clear|batchGet|batchUpdate|batchClear)$')
+_state = {'pid': None}
+_lock = threading.Lock()
+
+
+def stripe_resource(url):
+    """'/v1/customers/cus_123' -> 'customers'; '/v1/payment_intents/pi_1/confirm' -> 'payment_intents.confirm'."""
+    path = urlsplit(url).path
+    parts = [part for part in path.split('/')[2:] if part and _STRIPE_ID.match(part)]
+    return '.'.join(parts) or 'unknown'
+
+
+def sheets_method(url, method):
+    """Name a Sheets API call after its method, e.g. 'values.append' or 'batchUpdate'."""
+    path = urlsplit(url).path
+    match = _SHEETS_ACTION.search(path)
+    action = match.group(1) if match else {'GET': 'get', 'PUT': 'update'}.get(method.upper(), method.lower())
+    return f'values.{action}' if '/values' in path else action
+
+
+def _error_kind(status):
+    if status is None:
+        return 'connection'
+    if status == 429:
+        return '429'
+    if status >= 500:
+        return '5xx'
+    if status >= 400:
+        return '4xx'
+    return None
+
+
+def observe_upstream(service, resource, method, seconds, status):
+    """Record one outbound call; status is None when no response came back."""
+    method = method.upper()
+    UPSTREAM_DURATION.labels(service, resource, method).observe(seconds)
+    kind = _error_kind(status)
+    if kind is not None:
+        UPSTREAM_ERRORS.labels(service, resource, method, kind).inc()
+
+
+class upstream_call:
+    """Context manager timing an outbound call: `with upstream_call(...) as call: call.status = ...`."""
+
+    def __init__(self, service, resource, method):
+        self.service = service
+        self.resource = resource
+        self.method = method
+        self.status = None
+
+    def __enter__(self):
+        UPSTREAM_IN_FLIGHT.labels(self.service).inc()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        UPSTREAM_IN_FLIGHT.labels(self.service).dec()
+        observe_upstream(self.service, self.resource, self.method, time.perf_counter() - self.start, self.status)
+
+
+# -- flask -----------------------------------------------------------------
+
+def init_app(app):
+    """Time every request by its URL rule, so ids in paths don't become labels."""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def _observe(response):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            REQUESTS_IN_FLIGHT.dec()
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            REQUEST_DURATION.labels(route, request.method, str(response.status_code)).observe(
+                time.perf_counter() - start
+            )
+        return response
+
+    @app.teardown_request
+    def _teardown(error):
+        # after_request is skipped when a response couldn't be built
+        if g.pop('_metrics_start', None) is not None:
+            REQUESTS_IN_FLIGHT.dec()
+
+
+# -- gauges ----------------------------------------------------------------
+
+def refresh():
+    """Sample this process's cache and queue sizes into the gauges."""
+    from lot_size import lot_size_cache
+    from sheet_index import row_index
+    from sheet_queue import sheet_queue
+    from sheet_writes import sheet_writes
+    import stripe_http
+    import stripe_scheduler
+    import webhook_queue
+
+    SHEET_QUEUE_DEPTH.set(sheet_queue.depth())
+    SHEET_WRITES_PENDING.set(sheet_writes.pending())
+    WEBHOOK_QUEUE_DEPTH.set(webhook_queue.depth())
+    SHEET_ROW_INDEX_ENTRIES.set(len(row_index))
+    lot_size_stats = lot_size_cache.stats()
+    LOT_SIZE_CACHE_ENTRIES.set(lot_size_stats['memory_entries'])
+    LOT_SIZE_CACHE_HIT_RATIO.set(lot_size_stats['hit_rate'] or 0)
+    client = stripe_http.client()
+    if client is not None:
+        STRIPE_POOL_CONNECTIONS.set(client.stats()['connections_opened'])
+    for name, bucket in stripe_scheduler.scheduler.buckets.items():
+        stats = bucket.stats()
+        STRIPE_RATE_TOKENS.labels(name).set(stats['tokens'])
+        for priority, waiting in stats['waiting'].items():
+            STRIPE_RATE_WAITING.labels(name, priority).set(waiting)
+
+
+def _refresh_loop():
+    while True:
+        try:
+            refresh()
+        except Exception as e:
+            logger.warning("Metrics refresh failed: %s", e)
+        time.sleep(REFRESH_INTERVAL)
+
+
+def start():
+    """Start this process's gauge sampler (once per pid)."""
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        _state['pid'] = os.getpid()
+        threading.Thread(target=_refresh_loop, name='metrics', daemon=True).start()
+
+
+def render():
+    """Return (body, content_type) for a scrape."""
+    try:
+        refresh()
+    except Exception as e:
+        logger.warning("Metrics refresh failed: %s", e)
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,332 @@
+"""
+Offline parcel lookup for lot sizes.
+
+A parcel dataset (GeoJSON FeatureCollection, or CSV with a WKT geometry
+column) is compiled once into flat NumPy arrays: ring vertices, per-parcel
+areas and bounding boxes, and a uniform grid index over the bounding boxes.
+Workers memory-map those arrays, so startup costs no parsing and the pages
+are shared between processes.
+
+    python parcels.py build parcels.geojson data/parcels
+"""
+import os
+import re
+import csv
+import sys
+import json
+import logging
+import argparse
+
+import numpy as np
+
+from pricing import lot_size_tier
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6378137.0
+SQ_FT_PER_SQ_M = 10.763910416709722
+DEFAULT_CELL_DEGREES = 0.005  # roughly 500 m
+ARRAYS = ('vertices', 'ring_offsets', 'ring_parcel', 'areas', 'bboxes', 'grid_keys', 'grid_offsets', 'grid_items')
+# Grid keys pack (column, row) into one int64
+_GRID_STRIDE = 1 << 32
+
+
+# -- loading ---------------------------------------------------------------
+
+def _parse_wkt(wkt):
+    """Polygons from a POLYGON or MULTIPOLYGON WKT string, as lists of rings."""
+    wkt = wkt.strip()
+    kind = wkt.split('(', 1)[0].strip().upper()
+    if kind not in ('POLYGON', 'MULTIPOLYGON'):
+        raise ValueError(f'Unsupported geometry: {kind}')
+    polygons = []
+    for polygon in re.findall(r'\(\s*(\([^()]*\)(?:\s*,\s*\([^()]*\))*)\s*\)', wkt):
+        rings = []
+        for ring in re.findall(r'\(([^()]*)\)', polygon):
+            rings.append([[float(v) for v in point.split()[:2]] for point in ring.split(',')])
+        polygons.append(rings)
+    return polygons
+
+
+def _geojson_polygons(geometry):
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    return []
+
+
+def read_parcels(path):
+    """Yield (parcel_id, polygons) from a GeoJSON or CSV parcel file."""
+    if path.lower().endswith('.csv'):
+        with open(path, newline='') as f:
+            for i, row in enumerate(csv.DictReader(f)):
+                geometry = row.get('wkt') or row.get('geometry') or ''
+                yield row.get('parcel_id') or str(i), _parse_wkt(geometry)
+    else:
+        with open(path) as f:
+            collection = json.load(f)
+        for i, feature in enumerate(collection.get('features', [])):
+            properties = feature.get('properties') or {}
+            parcel_id = feature.get('id') or properties.get('parcel_id') or str(i)
+            yield str(parcel_id), _geojson_polygons(feature.get('geometry'))
+
+
+# -- area ------------------------------------------------------------------
+
+def ring_areas(vertices, ring_offsets):
+    """
+    Geodesic area in m^2 of every ring, on a spherical earth, computed for
+    all rings at once:
+
+        A = R^2 / 2 * |sum((lon2 - lon1) * (2 + sin(lat1) + sin(lat2)))|
+
+    which is the shoelace formula applied after an equal-area projection.
+    """
+    lon = np.radians(vertices[:, 0])
+    lat = np.radians(vertices[:, 1])
+    starts = ring_offsets[:-1]
+    ends = ring_offsets[1:]
+    # Index of each vertex's successor, wrapping to the ring start
+    following = np.arange(1, len(lon) + 1)
+    following[ends - 1] = starts
+    terms = (lon[following] - lon) * (2 + np.sin(lat) + np.sin(lat[following]))
+    sums = np.add.reduceat(terms, starts) if len(starts) else np.zeros(0)
+    return np.abs(sums) * EARTH_RADIUS_M ** 2 / 2
+
+
+# -- build -----------------------------------------------------------------
+
+def build(source_path, prefix, cell_degrees=DEFAULT_CELL_DEGREES):
+    """Compile a parcel file into the memory-mappable arrays at <prefix>.*.npy."""
+    ids = []
+    vertices = []
+    ring_offsets = [0]
+    ring_parcel = []
+    ring_signs = []
+    for parcel_id, polygons in read_parcels(source_path):
+        parcel = len(ids)
+        ids.append(parcel_id)
+        for polygon in polygons:
+            for r, ring in enumerate(polygon):
+                if len(ring) > 1 and ring[0] == ring[-1]:
+                    ring = ring[:-1]
+                if len(ring) < 3:
+                    continue
+                vertices.extend(ring)
+                ring_offsets.append(len(vertices))
+                ring_parcel.append(parcel)
+                # The first ring of a polygon is its outline, the rest are holes
+                ring_signs.append(1.0 if r == 0 else -1.0)
+
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+    ring_parcel = np.asarray(ring_parcel, dtype=np.int64)
+
+    areas_m2 = np.zeros(len(ids), dtype=np.float64)
+    np.add.at(areas_m2, ring_parcel, ring_areas(vertices, ring_offsets) * np.asarray(ring_signs))
+    areas = areas_m2 * SQ_FT_PER_SQ_M
+
+    bboxes = np.full((len(ids), 4), np.nan, dtype=np.float64)
+    if len(ring_parcel):
+        ring_of_vertex = np.repeat(np.arange(len(ring_parcel)), np.diff(ring_offsets))
+        parcel_of_vertex = ring_parcel[ring_of_vertex]
+        bboxes[:, 0] = np.inf
+        bboxes[:, 1] = np.inf
+        bboxes[:, 2] = -np.inf
+        bboxes[:, 3] = -np.inf
+        np.minimum.at(bboxes[:, 0], parcel_of_vertex, vertices[:, 0])
+        np.minimum.at(bboxes[:, 1], parcel_of_vertex, vertices[:, 1])
+        np.maximum.at(bboxes[:, 2], parcel_of_vertex, vertices[:, 0])
+        np.maximum.at(bboxes[:, 3], parcel_of_vertex, vertices[:, 1])
+
+    grid_keys, grid_offsets, grid_items = _build_grid(bboxes, cell_degrees)
+
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    arrays = {
+        'vertices': vertices,
+        'ring_offsets': ring_offsets,
+        'ring_parcel': ring_parcel,
+        'areas': areas,
+        'bboxes': bboxes,
+        'grid_keys': grid_keys,
+        'grid_offsets': grid_offsets,
+        'grid_items': grid_items
+    }
+    for name, array in arrays.items():
+        np.save(f'{prefix}.{name}.npy', array)
+    with open(f'{prefix}.meta.json', 'w') as f:
+        json.dump({'ids': ids, 'cell_degrees': cell_degrees, 'source': os.path.basename(source_path)}, f)
+    logger.info("Compiled %s parcels (%s rings) to %s", len(ids), len(ring_parcel), prefix)
+    return len(ids)
+
+
+def _cell(x, y, cell_degrees):
+    return np.floor(x / cell_degrees).astype(np.int64), np.floor(y / cell_degrees).astype(np.int64)
+
+
+def _build_grid(bboxes, cell_degrees):
+    """CSR grid index: every cell a parcel's bounding box touches lists that parcel."""
+    keys = []
+    items = []
+    valid = ~np.isnan(bboxes[:, 0])
+    x0, y0 = _cell(bboxes[valid, 0], bboxes[valid, 1], cell_degrees)
+    x1, y1 = _cell(bboxes[valid, 2], bboxes[valid, 3], cell_degrees)
+    for parcel, cx0, cy0, cx1, cy1 in zip(np.flatnonzero(valid), x0, y0, x1, y1):
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                keys.append(cx * _GRID_STRIDE + cy)
+                items.append(parcel)
+    keys = np.asarray(keys, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    items = items[order]
+    unique_keys, starts = np.unique(keys, return_index=True)
+    offsets = np.append(starts, len(keys)).astype(np.int64)
+    return unique_keys, offsets, items
+
+
+# -- lookup ----------------------------------------------------------------
+
+class ParcelIndex:
+    """Point-in-parcel lookups over a compiled, memory-mapped parcel dataset."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        for name in ARRAYS:
+            setattr(self, name, np.load(f'{prefix}.{name}.npy', mmap_mode='r'))
+        with open(f'{prefix}.meta.json') as f:
+            meta = json.load(f)
+        self.ids = meta['ids']
+        self.cell_degrees = meta['cell_degrees']
+        # build() writes each parcel's rings together, so ring_parcel is
+        # sorted and parcel p's rings are parcel_rings[p]:parcel_rings[p + 1]
+        self.parcel_rings = np.searchsorted(self.ring_parcel, np.arange(len(self.ids) + 1))
+        self.version = f"{meta['source']}@{int(os.path.getmtime(f'{prefix}.areas.npy'))}"
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _candidates(self, lon, lat):
+        cx, cy = _cell(np.float64(lon), np.float64(lat), self.cell_degrees)
+        key = cx * _GRID_STRIDE + cy
+        slot = np.searchsorted(self.grid_keys, key)
+        if slot >= len(self.grid_keys) or self.grid_keys[slot] != key:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.asarray(self.grid_items[self.grid_offsets[slot]:self.grid_offsets[slot + 1]])
+        boxes = self.bboxes[candidates]
+        inside = (boxes[:, 0] <= lon) & (lon <= boxes[:, 2]) & (boxes[:, 1] <= lat) & (lat <= boxes[:, 3])
+        return candidates[inside]
+
+    def _contains(self, parcel, lon, lat):
+        # Even-odd ray casting over all of the parcel's rings, so holes count
+        crossings = 0
+        for ring in range(self.parcel_rings[parcel], self.parcel_rings[parcel + 1]):
+            points = np.asarray(self.vertices[self.ring_offsets[ring]:self.ring_offsets[ring + 1]])
+            x1, y1 = points[:, 0], points[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            straddles = (y1 > lat) != (y2 > lat)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_at = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+            crossings += int(np.count_nonzero(straddles & (lon < x_at)))
+        return crossings % 2 == 1
+
+    def find(self, lon, lat):
+        """Index of the parcel containing the point, or None."""
+        for parcel in self._candidates(lon, lat):
+            if self._contains(int(parcel), lon, lat):
+                return int(parcel)
+        return None
+
+    def lookup(self, lon, lat):
+        """(parcel_id, area in sq ft) for the point, or None."""
+        parcel = self.find(lon, lat)
+        if parcel is None:
+            return None
+        return self.ids[parcel], float(self.areas[parcel])
+
+
+# -- resolver --------------------------------------------------------------
+
+class GeocodeError(Exception):
+    pass
+
+
+_geocoder = {'pid': None, 'session': None}
+
+
+def _geocode_session():
+    # One keep-alive pool per process; a forked child must not share sockets
+    if _geocoder['pid'] != os.getpid():
+        import requests
+        _geocoder['session'] = requests.Session()
+        _geocoder['pid'] = os.getpid()
+    return _geocoder['session']
+
+
+def google_geocode(address):
+    """
+    (lon, lat) for an address from the Google Geocoding API, or None if it
+    has no match. Raises GeocodeError when the API refuses the request
+    (REQUEST_DENIED, OVER_QUERY_LIMIT, ...).
+    """
+    response = _geocode_session().get(
+        'https://maps.googleapis.com/maps/api/geocode/json',
+        params={'address': address, 'key': os.getenv('GOOGLE_MAPS_API_KEY')},
+        timeout=10
+    )
+    response.raise_for_status()
+    body = response.json()
+    status = body.get('status')
+    if status == 'ZERO_RESULTS':
+        return None
+    if status != 'OK':
+        raise GeocodeError(f"Geocoding failed: {status} {body.get('error_message', '')}".strip())
+    location = body['results'][0]['geometry']['location']
+    return location['lng'], location['lat']
+
+
+class ParcelResolver:
+    """
+    Lot size resolver: geocode the address, find its parcel, tier the parcel
+    area. Returns None for an address with no geocoding match or outside the
+    dataset; geocoding errors are raised.
+    """
+
+    def __init__(self, index, geocoder=google_geocode):
+        self.index = index
+        self.geocoder = geocoder
+
+    @property
+    def name(self):
+        return f'parcels:{self.index.version}'
+
+    def __call__(self, address):
+        point = self.geocoder(address)
+        if point is None:
+            return None
+        found = self.index.lookup(*point)
+        if found is None:
+            return None
+        return lot_size_tier(found[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile a parcel dataset for lot size lookups.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('source', help='GeoJSON or CSV (parcel_id, wkt) parcel file')
+    build_parser.add_argument('prefix', help='Output path prefix for the compiled arrays')
+    build_parser.add_argument('--cell-degrees', type=float, default=DEFAULT_CELL_DEGREES)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    count = build(args.source, args.prefix, cell_degrees=args.cell_degrees)
+    print(f"Compiled {count} parcels to {args.prefix}.*.npy")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
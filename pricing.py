@@ -0,0 +1,118 @@
+from bisect import bisect_left
+
+import numpy as np
+
+# Base prices for different lot sizes
+BASE_PRICES = {
+    'SMALL': 60,    # Up to 5,000 sq ft
+    'MEDIUM': 70,   # 5,000 - 10,000 sq ft
+    'LARGE': 75,    # 10,000 - 15,000 sq ft
+    'XLARGE': 80    # Over 15,000 sq ft
+}
+
+# Service type discounts
+SERVICE_DISCOUNTS = {
+    'ONE_TIME': 0,      # No discount
+    'MONTHLY': 0,       # No discount
+    'BI_WEEKLY': 0.10,  # 10% discount
+    'WEEKLY': 0.20      # 20% discount
+}
+
+LOT_SIZES = ('SMALL', 'MEDIUM', 'LARGE', 'XLARGE')
+SERVICE_TYPES = tuple(SERVICE_DISCOUNTS)
+# Upper bound (inclusive) in sq ft of every tier but the last
+TIER_LIMITS_SQFT = (5000, 10000, 15000)
+
+# Precompiled lookup tables, indexed by tier / service code. Unknown lot
+# sizes price as XLARGE and unknown service types get no discount, the same
+# fallbacks calculate_price uses; the extra trailing slot holds them.
+_BASE_TABLE = np.array([BASE_PRICES[t] for t in LOT_SIZES], dtype=np.float64)
+_DISCOUNT_TABLE = np.array([SERVICE_DISCOUNTS[s] for s in SERVICE_TYPES] + [0], dtype=np.float64)
+_TIER_LIMITS = np.array(TIER_LIMITS_SQFT, dtype=np.float64)
+_LOT_SIZE_NAMES = np.array(LOT_SIZES, dtype=object)
+_LOT_SIZE_CODES = {name: i for i, name in enumerate(LOT_SIZES)}
+_SERVICE_CODES = {name: i for i, name in enumerate(SERVICE_TYPES)}
+_UNKNOWN_LOT_SIZE = _LOT_SIZE_CODES['XLARGE']
+_UNKNOWN_SERVICE = len(SERVICE_TYPES)
+
+
+def calculate_price(lot_size_range, service_type='ONE_TIME'):
+    base_price = BASE_PRICES.get(lot_size_range, BASE_PRICES['XLARGE'])
+    discount = SERVICE_DISCOUNTS.get(service_type, 0)
+
+    # Apply discount and round to nearest $5
+    final_price = base_price * (1 - discount)
+    return round(final_price / 5) * 5
+
+
+def lot_size_tier(square_feet):
+    """Map a lot area in square feet to SMALL, MEDIUM, LARGE or XLARGE."""
+    return LOT_SIZES[bisect_left(TIER_LIMITS_SQFT, float(square_feet))]
+
+
+def _encode(labels, codes, unknown):
+    """Turn a sequence of labels into an array of table codes."""
+    return np.fromiter((codes.get(label, unknown) for label in labels), dtype=np.intp, count=len(labels))
+
+
+def tier_codes_from_sqft(square_feet):
+    return np.searchsorted(_TIER_LIMITS, np.asarray(square_feet, dtype=np.float64), side='left')
+
+
+def calculate_prices(lot_size_codes, service_codes):
+    """Vectorised calculate_price over code arrays. Returns int64 prices."""
+    base_price = _BASE_TABLE[lot_size_codes]
+    discount = _DISCOUNT_TABLE[service_codes]
+    # Same operations in the same order as the scalar version; np.rint
+    # rounds half to even exactly like Python's round()
+    final_price = base_price * (1 - discount)
+    return (np.rint(final_price / 5) * 5).astype(np.int64)
+
+
+def price_columns(service_types, lot_sizes=None, square_feet=None):
+    """
+    Price quotes given as parallel columns. Each row is priced by its square
+    footage when one is given (not NaN/None), otherwise by its lot size name.
+    Returns (lot_sizes, prices) as lists in input order.
+    """
+    count = len(service_types)
+    service_codes = _encode(service_types, _SERVICE_CODES, _UNKNOWN_SERVICE)
+    if lot_sizes is not None:
+        lot_size_codes = _encode(lot_sizes, _LOT_SIZE_CODES, _UNKNOWN_LOT_SIZE)
+    else:
+        lot_size_codes = np.full(count, _UNKNOWN_LOT_SIZE, dtype=np.intp)
+
+    if square_feet is not None:
+        square_feet = np.array(square_feet, dtype=np.float64).reshape(count)
+        by_area = ~np.isnan(square_feet)
+        if by_area.all():
+            lot_size_codes = tier_codes_from_sqft(square_feet)
+        elif by_area.any():
+            lot_size_codes[by_area] = tier_codes_from_sqft(square_feet[by_area])
+
+    prices = calculate_prices(lot_size_codes, service_codes)
+    return _LOT_SIZE_NAMES[lot_size_codes].tolist(), prices.tolist()
+
+
+def price_quotes(quotes):
+    """
+    Price a list of quotes. Each quote is a dict with 'service_type' and
+    either 'lot_size' (a tier name) or 'square_feet'.
+    """
+    return price_columns(
+        [q.get('service_type', 'ONE_TIME') for q in quotes],
+        lot_sizes=[q.get('lot_size', '') for q in quotes],
+        square_feet=[q.get('square_feet') for q in quotes]
+    )
+
+
+def price_grid():
+    """Price for every lot size and service type, for rate cards."""
+    lot_size_codes, service_codes = np.meshgrid(
+        np.arange(len(LOT_SIZES)), np.arange(len(SERVICE_TYPES)), indexing='ij'
+    )
+    prices = calculate_prices(lot_size_codes.ravel(), service_codes.ravel()).reshape(lot_size_codes.shape)
+    return {
+        lot_size: dict(zip(SERVICE_TYPES, prices[i].tolist()))
+        for i, lot_size in enumerate(LOT_SIZES)
+    }
@@ -0,0 +1,311 @@
+"""
+Opt-in request profiling.
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>`, or at
+random with probability PROFILE_SAMPLE_RATE. Two profilers are available
+(PROFILE_MODE, or the X-Profile-Mode header):
+
+    sampling  a thread samples the request thread's stack every
+              PROFILE_INTERVAL_MS and writes <id>.collapsed, one
+              'frame;frame;frame count' line per stack, for flamegraph.pl
+              or speedscope. Cheap; the default.
+    cprofile  deterministic cProfile of the request thread, written as
+              <id>.prof for snakeviz/pstats. Exact, but slows the request.
+
+Both also write <id>.txt with the top functions. Files go to PROFILE_DIR
+after the response has been sent, and only the newest PROFILE_MAX_FILES
+profiles are kept.
+
+Overhead is capped per process: one profile at a time, at most
+PROFILE_MAX_PER_MINUTE profiles and PROFILE_BUDGET_SECONDS of profiled
+wall time per minute. A sampler stops when the budget runs out or after
+PROFILE_MAX_SECONDS. A cProfile run can't be stopped part way, so when the
+budget left is less than the route's recent cProfile runs took, the request
+gets the sampler instead. Requests over budget are served unprofiled with
+`X-Profile: refused`.
+"""
+import os
+import sys
+import hmac
+import time
+import uuid
+import pstats
+import random
+import cProfile
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+TOKEN = os.getenv('PROFILE_TOKEN')
+SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+MODE = os.getenv('PROFILE_MODE', 'sampling')
+MODES = ('sampling', 'cprofile')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', 5)) / 1000
+MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 10))
+MAX_PER_MINUTE = int(os.getenv('PROFILE_MAX_PER_MINUTE', 6))
+BUDGET_SECONDS = float(os.getenv('PROFILE_BUDGET_SECONDS', 5))
+MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 200))
+TOP_FUNCTIONS = 30
+# Weight of the newest run in a route's expected cProfile cost
+COST_SMOOTHING = 0.3
+
+
+class Budget:
+    """Profiles and profiled seconds allowed per one-minute window, one at a time."""
+
+    def __init__(self, max_per_minute=MAX_PER_MINUTE, seconds=BUDGET_SECONDS):
+        self.max_per_minute = max_per_minute
+        self.seconds = seconds
+        self._lock = threading.Lock()
+        self._window = 0
+        self._count = 0
+        self._used = 0.0
+        self.active = False
+        self.counts = {'profiled': 0, 'refused': 0, 'truncated': 0, 'cprofile_skipped': 0}
+        self._cprofile_cost = {}
+
+    def _roll(self):
+        window = int(time.time() // 60)
+        if window != self._window:
+            self._window, self._count, self._used = window, 0, 0.0
+
+    def try_start(self):
+        with self._lock:
+            self._roll()
+            if self.active or self._count >= self.max_per_minute or self._used >= self.seconds:
+                self.counts['refused'] += 1
+                return False
+            self.active = True
+            self._count += 1
+            return True
+
+    def remaining(self):
+        with self._lock:
+            self._roll()
+            return max(self.seconds - self._used, 0.0)
+
+    def cprofile_fits(self, route):
+        """True if the budget left covers what a cProfile run of route is expected to take."""
+        fits = self.remaining() >= self._cprofile_cost.get(route, 0.0)
+        if not fits:
+            with self._lock:
+                self.counts['cprofile_skipped'] += 1
+        return fits
+
+    def record_cprofile(self, route, seconds):
+        with self._lock:
+            cost = self._cprofile_cost.get(route)
+            self._cprofile_cost[route] = seconds if cost is None else cost + COST_SMOOTHING * (seconds - cost)
+
+    def finish(self, seconds, truncated=False):
+        with self._lock:
+            self._roll()
+            self._used += seconds
+            self.active = False
+            self.counts['profiled'] += 1
+            if truncated:
+                self.counts['truncated'] += 1
+
+    def stats(self):
+        with self._lock:
+            self._roll()
+            return {
+                **self.counts,
+                'this_minute': {'profiles': self._count, 'seconds': round(self._used, 3)},
+                'limits': {'per_minute': self.max_per_minute, 'seconds_per_minute': self.seconds}
+            }
+
+
+budget = Budget()
+
+
+def _frame_name(code):
+    return f'{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}'
+
+
+class StackSampler:
+    """Samples one thread's stack on a background thread."""
+
+    def __init__(self, thread_id, interval=INTERVAL, max_seconds=MAX_SECONDS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = Counter()
+        self.truncated = False
+        self.sampled = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def _run(self):
+        deadline = self.started + min(self.max_seconds, budget.remaining())
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(names))] += 1
+            self.sampled = time.perf_counter() - self.started
+            if time.perf_counter() >= deadline:
+                self.truncated = True
+                break
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return time.perf_counter() - self.started
+
+    def write(self, path):
+        with open(f'{path}.collapsed', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        total = sum(self.stacks.values())
+        own, inclusive = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for name in set(frames):
+                inclusive[name] += count
+        # A busy request thread holds the GIL past the interval, so spread
+        # the sampled wall time over the samples actually taken
+        per_sample = self.sampled * 1000 / total if total else 0
+        lines = [f'{total} samples over {self.sampled * 1000:.1f} ms (interval {self.interval * 1000:g} ms)']
+        for title, counts in (('self', own), ('inclusive', inclusive)):
+            lines += ['', f'{title}:']
+            lines += [f'  {n / total:6.1%} {n * per_sample:8.1f} ms  {name}'
+                      for name, n in counts.most_common(TOP_FUNCTIONS)]
+        return lines
+
+
+class DeterministicProfiler:
+    """cProfile of the calling thread; enable and disable on the request thread."""
+
+    truncated = False
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        self.profile.disable()
+        return time.perf_counter() - self.started
+
+    def write(self, path):
+        self.profile.dump_stats(f'{path}.prof')
+        stats = pstats.Stats(self.profile)
+        top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+        lines = ['cumulative    own  calls  function']
+        for (filename, line, name), (_, calls, own_time, cumulative, _) in top:
+            module = os.path.splitext(os.path.basename(filename))[0]
+            lines.append(f'{cumulative * 1000:9.1f} {own_time * 1000:7.1f} {calls:6}  {module}:{line}:{name}')
+        return lines
+
+
+def _prune(directory):
+    summaries = sorted(f for f in os.listdir(directory) if f.endswith('.txt'))
+    for name in summaries[:max(len(summaries) - MAX_FILES, 0)]:
+        stem = name[:-4]
+        for extension in ('.txt', '.collapsed', '.prof'):
+            try:
+                os.remove(os.path.join(directory, stem + extension))
+            except FileNotFoundError:
+                pass
+
+
+def _save(profile_id, profiler, meta):
+    """Write the profile files; runs after the response has gone out."""
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, profile_id)
+        lines = profiler.write(path)
+        header = [f'{key}: {value}' for key, value in meta.items()]
+        with open(f'{path}.txt', 'w') as f:
+            f.write('\n'.join(header + [''] + lines) + '\n')
+        _prune(PROFILE_DIR)
+    except Exception as e:
+        logger.warning("Failed to write profile %s: %s", profile_id, e)
+
+
+def authorized(header_value):
+    return bool(TOKEN and header_value and hmac.compare_digest(header_value, TOKEN))
+
+
+def list_profiles(limit=50):
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    summaries = sorted((f for f in os.listdir(PROFILE_DIR) if f.endswith('.txt')), reverse=True)[:limit]
+    return [name[:-4] for name in summaries]
+
+
+def stats():
+    return {**budget.stats(), 'mode': MODE, 'sample_rate': SAMPLE_RATE, 'directory': PROFILE_DIR}
+
+
+def init_app(app):
+    """Profile requests that ask for it (or are sampled), within the budget."""
+    from flask import g, request
+
+    def _route():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.before_request
+    def _start_profile():
+        requested = authorized(request.headers.get('X-Profile'))
+        if not requested and not (SAMPLE_RATE and random.random() < SAMPLE_RATE):
+            return
+        if not budget.try_start():
+            g._profile_refused = requested
+            return
+        mode = request.headers.get('X-Profile-Mode') if requested else None
+        mode = mode if mode in MODES else MODE
+        if mode == 'cprofile' and not budget.cprofile_fits(_route()):
+            mode = 'sampling'
+        if mode == 'cprofile':
+            g._profiler = DeterministicProfiler().start()
+        else:
+            g._profiler = StackSampler(threading.get_ident()).start()
+        g._profile_mode = mode
+
+    @app.after_request
+    def _finish_profile(response):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            if g.pop('_profile_refused', False):
+                response.headers['X-Profile'] = 'refused'
+            return response
+        elapsed = profiler.stop()
+        budget.finish(elapsed, profiler.truncated)
+        route = _route()
+        if g._profile_mode == 'cprofile':
+            budget.record_cprofile(route, elapsed)
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        meta = {
+            'route': route,
+            'method': request.method,
+            'status': response.status_code,
+            'mode': g._profile_mode,
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'truncated': profiler.truncated
+        }
+        response.headers['X-Profile-Id'] = profile_id
+        response.call_on_close(lambda: _save(profile_id, profiler, meta))
+        return response
+
+    @app.teardown_request
+    def _abandon_profile(error):
+        # Only reached with a profiler still running if after_request didn't run
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            budget.finish(profiler.stop(), profiler.truncated)
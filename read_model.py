@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import logging
+import threading
+
+import stripe
+
+from db import get_connection, ensure_schema, ensure_column
+import stripe_scheduler
+from stripe_lookup import UpstreamTimer, has_expanded_payment_method, iter_customers, payment_method_presence
+
+logger = logging.getLogger(__name__)
+
+# Stripe keeps events for 30 days; past that a catch-up has to resync fully.
+EVENT_RETENTION_SECONDS = 30 * 24 * 3600
+CATCH_UP_INTERVAL = int(os.getenv('READ_MODEL_CATCH_UP_INTERVAL', 600))
+# One worker at a time runs the catch-up; the others check back this often
+# in case it is due. A worker that dies mid-sync frees it after the lease.
+SYNC_POLL_INTERVAL = min(CATCH_UP_INTERVAL, 60)
+SYNC_LEASE_SECONDS = int(os.getenv('READ_MODEL_SYNC_LEASE_SECONDS', 900))
+# Events can be written a little after their `created` time, so each
+# checkpoint is set back by this much and the overlap is replayed.
+CHECKPOINT_OVERLAP = 300
+
+EVENT_TYPES = [
+    'customer.created',
+    'customer.updated',
+    'customer.deleted',
+    'payment_method.attached',
+    'payment_method.detached',
+    'setup_intent.succeeded',
+    'payment_intent.succeeded',
+    'payment_intent.payment_failed',
+    'payment_intent.canceled'
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (
+    id TEXT PRIMARY KEY,
+    email TEXT,
+    created INTEGER,
+    metadata TEXT NOT NULL DEFAULT '{}',
+    has_payment_method INTEGER NOT NULL DEFAULT 0,
+    payment_method_at INTEGER NOT NULL DEFAULT 0,
+    last_payment_intent TEXT,
+    last_payment_status TEXT,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    updated_at INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_customers_created ON customers (created);
+CREATE TABLE IF NOT EXISTS sync_checkpoints (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+"""
+
+_sync_lock = threading.Lock()
+_sync_state = {'pid': None, 'last_catch_up': None, 'last_error': None}
+
+
+def _conn():
+    ensure_schema('read_model', SCHEMA)
+    ensure_column('customers', 'payment_method_at', 'INTEGER NOT NULL DEFAULT 0')
+    return get_connection()
+
+
+def _now():
+    return int(time.time())
+
+
+def _get_checkpoint(conn, name):
+    row = conn.execute('SELECT value FROM sync_checkpoints WHERE name = ?', (name,)).fetchone()
+    return row['value'] if row else None
+
+
+def _set_checkpoint(conn, name, value):
+    conn.execute(
+        'INSERT INTO sync_checkpoints (name, value, updated_at) VALUES (?, ?, ?) '
+        'ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at',
+        (name, value, _now())
+    )
+
+
+# -- writes ----------------------------------------------------------------
+
+_UPSERT_SQL = """
+INSERT INTO customers (id, email, created, metadata, has_payment_method, payment_method_at, deleted, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+ON CONFLICT(id) DO UPDATE SET
+    email = excluded.email,
+    created = excluded.created,
+    metadata = excluded.metadata,
+    has_payment_method = CASE WHEN ? IS NULL OR customers.payment_method_at > excluded.updated_at
+                              THEN customers.has_payment_method
+                              ELSE excluded.has_payment_method END,
+    payment_method_at = CASE WHEN ? IS NULL THEN customers.payment_method_at
+                             ELSE MAX(customers.payment_method_at, excluded.updated_at) END,
+    deleted = 0,
+    updated_at = excluded.updated_at
+WHERE customers.updated_at <= excluded.updated_at
+"""
+
+
+def _upsert_params(customer, updated_at, has_payment_method):
+    if has_payment_method is None and has_expanded_payment_method(customer):
+        has_payment_method = True
+    return (
+        customer['id'],
+        customer.get('email'),
+        customer.get('created'),
+        json.dumps(dict(customer.get('metadata') or {})),
+        int(bool(has_payment_method)),
+        updated_at if has_payment_method is not None else 0,
+        updated_at,
+        has_payment_method,
+        has_payment_method
+    )
+
+
+def upsert_customer(customer, updated_at=None, has_payment_method=None):
+    """
+    Store a Stripe customer object. Writes older than what is stored are
+    ignored, so replayed or out-of-order events can't roll data back.
+    has_payment_method=None keeps the stored flag unless the object itself
+    shows a default card; a flag set by a newer payment method event is kept.
+    """
+    conn = _conn()
+    with conn:
+        conn.execute(_UPSERT_SQL, _upsert_params(customer, updated_at or _now(), has_payment_method))
+
+
+def mark_deleted(customer_id, updated_at=None):
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'UPDATE customers SET deleted = 1, updated_at = ? WHERE id = ? AND updated_at <= ?',
+            (updated_at or _now(), customer_id, updated_at or _now())
+        )
+
+
+def set_payment_method(customer_id, present, event_at=None):
+    """Set the payment method flag, unless a newer event already has."""
+    event_at = event_at or _now()
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'UPDATE customers SET has_payment_method = ?, payment_method_at = ? '
+            'WHERE id = ? AND payment_method_at <= ?',
+            (int(bool(present)), event_at, customer_id, event_at)
+        )
+
+
+def record_payment(customer_id, payment_intent_id, status):
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'UPDATE customers SET last_payment_intent = ?, last_payment_status = ? WHERE id = ?',
+            (payment_intent_id, status, customer_id)
+        )
+
+
+def apply_event(event):
+    """Update the read model from a customer.*, payment_method.*, setup_intent.* or payment_intent.* event."""
+    event_type = event['type']
+    obj = event['data']['object']
+    created = event.get('created') or _now()
+
+    if event_type in ('customer.created', 'customer.updated'):
+        upsert_customer(obj, updated_at=created)
+    elif event_type == 'customer.deleted':
+        mark_deleted(obj['id'], updated_at=created)
+    elif event_type == 'payment_method.attached':
+        if obj.get('customer') and obj.get('type') == 'card':
+            set_payment_method(obj['customer'], True, event_at=created)
+    elif event_type == 'payment_method.detached':
+        # The detached object no longer names its customer
+        previous = event['data'].get('previous_attributes') or {}
+        customer_id = previous.get('customer')
+        if customer_id:
+            remaining = stripe.PaymentMethod.list(customer=customer_id, type='card', limit=1)
+            set_payment_method(customer_id, len(remaining.data) > 0, event_at=created)
+    elif event_type == 'setup_intent.succeeded':
+        if obj.get('customer') and obj.get('payment_method'):
+            set_payment_method(obj['customer'], True, event_at=created)
+    elif event_type.startswith('payment_intent.'):
+        if obj.get('customer'):
+            record_payment(obj['customer'], obj['id'], obj.get('status'))
+
+
+# -- reads -----------------------------------------------------------------
+
+def ready():
+    """True once a full sync has populated the model."""
+    return _get_checkpoint(_conn(), 'full_sync') is not None
+
+
+def list_customers():
+    rows = _conn().execute(
+        'SELECT id, email, created, metadata, has_payment_method FROM customers '
+        'WHERE deleted = 0 ORDER BY created DESC'
+    ).fetchall()
+    return [{
+        'id': row['id'],
+        'email': row['email'],
+        'created': row['created'],
+        'metadata': json.loads(row['metadata']),
+        'has_payment_method': bool(row['has_payment_method'])
+    } for row in rows]
+
+
+def stats():
+    conn = _conn()
+    return {
+        'customers': conn.execute('SELECT COUNT(*) FROM customers WHERE deleted = 0').fetchone()[0],
+        'full_sync': _get_checkpoint(conn, 'full_sync'),
+        'events_checkpoint': _get_checkpoint(conn, 'events'),
+        'next_catch_up': _get_checkpoint(conn, 'sync_lease'),
+        'last_catch_up': _sync_state['last_catch_up'],
+        'last_error': _sync_state['last_error']
+    }
+
+
+# -- sync ------------------------------------------------------------------
+
+def store_snapshot(customers, presence, started_at):
+    """
+    Replace the model with a full customer listing. Customers missing from
+    the listing and not touched since it started are marked deleted.
+    """
+    conn = _conn()
+    seen = [customer.id for customer in customers]
+    with conn:
+        conn.executemany(_UPSERT_SQL, [
+            _upsert_params(customer, started_at, presence.get(customer.id, False))
+            for customer in customers
+        ])
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen_customers (id TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM seen_customers')
+        conn.executemany('INSERT OR IGNORE INTO seen_customers (id) VALUES (?)', [(i,) for i in seen])
+        conn.execute(
+            'UPDATE customers SET deleted = 1 WHERE updated_at <= ? AND id NOT IN (SELECT id FROM seen_customers)',
+            (started_at,)
+        )
+        _set_checkpoint(conn, 'full_sync', started_at)
+        _set_checkpoint(conn, 'events', started_at - CHECKPOINT_OVERLAP)
+
+
+def full_sync():
+    started_at = _now()
+    timer = UpstreamTimer()
+    customers = list(iter_customers(timer=timer))
+    presence = payment_method_presence(customers, timer=timer)
+    store_snapshot(customers, presence, started_at)
+    logger.info("Read model full sync: %s customers (%s)", len(customers), timer.as_dict())
+
+
+def catch_up():
+    """
+    Replay Stripe events since the last checkpoint, or do a full sync if
+    there is no checkpoint or it is older than Stripe's event retention.
+    """
+    with _sync_lock:
+        conn = _conn()
+        checkpoint = _get_checkpoint(conn, 'events')
+        started_at = _now()
+        if checkpoint is None or started_at - checkpoint > EVENT_RETENTION_SECONDS - CHECKPOINT_OVERLAP:
+            full_sync()
+            _sync_state['last_catch_up'] = started_at
+            return
+
+        events = []
+        for event in stripe.Event.list(created={'gte': checkpoint}, types=EVENT_TYPES, limit=100).auto_paging_iter():
+            events.append(event)
+        # The list is newest first
+        for event in reversed(events):
+            apply_event(event)
+        with conn:
+            _set_checkpoint(conn, 'events', started_at - CHECKPOINT_OVERLAP)
+        _sync_state['last_catch_up'] = started_at
+        logger.info("Read model caught up on %s events since %s", len(events), checkpoint)
+
+
+def _claim_sync(now):
+    """Take the shared catch-up lease if it is due and free. Returns True if taken."""
+    conn = _conn()
+    with conn:
+        cursor = conn.execute(
+            'INSERT INTO sync_checkpoints (name, value, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at '
+            'WHERE sync_checkpoints.value <= ?',
+            ('sync_lease', now + SYNC_LEASE_SECONDS, now, now)
+        )
+    return cursor.rowcount == 1
+
+
+def _release_sync(started_at):
+    """Free the lease; the next catch-up is due CATCH_UP_INTERVAL after this one started."""
+    conn = _conn()
+    with conn:
+        _set_checkpoint(conn, 'sync_lease', started_at + CATCH_UP_INTERVAL)
+
+
+def _sync_loop():
+    # Catch-up is never urgent enough to delay a customer's call
+    with stripe_scheduler.priority(stripe_scheduler.BATCH):
+        while True:
+            started_at = _now()
+            try:
+                if _claim_sync(started_at):
+                    try:
+                        catch_up()
+                        _sync_state['last_error'] = None
+                    finally:
+                        _release_sync(started_at)
+            except Exception as e:
+                _sync_state['last_error'] = str(e)
+                logger.error("Read model catch-up failed: %s", e)
+            time.sleep(SYNC_POLL_INTERVAL)
+
+
+def start_background_sync():
+    """
+    Start this process's catch-up loop (once per pid). Every worker runs one,
+    but the shared lease in sync_checkpoints lets only one catch up at a time.
+    """
+    if _sync_state['pid'] == os.getpid():
+        return
+    _sync_state['pid'] = os.getpid()
+    threading.Thread(target=_sync_loop, name='read-model-sync', daemon=True).start()
@@ -0,0 +1,356 @@
+"""
+Stripe <-> sheet reconciliation.
+
+One pass streams every Stripe customer, reads the sheet once (A:K), joins
+the two in memory on normalized email with a dict on each side, and
+reports where they disagree:
+
+    missing_rows       customers with no sheet row
+    orphan_rows        sheet rows with no customer (often quotes that never
+                       became customers, so these are only reported)
+    duplicate_rows     emails on more than one row; the first row is used,
+                       as the row index does
+    legacy_rows        rows written in the old column order (phone in D,
+                       service type in G); rewritten in sheet_format.HEADERS
+                       order
+    mismatches         fields that differ. Stripe wins for service type,
+                       price and charged date; name, phone, address and lot
+                       size are only filled in where the sheet cell is empty,
+                       and other differences are reported as conflicts
+
+Every fix is sent in a single values.batchUpdate. Missing rows are only
+added with append_missing, through the sheet queue like any other append.
+With dry_run nothing is written. While applying, the sheet_format lease is
+held from the sheet read to the write, so no row is renumbered in between.
+
+    python reconcile.py            # dry run, prints the report
+    python reconcile.py --apply
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import contextlib
+
+import sheet_format
+import stripe_scheduler
+from pricing import SERVICE_TYPES
+from sheet_index import row_index
+from sheet_queue import sheet_queue
+from sheets_client import get_sheets_service, spreadsheet_id
+from stripe_lookup import UpstreamTimer, iter_customers
+
+logger = logging.getLogger(__name__)
+
+# Entries listed per category in the report; counts are always complete
+REPORT_LIMIT = 100
+
+# field -> sheet header
+FIELDS = {
+    'name': 'Customer Name',
+    'service_type': 'Service Type',
+    'phone': 'Phone Number',
+    'address': 'Address',
+    'lot_size': 'Lot Size',
+    'price': 'Price ($)',
+    'charged_date': 'Charged Date'
+}
+# Fields where Stripe is the source of truth; the rest are only filled in
+STRIPE_WINS = ('service_type', 'price', 'charged_date')
+
+_INDEX = {header: i for i, header in enumerate(sheet_format.HEADERS)}
+_EMAIL = _INDEX['Email']
+# Column positions in rows appended before the layout matched HEADERS:
+# timestamp, name, email, phone, address, lot size, service type, price,
+# start date (overwritten by charges with the charge time), payment status,
+# charged date
+_LEGACY = {'phone': 3, 'address': 4, 'lot_size': 5, 'service_type': 6, 'price': 7,
+           'start_date': 8, 'payment_status': 9, 'charged_date': 10}
+_DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%d.%m.%Y %H:%M', '%Y-%m-%d')
+
+
+def _email(value):
+    return (value or '').strip().lower()
+
+
+def _service_type(value):
+    return (value or '').strip().upper().replace('-', '_').replace(' ', '_')
+
+
+def _date(value):
+    value = (value or '').strip()
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def _price(value):
+    try:
+        return float(str(value).replace('$', '').replace(',', '').strip())
+    except ValueError:
+        return None
+
+
+def _same(field, sheet_value, stripe_value):
+    if field == 'price':
+        a, b = _price(sheet_value), _price(stripe_value)
+        if a is not None and b is not None:
+            return abs(a - b) < 0.005
+    elif field == 'charged_date':
+        a, b = _date(sheet_value), _date(stripe_value)
+        if a is not None and b is not None:
+            # Stripe's metadata keeps minutes only
+            return a.replace(second=0) == b.replace(second=0)
+    elif field == 'service_type':
+        return _service_type(sheet_value) == _service_type(stripe_value)
+    return (sheet_value or '').strip().casefold() == (stripe_value or '').strip().casefold()
+
+
+def _pad(row):
+    return list(row) + [''] * (len(sheet_format.HEADERS) - len(row))
+
+
+def is_legacy(row):
+    """True for a row in the old column order: a service type in G but not in D."""
+    row = _pad(row)
+    return (_service_type(row[_LEGACY['service_type']]) in SERVICE_TYPES
+            and _service_type(row[_INDEX['Service Type']]) not in SERVICE_TYPES)
+
+
+def from_legacy(row):
+    """Reorder an old-layout row into HEADERS order."""
+    row = _pad(row)
+    start_date, charged_date = row[_LEGACY['start_date']], row[_LEGACY['charged_date']]
+    # A full timestamp in the start date column is a charge time written there
+    if _date(start_date) is not None and ':' in start_date:
+        charged_date, start_date = charged_date or start_date, ''
+    fixed = _pad(row[:_EMAIL + 1])
+    for field in ('phone', 'address', 'lot_size', 'service_type', 'price'):
+        fixed[_INDEX[FIELDS[field]]] = row[_LEGACY[field]]
+    fixed[_INDEX['Charged Date']] = charged_date
+    fixed[_INDEX['Start Date']] = start_date
+    fixed[_INDEX['Payment Status']] = row[_LEGACY['payment_status']]
+    return fixed
+
+
+def stripe_values(customer):
+    """A customer's values for the sheet's fields."""
+    metadata = customer.get('metadata') or {}
+    charged = _date(metadata.get('charge_date'))
+    return {
+        'name': customer.get('name') or '',
+        'email': customer.get('email') or '',
+        'service_type': metadata.get('service_type') or '',
+        'phone': customer.get('phone') or metadata.get('phone') or '',
+        'address': metadata.get('address') or '',
+        'lot_size': metadata.get('lot_size') or '',
+        'price': metadata.get('price') or '',
+        'charged_date': charged.strftime('%Y-%m-%d %H:%M') if charged else ''
+    }
+
+
+def sheet_row(values):
+    """A new sheet row for a customer with none, in HEADERS order."""
+    row = [''] * len(sheet_format.HEADERS)
+    row[_INDEX['Timestamp']] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    row[_EMAIL] = values['email']
+    for field, header in FIELDS.items():
+        row[_INDEX[header]] = values[field]
+    row[_INDEX['Payment Status']] = 'Active'
+    return row
+
+
+class _Report:
+    def __init__(self):
+        self.counts = {}
+        self.entries = {}
+
+    def add(self, category, entry):
+        self.counts[category] = self.counts.get(category, 0) + 1
+        entries = self.entries.setdefault(category, [])
+        if len(entries) < REPORT_LIMIT:
+            entries.append(entry)
+
+
+@contextlib.contextmanager
+def _phase(timings, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def _load_customers(timer):
+    """Stream all customers into {email: customer}, keeping the newest per email."""
+    by_email = {}
+    duplicates = []
+    without_email = []
+    with stripe_scheduler.priority(stripe_scheduler.BATCH):
+        for customer in iter_customers(timer):
+            email = _email(customer.get('email'))
+            if not email:
+                without_email.append(customer.id)
+                continue
+            existing = by_email.get(email)
+            if existing is not None:
+                duplicates.append({'email': email, 'customer_ids': [existing.id, customer.id]})
+                if existing.created >= customer.created:
+                    continue
+            by_email[email] = customer
+    return by_email, duplicates, without_email
+
+
+def _read_sheet(service):
+    result = service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id(),
+        range=f'A:{sheet_format.LAST_COLUMN}'
+    ).execute()
+    return result.get('values', [])
+
+
+def _diff(customers, rows, report):
+    """Join and compare; returns ({row: new values or {column: value}}, [missing customers])."""
+    first_row = {}
+    for i, row in enumerate(rows[1:], start=2):
+        email = _email(row[_EMAIL] if len(row) > _EMAIL else '')
+        if not email:
+            continue
+        if email in first_row:
+            report.add('duplicate_rows', {'email': email, 'row': i, 'first_row': first_row[email]})
+        else:
+            first_row[email] = i
+
+    fixes = {}
+    for email, row_number in first_row.items():
+        customer = customers.get(email)
+        row = rows[row_number - 1]
+        legacy = is_legacy(row)
+        current = from_legacy(row) if legacy else _pad(row)
+        if legacy:
+            report.add('legacy_rows', {'row': row_number, 'email': email})
+        if customer is None:
+            report.add('orphan_rows', {'row': row_number, 'email': email})
+            if legacy:
+                fixes[row_number] = current
+            continue
+
+        expected = stripe_values(customer)
+        cells = {}
+        for field, header in FIELDS.items():
+            column = _INDEX[header]
+            sheet_value, stripe_value = str(current[column]), str(expected[field])
+            if not stripe_value or _same(field, sheet_value, stripe_value):
+                continue
+            entry = {'row': row_number, 'email': email, 'customer_id': customer.id, 'field': field,
+                     'sheet': sheet_value, 'stripe': stripe_value}
+            if field in STRIPE_WINS or not sheet_value.strip():
+                cells[column] = stripe_value
+                report.add('mismatches', {**entry, 'action': 'update'})
+            else:
+                report.add('conflicts', entry)
+        if legacy:
+            for column, value in cells.items():
+                current[column] = value
+            fixes[row_number] = current
+        elif cells:
+            fixes[row_number] = cells
+
+    missing = [customer for email, customer in customers.items() if email not in first_row]
+    for customer in missing:
+        report.add('missing_rows', {'customer_id': customer.id, 'email': customer.email})
+    return fixes, missing
+
+
+def _update_data(fixes):
+    """values.batchUpdate entries: whole rows for legacy rewrites, single cells otherwise."""
+    data = []
+    for row_number, fix in sorted(fixes.items()):
+        if isinstance(fix, list):
+            data.append({
+                'range': f'A{row_number}:{sheet_format.LAST_COLUMN}{row_number}',
+                'values': [[str(value) for value in fix]]
+            })
+        else:
+            for column, value in sorted(fix.items()):
+                data.append({'range': f'{chr(ord("A") + column)}{row_number}', 'values': [[value]]})
+    return data
+
+
+def run(service=None, dry_run=True, append_missing=False):
+    """Reconcile Stripe customers with the sheet. Returns the report."""
+    timings = {}
+    report = _Report()
+    timer = UpstreamTimer()
+
+    with _phase(timings, 'stripe'):
+        customers, duplicate_customers, without_email = _load_customers(timer)
+    for entry in duplicate_customers:
+        report.add('duplicate_customers', entry)
+    for customer_id in without_email:
+        report.add('customers_without_email', {'customer_id': customer_id})
+
+    service = service or get_sheets_service()
+    # Row numbers must not shift between the read and the write
+    hold = contextlib.nullcontext() if dry_run else sheet_format.lease()
+    with hold:
+        with _phase(timings, 'sheet_read'):
+            rows = _read_sheet(service)
+        with _phase(timings, 'join'):
+            fixes, missing = _diff(customers, rows, report)
+            data = _update_data(fixes)
+        with _phase(timings, 'write'):
+            if data and not dry_run:
+                service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=spreadsheet_id(),
+                    body={'valueInputOption': 'RAW', 'data': data}
+                ).execute()
+            appended = 0
+            if missing and append_missing and not dry_run:
+                for customer in missing:
+                    row_index.register_customer(customer.id, customer.email)
+                    sheet_queue.enqueue(sheet_row(stripe_values(customer)))
+                appended = len(missing)
+
+    summary = {
+        'dry_run': dry_run,
+        'customers': len(customers) + len(without_email),
+        'sheet_rows': max(len(rows) - 1, 0),
+        'counts': report.counts,
+        'rows_to_update': len(fixes),
+        'ranges_written': 0 if dry_run else len(data),
+        'rows_appended': appended,
+        'stripe': timer.as_dict(),
+        'timings_ms': timings
+    }
+    logger.info("Reconciliation%s: %s", ' (dry run)' if dry_run else '', json.dumps(summary))
+    return {**summary, 'differences': report.entries}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile Stripe customers with the sheet.')
+    parser.add_argument('--apply', action='store_true', help='Write the fixes (default: dry run)')
+    parser.add_argument('--append-missing', action='store_true', help='Add rows for customers with none')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from dotenv import load_dotenv
+    import stripe
+    import stripe_http
+    load_dotenv()
+    stripe.api_key = (os.getenv('STRIPE_SECRET_KEY') or '').strip()
+    stripe.api_base = os.getenv('STRIPE_API_BASE', stripe.api_base)
+    stripe_http.install()
+    print(json.dumps(run(dry_run=not args.apply, append_missing=args.append_missing), indent=2, default=str))
+    if args.append_missing and args.apply:
+        sheet_queue.drain()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,411 @@
+"""
+Incremental sheet formatting.
+
+The formatter remembers (in payments.db) how many leading rows are already
+compacted and formatted, plus any rows cleared since then. A run only reads
+the rows past that mark and the recorded cleared rows. It then sends one
+batchUpdate that deletes the empty rows with deleteDimension and formats the
+new rows. Rows are never cleared and rewritten, so an append that lands
+mid-run is not lost.
+"""
+import time
+import logging
+import threading
+import contextlib
+
+from db import get_connection, ensure_schema
+from sheets_client import spreadsheet_id
+from sheet_index import row_index
+
+logger = logging.getLogger(__name__)
+
+SHEET_ID = 0
+# The sheet's column layout; app.build_sheet_row writes rows in this order
+HEADERS = [
+    'Timestamp',
+    'Customer Name',
+    'Email',
+    'Service Type',
+    'Phone Number',
+    'Address',
+    'Lot Size',
+    'Price ($)',
+    'Charged Date',
+    'Start Date',
+    'Payment Status'
+]
+LAST_COLUMN = chr(ord('A') + len(HEADERS) - 1)
+PRICE_COLUMN = HEADERS.index('Price ($)')
+DATE_COLUMNS = (HEADERS.index('Timestamp'), HEADERS.index('Charged Date'))
+# A run holds the lease this long; a crashed run frees it when it expires
+LEASE_SECONDS = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_format_state (
+    spreadsheet_id TEXT PRIMARY KEY,
+    formatted_rows INTEGER NOT NULL DEFAULT 0,
+    headers TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sheet_format_cleared (
+    spreadsheet_id TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    PRIMARY KEY (spreadsheet_id, row)
+);
+"""
+
+_lock = threading.Lock()
+
+
+class FormatInProgress(Exception):
+    pass
+
+
+def column(header):
+    """Column letter of a header, e.g. column('Price ($)') == 'H'."""
+    return chr(ord('A') + HEADERS.index(header))
+
+
+def _conn():
+    ensure_schema('sheet_format', SCHEMA)
+    return get_connection()
+
+
+def _is_empty(row):
+    return not any(str(cell).strip() for cell in row if cell is not None)
+
+
+def mark_cleared(row):
+    """Record a row whose cells were cleared, so the next run removes it."""
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'INSERT OR IGNORE INTO sheet_format_cleared (spreadsheet_id, row) VALUES (?, ?)',
+            (spreadsheet_id(), row)
+        )
+
+
+def reset():
+    """Forget all progress; the next run rescans and reformats the whole sheet."""
+    conn = _conn()
+    with conn:
+        conn.execute('DELETE FROM sheet_format_state WHERE spreadsheet_id = ?', (spreadsheet_id(),))
+        conn.execute('DELETE FROM sheet_format_cleared WHERE spreadsheet_id = ?', (spreadsheet_id(),))
+
+
+def state():
+    sid = spreadsheet_id()
+    conn = _conn()
+    row = conn.execute('SELECT * FROM sheet_format_state WHERE spreadsheet_id = ?', (sid,)).fetchone()
+    cleared = conn.execute('SELECT COUNT(*) FROM sheet_format_cleared WHERE spreadsheet_id = ?', (sid,)).fetchone()[0]
+    return {
+        'formatted_rows': row['formatted_rows'] if row else 0,
+        'headers_current': bool(row) and row['headers'] == '|'.join(HEADERS),
+        'pending_cleared_rows': cleared,
+        'updated_at': row['updated_at'] if row else None
+    }
+
+
+def _acquire_lease(sid, wait=0):
+    deadline = time.monotonic() + wait
+    conn = _conn()
+    while True:
+        now = time.time()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO sheet_format_state (spreadsheet_id) VALUES (?)', (sid,))
+            claimed = conn.execute(
+                'UPDATE sheet_format_state SET lease_until = ? WHERE spreadsheet_id = ? AND lease_until < ?',
+                (now + LEASE_SECONDS, sid, now)
+            ).rowcount
+        if claimed:
+            return conn.execute('SELECT * FROM sheet_format_state WHERE spreadsheet_id = ?', (sid,)).fetchone()
+        if time.monotonic() >= deadline:
+            raise FormatInProgress('Sheet formatting is already running')
+        time.sleep(min(0.5, max(deadline - time.monotonic(), 0)))
+
+
+@contextlib.contextmanager
+def lease(wait=0):
+    """
+    Hold the sheet's format lease, so no rows are deleted (and the rows below
+    renumbered) until the block exits. Anything that writes to a row by
+    number must find the row inside the lease. Yields the state row.
+    Raises FormatInProgress if another process still holds it after wait
+    seconds.
+    """
+    sid = spreadsheet_id()
+    with _lock:
+        state_row = _acquire_lease(sid, wait)
+        try:
+            yield state_row
+        finally:
+            conn = _conn()
+            with conn:
+                conn.execute('UPDATE sheet_format_state SET lease_until = 0 WHERE spreadsheet_id = ?', (sid,))
+
+
+# -- requests --------------------------------------------------------------
+
+def _grid_range(start_row, end_row, start_column=0, end_column=len(HEADERS)):
+    return {
+        'sheetId': SHEET_ID,
+        'startRowIndex': start_row,
+        'endRowIndex': end_row,
+        'startColumnIndex': start_column,
+        'endColumnIndex': end_column
+    }
+
+
+def _header_requests():
+    return [
+        {
+            'updateCells': {
+                'range': _grid_range(0, 1),
+                'rows': [{'values': [{'userEnteredValue': {'stringValue': h}} for h in HEADERS]}],
+                'fields': 'userEnteredValue'
+            }
+        },
+        {
+            'repeatCell': {
+                'range': _grid_range(0, 1),
+                'cell': {
+                    'userEnteredFormat': {
+                        'backgroundColor': {'red': 0.2, 'green': 0.5, 'blue': 0.3},
+                        'textFormat': {
+                            'bold': True,
+                            'foregroundColor': {'red': 1.0, 'green': 1.0, 'blue': 1.0}
+                        },
+                        'horizontalAlignment': 'CENTER',
+                        'verticalAlignment': 'MIDDLE'
+                    }
+                },
+                'fields': 'userEnteredFormat(backgroundColor,textFormat,horizontalAlignment,verticalAlignment)'
+            }
+        },
+        {
+            'updateSheetProperties': {
+                'properties': {'sheetId': SHEET_ID, 'gridProperties': {'frozenRowCount': 1}},
+                'fields': 'gridProperties.frozenRowCount'
+            }
+        }
+    ]
+
+
+def _row_format_requests(start_row, end_row):
+    """Formatting for data rows [start_row, end_row), 0-based."""
+    requests = [
+        {
+            'updateBorders': {
+                'range': _grid_range(max(start_row - 1, 0), end_row),
+                'top': {'style': 'SOLID'},
+                'bottom': {'style': 'SOLID'},
+                'left': {'style': 'SOLID'},
+                'right': {'style': 'SOLID'},
+                'innerHorizontal': {'style': 'SOLID'},
+                'innerVertical': {'style': 'SOLID'}
+            }
+        },
+        {
+            'repeatCell': {
+                'range': _grid_range(start_row, end_row),
+                'cell': {
+                    'userEnteredFormat': {'horizontalAlignment': 'CENTER', 'verticalAlignment': 'MIDDLE'}
+                },
+                'fields': 'userEnteredFormat(horizontalAlignment,verticalAlignment)'
+            }
+        },
+        {
+            'repeatCell': {
+                'range': _grid_range(start_row, end_row, PRICE_COLUMN, PRICE_COLUMN + 1),
+                'cell': {'userEnteredFormat': {'numberFormat': {'type': 'CURRENCY', 'pattern': '$#,##0.00'}}},
+                'fields': 'userEnteredFormat.numberFormat'
+            }
+        }
+    ]
+    for column in DATE_COLUMNS:
+        requests.append({
+            'repeatCell': {
+                'range': _grid_range(start_row, end_row, column, column + 1),
+                'cell': {'userEnteredFormat': {'numberFormat': {'type': 'DATE_TIME', 'pattern': 'yyyy-mm-dd hh:mm:ss'}}},
+                'fields': 'userEnteredFormat.numberFormat'
+            }
+        })
+    return requests
+
+
+def _delete_row_requests(rows):
+    """deleteDimension requests for 1-based rows, bottom up so indexes stay valid."""
+    return [
+        {
+            'deleteDimension': {
+                'range': {'sheetId': SHEET_ID, 'dimension': 'ROWS', 'startIndex': row - 1, 'endIndex': row}
+            }
+        }
+        for row in sorted(rows, reverse=True)
+    ]
+
+
+def _shift_after_delete(conn, sid, deleted, formatted_rows, skip=()):
+    """Move the watermark and pending cleared rows up past deleted rows."""
+    conn.execute(
+        'UPDATE sheet_format_state SET formatted_rows = ?, updated_at = ? WHERE spreadsheet_id = ?',
+        (formatted_rows - sum(1 for d in deleted if d <= formatted_rows), time.time(), sid)
+    )
+    pending = [
+        r['row'] for r in conn.execute('SELECT row FROM sheet_format_cleared WHERE spreadsheet_id = ?', (sid,))
+        if r['row'] not in skip
+    ]
+    conn.execute('DELETE FROM sheet_format_cleared WHERE spreadsheet_id = ?', (sid,))
+    conn.executemany(
+        'INSERT OR IGNORE INTO sheet_format_cleared (spreadsheet_id, row) VALUES (?, ?)',
+        [(sid, row - sum(1 for d in deleted if d < row)) for row in pending if row not in deleted]
+    )
+
+
+def _delete_rows(service, sid, rows, state_row):
+    """
+    Delete whole rows (1-based; the header row is never deleted) in one
+    batchUpdate, keeping the formatter's state in line with the shifted rows.
+    Must hold the lease.
+    """
+    rows = sorted({row for row in rows if row > 1})
+    if not rows:
+        return 0
+    service.spreadsheets().batchUpdate(
+        spreadsheetId=sid, body={'requests': _delete_row_requests(rows)}
+    ).execute()
+    row_index.invalidate()
+    conn = _conn()
+    with conn:
+        _shift_after_delete(conn, sid, rows, state_row['formatted_rows'])
+    return len(rows)
+
+
+def delete_customer_rows(service, emails, wait=0):
+    """
+    Delete the rows holding these emails. The rows are looked up inside the
+    lease, so none can move between the lookup and the delete.
+    Returns the number of rows deleted.
+    Raises FormatInProgress if the lease is still taken after wait seconds.
+    """
+    with lease(wait) as state_row:
+        rows = row_index.lookup_many(service, emails)
+        return _delete_rows(service, spreadsheet_id(), rows.values(), state_row)
+
+
+def clear_customer_rows(service, emails, wait=0):
+    """
+    Clear the rows holding these emails and record them for the next run to
+    remove. Looked up inside the lease, like delete_customer_rows.
+    Returns the cleared rows.
+    """
+    sid = spreadsheet_id()
+    with lease(wait):
+        rows = sorted(row for row in row_index.lookup_many(service, emails).values() if row > 1)
+        for row in rows:
+            service.spreadsheets().values().clear(
+                spreadsheetId=sid,
+                range=f'A{row}:{LAST_COLUMN}{row}'
+            ).execute()
+            row_index.record_clear(row)
+            mark_cleared(row)
+    return rows
+
+
+# -- run -------------------------------------------------------------------
+
+def _read_rows(service, sid, first_row):
+    """Rows first_row.. (1-based) of A:<last>, as {row: values}."""
+    result = service.spreadsheets().values().get(
+        spreadsheetId=sid,
+        range=f'A{first_row}:{LAST_COLUMN}'
+    ).execute()
+    return {first_row + i: row for i, row in enumerate(result.get('values', []))}
+
+
+def _read_cleared(service, sid, rows):
+    if not rows:
+        return {}
+    result = service.spreadsheets().values().batchGet(
+        spreadsheetId=sid,
+        ranges=[f'A{row}:{LAST_COLUMN}{row}' for row in rows]
+    ).execute()
+    return {row: (vr.get('values') or [[]])[0] for row, vr in zip(rows, result.get('valueRanges', []))}
+
+
+def run(service, full=False):
+    """
+    Compact and format whatever changed since the last run. With full=True
+    (or on the first run) the whole sheet is rescanned and reformatted.
+    """
+    with lease() as state_row:
+        return _run(service, spreadsheet_id(), state_row, full)
+
+
+def _run(service, sid, state_row, full):
+    conn = _conn()
+    formatted_rows = 0 if full else state_row['formatted_rows']
+    headers_current = not full and state_row['headers'] == '|'.join(HEADERS)
+    if formatted_rows == 0:
+        full = True
+        headers_current = False
+
+    cleared = [
+        r['row'] for r in conn.execute(
+            'SELECT row FROM sheet_format_cleared WHERE spreadsheet_id = ? ORDER BY row', (sid,)
+        )
+    ]
+
+    # Row 1 is the header row and is never deleted
+    tail = _read_rows(service, sid, max(formatted_rows + 1, 2))
+    recheck = [row for row in cleared if 1 < row <= formatted_rows]
+    candidates = {**_read_cleared(service, sid, recheck), **tail}
+    empty_rows = [row for row, values in candidates.items() if _is_empty(values)]
+    last_row = max([formatted_rows, 1] + list(tail))
+    # Trailing empty rows are just unused grid space; leave them alone
+    while last_row in empty_rows and last_row > formatted_rows:
+        empty_rows.remove(last_row)
+        last_row -= 1
+
+    deleted_above_mark = sum(1 for row in empty_rows if row <= formatted_rows)
+    total_rows = last_row - len(empty_rows)
+    format_from = max(formatted_rows - deleted_above_mark, 1)
+
+    requests = _delete_row_requests(empty_rows)
+    if not headers_current:
+        requests.extend(_header_requests())
+    if total_rows > format_from:
+        requests.extend(_row_format_requests(format_from, total_rows))
+    if not headers_current or total_rows > format_from:
+        requests.append({
+            'autoResizeDimensions': {
+                'dimensions': {'sheetId': SHEET_ID, 'dimension': 'COLUMNS', 'startIndex': 0, 'endIndex': len(HEADERS)}
+            }
+        })
+
+    if requests:
+        service.spreadsheets().batchUpdate(spreadsheetId=sid, body={'requests': requests}).execute()
+    if empty_rows:
+        row_index.invalidate()
+
+    deleted = sorted(empty_rows)
+    with conn:
+        # Cleared rows recorded while this run was in flight are still
+        # pending; shift them up past the rows that were just deleted
+        _shift_after_delete(conn, sid, deleted, 0, skip=cleared)
+        conn.execute(
+            'UPDATE sheet_format_state SET formatted_rows = ?, headers = ?, updated_at = ? WHERE spreadsheet_id = ?',
+            (total_rows, '|'.join(HEADERS), time.time(), sid)
+        )
+
+    summary = {
+        'mode': 'full' if full else 'incremental',
+        'rows_read': len(candidates),
+        'deleted_rows': len(deleted),
+        'formatted_rows': max(total_rows - format_from, 0),
+        'total_rows': total_rows,
+        'requests': len(requests)
+    }
+    logger.info("Sheet format run", extra={'summary': summary})
+    return summary
@@ -0,0 +1,193 @@
+import re
+import time
+import logging
+import threading
+
+from sheets_client import spreadsheet_id
+
+logger = logging.getLogger(__name__)
+
+EMAIL_COLUMN = 'C'
+# A miss may mean another worker appended the row, so a miss triggers a
+# rebuild, but never more often than this.
+MIN_REBUILD_INTERVAL = 5.0
+
+_RANGE_ROWS = re.compile(r'![A-Z]+(\d+)(?::[A-Z]+(\d+))?$')
+
+
+def _normalize(email):
+    return (email or '').strip().lower()
+
+
+def cell_matches(values, email):
+    """True if a one-cell values() result holds email."""
+    return bool(values and values[0] and _normalize(values[0][0]) == _normalize(email))
+
+
+def parse_range_rows(a1_range):
+    """Return (first_row, last_row) for an A1 range like 'Sheet1!A5:K7'."""
+    match = _RANGE_ROWS.search(a1_range or '')
+    if not match:
+        return None
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    return first, last
+
+
+class SheetRowIndex:
+    """
+    Maps customer email (and known customer ids) to 1-based sheet row numbers.
+
+    Built from a single read of the email column and kept current as rows are
+    appended or cleared, so single-row updates don't have to scan the sheet.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._customer_emails = {}
+        self._built_at = None
+
+    @property
+    def built(self):
+        return self._built_at is not None
+
+    @property
+    def recently_built(self):
+        """True if a rebuild now would be within MIN_REBUILD_INTERVAL of the last."""
+        return self._built_at is not None and time.monotonic() - self._built_at < MIN_REBUILD_INTERVAL
+
+    def __len__(self):
+        return len(self._rows)
+
+    def rebuild(self, service):
+        result = service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id(),
+            range=f'{EMAIL_COLUMN}:{EMAIL_COLUMN}'
+        ).execute()
+        self.load(result.get('values', []))
+
+    def load(self, values):
+        """Replace the index from the email column's values, as read from the sheet."""
+        rows = {}
+        for i, row in enumerate(values):
+            email = _normalize(row[0]) if row else ''
+            if email:
+                rows.setdefault(email, i + 1)
+        with self._lock:
+            self._rows = rows
+            self._built_at = time.monotonic()
+        logger.info("Built sheet row index with %s emails", len(rows))
+
+    def ensure_built(self, service):
+        if not self.built:
+            self.rebuild(service)
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    def register_customer(self, customer_id, email):
+        if customer_id and email:
+            with self._lock:
+                self._customer_emails[customer_id] = _normalize(email)
+
+    def find_row(self, email=None, customer_id=None):
+        with self._lock:
+            if not email and customer_id:
+                email = self._customer_emails.get(customer_id)
+            return self._rows.get(_normalize(email))
+
+    def _verify(self, service, row, email):
+        result = service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id(),
+            range=f'{EMAIL_COLUMN}{row}'
+        ).execute()
+        return cell_matches(result.get('values', []), email)
+
+    def lookup(self, service, email=None, customer_id=None):
+        """
+        Return the verified row for a customer, or None.
+
+        The indexed row is confirmed with a one-cell read before it is handed
+        out; if it no longer matches (another worker moved or cleared it) the
+        index is rebuilt once and the lookup retried.
+        """
+        self.ensure_built(service)
+        if not email and customer_id:
+            with self._lock:
+                email = self._customer_emails.get(customer_id)
+        if not email:
+            return None
+
+        row = self.find_row(email)
+        if row is not None and self._verify(service, row, email):
+            return row
+
+        if row is None and self.recently_built:
+            return None
+
+        self.rebuild(service)
+        row = self.find_row(email)
+        if row is not None and self._verify(service, row, email):
+            return row
+        return None
+
+    def _verify_many(self, service, rows):
+        """rows is {email: row}; returns the subset whose cells still match."""
+        if not rows:
+            return {}
+        emails = list(rows)
+        result = service.spreadsheets().values().batchGet(
+            spreadsheetId=spreadsheet_id(),
+            ranges=[f'{EMAIL_COLUMN}{rows[email]}' for email in emails]
+        ).execute()
+        verified = {}
+        for email, value_range in zip(emails, result.get('valueRanges', [])):
+            if cell_matches(value_range.get('values', []), email):
+                verified[email] = rows[email]
+        return verified
+
+    def lookup_many(self, service, emails):
+        """
+        Resolve many emails to verified rows with one batchGet. If any indexed
+        row turned out to be stale, or an email is missing (unless the index
+        was built within MIN_REBUILD_INTERVAL), the index is rebuilt once and
+        those emails retried.
+        Returns {email: row} for the emails found.
+        """
+        self.ensure_built(service)
+        emails = [email for email in dict.fromkeys(emails) if email]
+        rows = {email: self.find_row(email) for email in emails}
+        found = {email: row for email, row in rows.items() if row is not None}
+        verified = self._verify_many(service, found)
+        stale = len(verified) < len(found)
+        missing = len(found) < len(emails)
+        if not stale and (not missing or self.recently_built):
+            return verified
+
+        self.rebuild(service)
+        retry = {email: self.find_row(email) for email in emails if email not in verified}
+        verified.update(self._verify_many(service, {email: row for email, row in retry.items() if row is not None}))
+        return verified
+
+    def record_append(self, updated_range, emails):
+        """Index rows just written by values().append using its updatedRange."""
+        rows = parse_range_rows(updated_range)
+        if rows is None or not self.built:
+            return
+        first, _ = rows
+        with self._lock:
+            for offset, email in enumerate(emails):
+                key = _normalize(email)
+                if key:
+                    self._rows.setdefault(key, first + offset)
+
+    def record_clear(self, row):
+        with self._lock:
+            for email, indexed_row in list(self._rows.items()):
+                if indexed_row == row:
+                    del self._rows[email]
+
+
+row_index = SheetRowIndex()
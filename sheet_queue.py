@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import logging
+import threading
+from collections import deque
+
+import sheet_format
+from sheets_client import get_sheets_service, spreadsheet_id
+from sheet_index import row_index
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = os.getenv('SHEET_SPOOL_DIR', 'spool')
+BATCH_SIZE = int(os.getenv('SHEET_QUEUE_BATCH_SIZE', 50))
+FLUSH_INTERVAL = float(os.getenv('SHEET_QUEUE_FLUSH_INTERVAL', 2.0))
+RETRY_DELAY = float(os.getenv('SHEET_QUEUE_RETRY_DELAY', 10.0))
+APPEND_RANGE = f'A:{sheet_format.LAST_COLUMN}'
+EMAIL_INDEX = sheet_format.HEADERS.index('Email')
+
+
+class SheetWriteQueue:
+    """
+    Write-behind queue for sheet appends.
+
+    Rows are accepted immediately, written to a per-process spool file so they
+    survive a restart, and sent to Sheets by a background thread as one
+    multi-row values().append once BATCH_SIZE rows are waiting or the oldest
+    row has waited FLUSH_INTERVAL seconds.
+
+    The spool is an append-only JSONL log of {"seq", "row"} entries followed
+    by {"ack": seq} markers once a batch is written. Each process holds an
+    exclusive flock on its own spool, so a new process can tell a dead
+    worker's spool apart from a live one and take over its pending rows.
+    """
+
+    def __init__(self, spool_dir=SPOOL_DIR):
+        self.spool_dir = spool_dir
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = deque()
+        self._seq = 0
+        self._pid = None
+        self._spool = None
+        self._thread = None
+        self._stopping = False
+        self._oldest_at = None
+        self.flushed_rows = 0
+        self.flushed_batches = 0
+        self.failures = 0
+
+    # -- spool -------------------------------------------------------------
+
+    @staticmethod
+    def _read_spool(f):
+        rows = {}
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn write from a crash mid-line
+                continue
+            if 'ack' in entry:
+                for seq in [s for s in rows if s <= entry['ack']]:
+                    del rows[seq]
+            else:
+                rows[entry['seq']] = entry['row']
+        return [rows[seq] for seq in sorted(rows)]
+
+    def _claim_orphans(self):
+        recovered = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if not name.startswith('sheet-queue-'):
+                continue
+            f = open(path, 'r')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Owner is still alive
+                f.close()
+                continue
+            try:
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    # Another process claimed and removed it first
+                    continue
+                recovered.extend(self._read_spool(f))
+                os.unlink(path)
+            finally:
+                f.close()
+        if recovered:
+            logger.info("Recovered %s spooled sheet rows", len(recovered))
+        return recovered
+
+    def _write_spool(self, entry):
+        self._spool.write(json.dumps(entry) + '\n')
+        self._spool.flush()
+
+    def _start(self):
+        """Open this process's spool and start the writer. Must hold self._cond."""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        if self._spool is not None:
+            # Inherited from the parent across a fork
+            self._spool.close()
+        self._pid = os.getpid()
+        self._pending = deque()
+        self._seq = 0
+        self._oldest_at = None
+        self._stopping = False
+        # Claim before creating our own spool: a leftover file may carry our
+        # pid if the container restarted.
+        recovered = self._claim_orphans()
+        self._spool = open(os.path.join(self.spool_dir, f'sheet-queue-{self._pid}.jsonl'), 'w')
+        fcntl.flock(self._spool, fcntl.LOCK_EX)
+        for row in recovered:
+            self._push(row)
+        self._thread = threading.Thread(target=self._run, name='sheet-queue', daemon=True)
+        self._thread.start()
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._start()
+
+    def _push(self, row):
+        self._seq += 1
+        self._write_spool({'seq': self._seq, 'row': row})
+        self._pending.append((self._seq, row))
+        if self._oldest_at is None:
+            self._oldest_at = time.monotonic()
+
+    # -- public API --------------------------------------------------------
+
+    def start(self):
+        """
+        Start this process's writer (once per pid). Rows spooled by workers
+        that have since died are taken over now rather than on the first
+        enqueue, which may never come.
+        """
+        with self._cond:
+            self._ensure_started()
+
+    def enqueue(self, row):
+        """Accept a row for appending. Returns once it is spooled to disk."""
+        with self._cond:
+            self._ensure_started()
+            self._push(row)
+            if len(self._pending) >= BATCH_SIZE:
+                self._cond.notify()
+
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'flushed_rows': self.flushed_rows,
+            'flushed_batches': self.flushed_batches,
+            'failures': self.failures
+        }
+
+    def flush(self):
+        """Send one batch now. Returns the number of rows written."""
+        with self._flush_lock:
+            return self._flush_batch()
+
+    def _flush_batch(self):
+        with self._cond:
+            batch = list(self._pending)[:BATCH_SIZE]
+        if not batch:
+            return 0
+
+        rows = [row for _, row in batch]
+        service = get_sheets_service()
+        result = service.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id(),
+            range=APPEND_RANGE,
+            valueInputOption='RAW',
+            insertDataOption='INSERT_ROWS',
+            body={'values': rows}
+        ).execute()
+        row_index.record_append(
+            result.get('updates', {}).get('updatedRange'),
+            [row[EMAIL_INDEX] if len(row) > EMAIL_INDEX else '' for row in rows]
+        )
+
+        with self._cond:
+            for _ in batch:
+                self._pending.popleft()
+            self._write_spool({'ack': batch[-1][0]})
+            if self._pending:
+                self._oldest_at = time.monotonic()
+            else:
+                # Nothing outstanding, so the log can start over
+                self._oldest_at = None
+                self._spool.seek(0)
+                self._spool.truncate()
+            self.flushed_rows += len(batch)
+            self.flushed_batches += 1
+        logger.info("Appended %s queued rows to sheet", len(batch))
+        return len(batch)
+
+    def drain(self, timeout=30.0):
+        """Flush everything still queued, for graceful shutdown."""
+        if self._pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        while self._pending and time.monotonic() < deadline:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error draining sheet queue: %s", e)
+                time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+        if self._pending:
+            logger.warning("Sheet queue drain timed out; %s rows left in spool", len(self._pending))
+        return not self._pending
+
+    def _due(self):
+        if not self._pending:
+            return False
+        if len(self._pending) >= BATCH_SIZE:
+            return True
+        return time.monotonic() - self._oldest_at >= FLUSH_INTERVAL
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping and not self._due():
+                    if self._pending:
+                        wait = FLUSH_INTERVAL - (time.monotonic() - self._oldest_at)
+                        self._cond.wait(max(wait, 0.01))
+                    else:
+                        self._cond.wait()
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                self.failures += 1
+                logger.error("Error flushing sheet queue, retrying in %ss: %s", RETRY_DELAY, e)
+                time.sleep(RETRY_DELAY)
+
+
+sheet_queue = SheetWriteQueue()
+atexit.register(sheet_queue.drain)
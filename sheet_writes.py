@@ -0,0 +1,308 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+import sheet_format
+from sheets_client import get_sheets_service, spreadsheet_id
+from sheet_index import row_index
+
+logger = logging.getLogger(__name__)
+
+MAX_CELLS = int(os.getenv('SHEET_WRITES_MAX_CELLS', 200))
+FLUSH_INTERVAL = float(os.getenv('SHEET_WRITES_FLUSH_INTERVAL', 1.0))
+RETRY_DELAY = float(os.getenv('SHEET_WRITES_RETRY_DELAY', 5.0))
+MAX_ATTEMPTS = int(os.getenv('SHEET_WRITES_MAX_ATTEMPTS', 3))
+# How long a flush waits for a format run or row delete to finish
+LEASE_WAIT = float(os.getenv('SHEET_WRITES_LEASE_WAIT', 10.0))
+
+
+def _column_letters(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def merge(cells):
+    """
+    Fold {(row, column): value} into as few rectangular ranges as possible:
+    adjacent cells in a row become one run, and runs over the same columns
+    in consecutive rows become one block. Returns values.batchUpdate data.
+    """
+    runs = []
+    for row, column in sorted(cells):
+        run = runs[-1] if runs else None
+        if run and run['row'] == row and run['last'] == column - 1:
+            run['last'] = column
+            run['values'].append(cells[(row, column)])
+        else:
+            runs.append({'row': row, 'first': column, 'last': column, 'values': [cells[(row, column)]]})
+
+    blocks = []
+    open_blocks = {}
+    for run in runs:
+        span = (run['first'], run['last'])
+        block = open_blocks.get(span)
+        if block and block['last_row'] == run['row'] - 1:
+            block['last_row'] = run['row']
+            block['values'].append(run['values'])
+        else:
+            block = {'first_row': run['row'], 'last_row': run['row'], 'span': span, 'values': [run['values']]}
+            open_blocks[span] = block
+            blocks.append(block)
+
+    data = []
+    for block in blocks:
+        first, last = block['span']
+        a1_range = f"{_column_letters(first)}{block['first_row']}"
+        if (first, block['first_row']) != (last, block['last_row']):
+            a1_range += f":{_column_letters(last)}{block['last_row']}"
+        data.append({'range': a1_range, 'values': block['values']})
+    return data
+
+
+class SheetWriteBuffer:
+    """
+    Coalescing buffer for cell updates to existing sheet rows.
+
+    write() records a value for a customer's cell, addressed by email and
+    column header, and returns a Future at once. A later write to the same
+    cell replaces the earlier one before anything is sent. A background
+    thread sends everything waiting after FLUSH_INTERVAL seconds, or as soon
+    as MAX_CELLS cells are waiting, as one values.batchUpdate per value
+    input option with adjacent cells merged into ranges.
+
+    Rows are resolved at flush time, inside the sheet's format lease, so no
+    rows can be deleted (and the rows below renumbered) between finding a
+    row and writing to it. Futures resolve to the row written, or None if the
+    email has no row. After MAX_ATTEMPTS failed flushes in a row the waiting
+    cells are dropped and their futures get the error; a flush that only
+    found the lease taken is retried without counting as a failure.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._cells = {}
+        self._futures = []
+        self._pid = None
+        self._thread = None
+        self._stopping = False
+        self._oldest_at = None
+        self._attempts = 0
+        self.writes = 0
+        self.coalesced_cells = 0
+        self.flushes = 0
+        self.flushed_writes = 0
+        self.flushed_cells = 0
+        self.flushed_ranges = 0
+        self.unmatched_writes = 0
+        self.failures = 0
+        self.dropped_cells = 0
+        self._flush_sizes = deque(maxlen=500)
+
+    def _start(self):
+        """Start this process's flusher. Must hold self._cond."""
+        self._pid = os.getpid()
+        self._cells = {}
+        self._futures = []
+        self._oldest_at = None
+        self._stopping = False
+        self._attempts = 0
+        self._thread = threading.Thread(target=self._run, name='sheet-writes', daemon=True)
+        self._thread.start()
+
+    # -- public API --------------------------------------------------------
+
+    def write(self, email, header, value, value_input_option='USER_ENTERED'):
+        """Queue value for the header's column in email's row. Returns a Future."""
+        email = (email or '').strip().lower()
+        if not email:
+            raise ValueError('A sheet write needs the row\'s email')
+        key = (value_input_option, email, sheet_format.HEADERS.index(header))
+        future = Future()
+        with self._cond:
+            if self._pid != os.getpid():
+                self._start()
+            if key in self._cells:
+                self.coalesced_cells += 1
+            self._cells[key] = value
+            self._futures.append((key, future))
+            self.writes += 1
+            if self._oldest_at is None:
+                self._oldest_at = time.monotonic()
+            if len(self._cells) >= MAX_CELLS:
+                self._cond.notify()
+        return future
+
+    def pending(self):
+        return len(self._cells)
+
+    def stats(self):
+        sizes = sorted(self._flush_sizes)
+        return {
+            'pending_cells': self.pending(),
+            'writes': self.writes,
+            'coalesced_cells': self.coalesced_cells,
+            'flushes': self.flushes,
+            'flushed_cells': self.flushed_cells,
+            'flushed_ranges': self.flushed_ranges,
+            'writes_per_flush': round(self.flushed_writes / self.flushes, 2) if self.flushes else None,
+            'flush_cells': {
+                'mean': round(sum(sizes) / len(sizes), 2) if sizes else None,
+                'p50': sizes[len(sizes) // 2] if sizes else None,
+                'max': sizes[-1] if sizes else None
+            },
+            'unmatched_writes': self.unmatched_writes,
+            'failures': self.failures,
+            'dropped_cells': self.dropped_cells
+        }
+
+    def flush(self):
+        """Send everything waiting now. Returns the number of cells written."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._cond:
+            cells, futures = self._cells, self._futures
+            self._cells, self._futures = {}, []
+            self._oldest_at = None
+        if not cells:
+            return 0
+
+        rows = {}
+        size = 0
+        ranges = 0
+        try:
+            service = get_sheets_service()
+            with sheet_format.lease(wait=LEASE_WAIT):
+                rows = row_index.lookup_many(service, list({email for _, email, _ in cells}))
+                by_option = {}
+                for key, value in list(cells.items()):
+                    option, email, column = key
+                    if email in rows:
+                        by_option.setdefault(option, {})[(rows[email], column)] = value
+                    else:
+                        # No row to write to; its futures resolve to None
+                        del cells[key]
+                for option, option_cells in sorted(by_option.items()):
+                    data = merge(option_cells)
+                    service.spreadsheets().values().batchUpdate(
+                        spreadsheetId=spreadsheet_id(),
+                        body={'valueInputOption': option, 'data': data}
+                    ).execute()
+                    size += len(option_cells)
+                    ranges += len(data)
+                    # Written; a retry of the rest must not send these again
+                    for key in [key for key in cells if key[0] == option]:
+                        del cells[key]
+        except Exception as e:
+            # Writes an earlier batchUpdate already made are done; only the
+            # rest go back in the buffer
+            done = [(key, future) for key, future in futures if key not in cells]
+            self._requeue(cells, [(key, future) for key, future in futures if key in cells], e,
+                          failed=not isinstance(e, sheet_format.FormatInProgress))
+            if done:
+                self._settle(done, rows, size, ranges)
+            raise
+
+        with self._cond:
+            self._attempts = 0
+        self._settle(futures, rows, size, ranges)
+        logger.debug("Wrote %s buffered cells in %s ranges", size, ranges)
+        return size
+
+    def _settle(self, futures, rows, size, ranges):
+        """Count a flush that wrote size cells and resolve its writes' futures."""
+        unmatched = [key[1] for key, _ in futures if key[1] not in rows]
+        if unmatched:
+            logger.warning("Dropped sheet writes for %s emails with no row: %s",
+                           len(set(unmatched)), sorted(set(unmatched)))
+        with self._cond:
+            self.flushes += 1
+            self.flushed_writes += len(futures)
+            self.flushed_cells += size
+            self.flushed_ranges += ranges
+            self.unmatched_writes += len(unmatched)
+            self._flush_sizes.append(size)
+        metrics.SHEET_WRITE_FLUSH_CELLS.observe(size)
+        for key, future in futures:
+            future.set_result(rows.get(key[1]))
+
+    def _requeue(self, cells, futures, error, failed=True):
+        with self._cond:
+            if failed:
+                self.failures += 1
+                self._attempts += 1
+            if self._attempts >= MAX_ATTEMPTS:
+                self.dropped_cells += len(cells)
+                self._attempts = 0
+                logger.error("Dropping %s buffered sheet cells after %s failed flushes: %s",
+                             len(cells), MAX_ATTEMPTS, error)
+                for _, future in futures:
+                    future.set_exception(error)
+                return
+            for key, value in cells.items():
+                # A newer write to the same cell wins over the failed one
+                self._cells.setdefault(key, value)
+            self._futures[:0] = futures
+            if self._oldest_at is None:
+                self._oldest_at = time.monotonic()
+
+    def drain(self, timeout=10.0):
+        """Flush whatever is waiting, for graceful shutdown."""
+        if self._pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        while self._cells and time.monotonic() < deadline:
+            try:
+                self.flush()
+            except sheet_format.FormatInProgress as e:
+                logger.info("Sheet writes waiting for the format lease: %s", e)
+            except Exception as e:
+                logger.error("Error draining sheet writes: %s", e)
+                time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+        if self._cells:
+            logger.warning("Sheet write drain timed out; %s cells not written", len(self._cells))
+        return not self._cells
+
+    def _due(self):
+        if not self._cells:
+            return False
+        if len(self._cells) >= MAX_CELLS:
+            return True
+        return time.monotonic() - self._oldest_at >= FLUSH_INTERVAL
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping and not self._due():
+                    if self._cells:
+                        wait = FLUSH_INTERVAL - (time.monotonic() - self._oldest_at)
+                        self._cond.wait(max(wait, 0.01))
+                    else:
+                        self._cond.wait()
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except sheet_format.FormatInProgress as e:
+                logger.info("Sheet writes waiting for the format lease: %s", e)
+            except Exception as e:
+                logger.error("Error flushing sheet writes, retrying in %ss: %s", RETRY_DELAY, e)
+                time.sleep(RETRY_DELAY)
+
+
+sheet_writes = SheetWriteBuffer()
+atexit.register(sheet_writes.drain)
@@ -0,0 +1,186 @@
+import os
+import json
+import datetime
+import logging
+import threading
+
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+# Refresh the OAuth token this long before it expires so no request ever
+# has to wait on a token fetch.
+TOKEN_REFRESH_MARGIN = datetime.timedelta(seconds=int(os.getenv('SHEETS_TOKEN_REFRESH_MARGIN', 300)))
+HTTP_TIMEOUT = int(os.getenv('SHEETS_HTTP_TIMEOUT', 30))
+DEFAULT_SPREADSHEET_ID = '19AqlhJ54zBXsED3J3vkY8_WolSnundLakNdfBAJdMXA'
+# Point the client at another Sheets endpoint (e.g. the benchmark fake) and
+# authenticate with a fixed bearer token instead of the service account
+API_ROOT = os.getenv('SHEETS_API_ROOT', 'https://sheets.googleapis.com/')
+ACCESS_TOKEN = os.getenv('SHEETS_ACCESS_TOKEN')
+
+_lock = threading.Lock()
+_local = threading.local()
+_state = {
+    'pid': None,
+    'credentials': None,
+    'discovery': None,
+    'token_session': None,
+    'generation': 0,
+    'token_refreshes': 0,
+    'services_built': 0
+}
+
+
+def spreadsheet_id():
+    return os.getenv('GOOGLE_SHEETS_ID', DEFAULT_SPREADSHEET_ID)
+
+
+def configured():
+    """True if there is something to authenticate with."""
+    return bool(ACCESS_TOKEN or os.getenv('GOOGLE_SHEETS_PRIVATE_KEY'))
+
+
+# The Google auth and API client libraries take a good share of app import
+# time, so they are imported on first use (or by the startup warm-up).
+
+def _build_credentials():
+    """Build service-account credentials from the GOOGLE_SHEETS_* env vars."""
+    if ACCESS_TOKEN:
+        from google.oauth2.credentials import Credentials
+        return Credentials(ACCESS_TOKEN, expiry=datetime.datetime.max)
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_info({
+        "type": "service_account",
+        "project_id": "lawn-quote-calculator",
+        "private_key_id": os.getenv('GOOGLE_SHEETS_PRIVATE_KEY_ID'),
+        "private_key": os.getenv('GOOGLE_SHEETS_PRIVATE_KEY').replace('\\n', '\n'),
+        "client_email": os.getenv('GOOGLE_SHEETS_CLIENT_EMAIL'),
+        "client_id": os.getenv('GOOGLE_SHEETS_CLIENT_ID'),
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+        "client_x509_cert_url": os.getenv('GOOGLE_SHEETS_CLIENT_X509_CERT_URL')
+    }, scopes=SCOPES)
+
+
+def _load_discovery_document():
+    """
+    Load the Sheets v4 discovery document from disk instead of fetching it.
+    SHEETS_DISCOVERY_DOC may point at a pinned copy; otherwise the document
+    bundled with google-api-python-client is used.
+    """
+    path = os.getenv('SHEETS_DISCOVERY_DOC')
+    if path and os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    from googleapiclient.discovery_cache import get_static_doc
+    document = get_static_doc('sheets', 'v4')
+    if document is None:
+        raise Exception("Sheets v4 discovery document not found")
+    return json.loads(document)
+
+
+class TimedHttp:
+    """Wraps an AuthorizedHttp and records each Sheets call in the upstream metrics."""
+
+    def __init__(self, http):
+        self.http = http
+
+    def request(self, uri, method='GET', *args, **kwargs):
+        with metrics.upstream_call('sheets', metrics.sheets_method(uri, method), method) as call:
+            response, content = self.http.request(uri, method, *args, **kwargs)
+            call.status = response.status
+            return response, content
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+
+def _reset():
+    """Drop all cached state. Called in forked children and when the pid changes."""
+    global _lock
+    _lock = threading.Lock()
+    _state['pid'] = os.getpid()
+    _state['credentials'] = None
+    _state['token_session'] = None
+    _state['generation'] += 1
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
+
+
+def _check_pid():
+    if _state['pid'] != os.getpid():
+        _reset()
+
+
+def _token_needs_refresh(credentials):
+    if not credentials.token or credentials.expiry is None:
+        return True
+    return credentials.expiry - datetime.datetime.utcnow() < TOKEN_REFRESH_MARGIN
+
+
+def get_credentials():
+    """Return the shared credentials, refreshing the token only when it is close to expiry."""
+    _check_pid()
+    credentials = _state['credentials']
+    if credentials is not None and not _token_needs_refresh(credentials):
+        return credentials
+
+    with _lock:
+        credentials = _state['credentials']
+        if credentials is None:
+            credentials = _build_credentials()
+            _state['credentials'] = credentials
+        if _token_needs_refresh(credentials):
+            from google.auth.transport.requests import Request
+            if _state['token_session'] is None:
+                _state['token_session'] = requests.Session()
+            credentials.refresh(Request(session=_state['token_session']))
+            _state['token_refreshes'] += 1
+            logger.info("Refreshed Google Sheets token, expires at %s", credentials.expiry)
+        return credentials
+
+
+def get_sheets_service():
+    """
+    Return a Sheets service for the calling thread.
+
+    httplib2 connections are not thread-safe, so each thread keeps its own
+    keep-alive connection and service object, all sharing one set of
+    credentials and one parsed discovery document.
+    """
+    credentials = get_credentials()
+
+    service = getattr(_local, 'service', None)
+    if service is not None and getattr(_local, 'generation', None) == _state['generation']:
+        return service
+
+    if _state['discovery'] is None:
+        with _lock:
+            if _state['discovery'] is None:
+                _state['discovery'] = _load_discovery_document()
+
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build_from_document
+    http = TimedHttp(google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT)))
+    service = build_from_document(_state['discovery'], http=http, client_options={'api_endpoint': API_ROOT})
+    _local.service = service
+    _local.generation = _state['generation']
+    _state['services_built'] += 1
+    return service
+
+
+def stats():
+    credentials = _state['credentials']
+    return {
+        'token_refreshes': _state['token_refreshes'],
+        'services_built': _state['services_built'],
+        'token_expiry': credentials.expiry.isoformat() if credentials is not None and credentials.expiry else None
+    }
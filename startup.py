@@ -0,0 +1,94 @@
+"""
+Startup timing and post-boot warm-up.
+
+app.py marks the end of each step of its import with `checkpoint(name)`,
+so the log shows where a cold start goes and /startup/stats reports it per
+process. Once the app is importable, `start()` runs a warm-up thread
+(STARTUP_WARMUP=0 turns it off) that does the first request's work ahead
+of it: importing the Google client libraries, fetching the Sheets token,
+building the row index and opening a pooled Stripe connection. Each step
+is timed as a phase too; a failed step is logged and skipped.
+"""
+import os
+import time
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+WARMUP = os.getenv('STARTUP_WARMUP', '1') == '1'
+
+_started = time.perf_counter()
+_last = [_started]
+_phases = []
+_state = {'pid': None, 'ready_ms': None, 'warmup': 'pending' if WARMUP else 'disabled', 'warmup_ms': None}
+_lock = threading.Lock()
+
+
+def _record(name, start, end):
+    with _lock:
+        _phases.append((name, round((end - start) * 1000, 1)))
+
+
+def checkpoint(name):
+    """Record the time since the previous checkpoint (or since this module loaded) as a phase."""
+    now = time.perf_counter()
+    _record(name, _last[0], now)
+    _last[0] = now
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the enclosed block as one startup phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, start, time.perf_counter())
+
+
+def ready():
+    """Mark the app importable and log the phase breakdown."""
+    _state['ready_ms'] = round((time.perf_counter() - _started) * 1000, 1)
+    with _lock:
+        summary = ', '.join(f'{name} {ms:.0f}ms' for name, ms in _phases)
+    logger.info("Started in %.0fms: %s", _state['ready_ms'], summary)
+
+
+def warm_up(steps):
+    """Run (name, fn) steps in order, timing each."""
+    start = time.perf_counter()
+    _state['warmup'] = 'running'
+    for name, fn in steps:
+        try:
+            with phase(f'warmup.{name}'):
+                fn()
+        except Exception as e:
+            logger.warning("Warm-up step %s failed: %s", name, e)
+    _state['warmup_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    _state['warmup'] = 'done'
+    logger.info("Warm-up finished in %.0fms", _state['warmup_ms'])
+
+
+def start(steps):
+    """Start this process's warm-up thread (once per pid)."""
+    if not WARMUP or _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        _state['pid'] = os.getpid()
+    threading.Thread(target=warm_up, args=(steps,), name='warmup', daemon=True).start()
+
+
+def stats():
+    with _lock:
+        phases = dict(_phases)
+    return {
+        'pid': os.getpid(),
+        'ready_ms': _state['ready_ms'],
+        'phases_ms': phases,
+        'warmup': _state['warmup'],
+        'warmup_ms': _state['warmup_ms']
+    }
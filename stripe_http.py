@@ -0,0 +1,209 @@
+"""
+Pooled HTTP client for the Stripe SDK.
+
+One keep-alive session per process with a connection pool sized for every
+thread that talks to Stripe, (connect, read) timeouts per kind of operation,
+and retries with jittered backoff for calls that are safe to repeat. Stats
+count requests against new connections, so TLS handshakes show up directly.
+"""
+import os
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from stripe._http_client import RequestsClient
+
+import metrics
+from stripe_lookup import LOOKUP_WORKERS
+from stripe_scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+# Request threads per gunicorn worker, plus the largest fan-out pool
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', 4))
+POOL_SIZE = int(os.getenv('STRIPE_POOL_SIZE', GUNICORN_THREADS + LOOKUP_WORKERS))
+MAX_NETWORK_RETRIES = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+CONNECT_TIMEOUT = float(os.getenv('STRIPE_CONNECT_TIMEOUT', 3.05))
+# Read timeouts by operation; confirming a payment can legitimately take a while
+READ_TIMEOUTS = {
+    'read': float(os.getenv('STRIPE_READ_TIMEOUT', 10)),
+    'write': float(os.getenv('STRIPE_WRITE_TIMEOUT', 20)),
+    'payment': float(os.getenv('STRIPE_PAYMENT_TIMEOUT', 40))
+}
+SAFE_METHODS = frozenset({'get', 'head', 'options', 'delete'})
+
+
+def operation(method, url):
+    """Classify a Stripe API call as 'read', 'write' or 'payment'."""
+    method = method.lower()
+    if method in ('get', 'head'):
+        return 'read'
+    if '/v1/payment_intents' in url or '/v1/charges' in url:
+        return 'payment'
+    return 'write'
+
+
+class PooledStripeClient(RequestsClient):
+    name = 'pooled-requests'
+    INITIAL_DELAY = float(os.getenv('STRIPE_RETRY_INITIAL_DELAY', 0.25))
+    MAX_DELAY = float(os.getenv('STRIPE_RETRY_MAX_DELAY', 2.0))
+
+    def __init__(self, pool_size=POOL_SIZE, **kwargs):
+        self.pool_size = pool_size
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        super().__init__(session=self._new_session(), **kwargs)
+
+    # The SDK reads self._timeout inside each request; keep it per thread so
+    # concurrent calls of different kinds don't overwrite each other's
+    @property
+    def _timeout(self):
+        return getattr(self._thread_local, 'timeout', None) or self._default_timeout
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._default_timeout = value
+
+    def _new_session(self):
+        session = requests.Session()
+        # Stripe's own retry logic decides what to retry, so urllib3 doesn't
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _reset_stats(self):
+        self._counts = {'requests': 0, 'retries': 0, 'errors': 0, 'retry_sleep_ms': 0.0}
+        self._by_operation = defaultdict(lambda: {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        self._latencies = deque(maxlen=2000)
+
+    def reset(self):
+        """New session and stats; used in forked children so no socket is shared."""
+        self._session = self._new_session()
+        self._thread_local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _request_internal(self, method, url, headers, post_data, is_streaming):
+        op = operation(method, url)
+        self._thread_local.call = (method.lower(), headers)
+        self._thread_local.timeout = (CONNECT_TIMEOUT, READ_TIMEOUTS[op])
+        # Every attempt, retries included, waits for a rate limit token
+        scheduler.acquire(method)
+        start = time.perf_counter()
+        failed = True
+        with metrics.upstream_call('stripe', metrics.stripe_resource(url), method) as call:
+            try:
+                response = super()._request_internal(method, url, headers, post_data, is_streaming)
+                call.status = response[1]
+                failed = response[1] >= 500
+                if response[1] == 429:
+                    scheduler.throttle(method, self._retry_after_header(response))
+                return response
+            finally:
+                self._record(op, (time.perf_counter() - start) * 1000, failed)
+
+    def _record(self, op, elapsed, failed):
+        with self._stats_lock:
+            self._counts['requests'] += 1
+            stats = self._by_operation[op]
+            stats['count'] += 1
+            stats['total_ms'] += elapsed
+            stats['max_ms'] = max(stats['max_ms'], elapsed)
+            if failed:
+                self._counts['errors'] += 1
+                stats['errors'] += 1
+            self._latencies.append(elapsed)
+
+    def _should_retry(self, response, api_connection_error, num_retries):
+        method, headers = getattr(self._thread_local, 'call', ('get', {}))
+        # Only repeat calls that can't apply twice: reads, deletes, and
+        # writes carrying an idempotency key (the SDK adds one to every POST)
+        if method not in SAFE_METHODS and 'Idempotency-Key' not in (headers or {}):
+            return False
+        retry = super()._should_retry(response, api_connection_error, num_retries)
+        if not retry and response is not None and response[1] == 429:
+            retry = num_retries < self._max_network_retries()
+        if retry:
+            with self._stats_lock:
+                self._counts['retries'] += 1
+        return retry
+
+    def _sleep_time_seconds(self, num_retries, response=None):
+        # The SDK's version hardcodes its own class delays; use ours, with
+        # jitter in [delay/2, delay], but never shorter than Retry-After
+        sleep_seconds = self._add_jitter_time(min(self.INITIAL_DELAY * 2 ** (num_retries - 1), self.MAX_DELAY))
+        retry_after = self._retry_after_header(response) or 0
+        if retry_after <= self.MAX_RETRY_AFTER:
+            sleep_seconds = max(retry_after, sleep_seconds)
+        with self._stats_lock:
+            self._counts['retry_sleep_ms'] += sleep_seconds * 1000
+        return sleep_seconds
+
+    def _connection_counts(self):
+        opened = 0
+        pooled_requests = 0
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                pooled_requests += pool.num_requests
+        return opened, pooled_requests
+
+    def stats(self):
+        opened, pooled_requests = self._connection_counts()
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1)
+
+        with self._stats_lock:
+            by_operation = {
+                op: {
+                    'count': s['count'],
+                    'errors': s['errors'],
+                    'avg_ms': round(s['total_ms'] / s['count'], 1) if s['count'] else None,
+                    'max_ms': round(s['max_ms'], 1)
+                }
+                for op, s in self._by_operation.items()
+            }
+            counts = dict(self._counts)
+        counts['retry_sleep_ms'] = round(counts['retry_sleep_ms'], 1)
+        return {
+            **counts,
+            'pool_size': self.pool_size,
+            'connections_opened': opened,
+            'connection_reuse_rate': round(1 - opened / pooled_requests, 3) if pooled_requests else None,
+            'timeouts': {'connect': CONNECT_TIMEOUT, **READ_TIMEOUTS},
+            'max_network_retries': stripe.max_network_retries,
+            'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99)},
+            'by_operation': by_operation
+        }
+
+
+_state = {'client': None}
+
+
+def install():
+    """Make the pooled client the SDK's default for this process."""
+    if _state['client'] is None:
+        client = PooledStripeClient()
+        _state['client'] = client
+        stripe.default_http_client = client
+        stripe.max_network_retries = MAX_NETWORK_RETRIES
+        os.register_at_fork(after_in_child=client.reset)
+        logger.info("Stripe HTTP pool: %s connections, %s retries", POOL_SIZE, MAX_NETWORK_RETRIES)
+    return _state['client']
+
+
+def client():
+    return _state['client']
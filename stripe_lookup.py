@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import stripe
+
+import stripe_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on concurrent PaymentMethod.list calls; Stripe allows ~100 req/s
+# in live mode, so keep well under that for a single dashboard request.
+LOOKUP_WORKERS = int(os.getenv('STRIPE_LOOKUP_WORKERS', 8))
+PAGE_SIZE = 100
+
+
+class UpstreamTimer:
+    """
+    Counts calls to Stripe and the time spent waiting on them.
+
+    time_ms is wall-clock time with at least one call in flight, so calls
+    made concurrently are not counted twice; call_time_ms is the sum of the
+    individual call durations.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._busy_since = None
+        self.calls = 0
+        self.seconds = 0.0
+        self.wall_seconds = 0.0
+
+    @contextlib.contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        with self._lock:
+            if self._in_flight == 0:
+                self._busy_since = start
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.calls += 1
+                self.seconds += end - start
+                self._in_flight -= 1
+                if self._in_flight == 0:
+                    self.wall_seconds += end - self._busy_since
+
+    def call(self, fn, *args, **kwargs):
+        with self.measure():
+            return fn(*args, **kwargs)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'time_ms': round(self.wall_seconds * 1000, 1),
+            'call_time_ms': round(self.seconds * 1000, 1)
+        }
+
+
+def iter_customers(timer=None, **params):
+    """
+    Yield every Stripe customer, following pagination past the 100 item cap.
+    The default payment method is expanded so most customers need no extra call.
+    """
+    timer = timer or UpstreamTimer()
+    params.setdefault('limit', PAGE_SIZE)
+    params.setdefault('expand', ['data.invoice_settings.default_payment_method'])
+
+    starting_after = None
+    while True:
+        if starting_after:
+            params['starting_after'] = starting_after
+        page = timer.call(stripe.Customer.list, **params)
+        for customer in page.data:
+            yield customer
+        if not page.has_more or not page.data:
+            break
+        starting_after = page.data[-1].id
+
+
+def has_expanded_payment_method(customer):
+    """
+    True if the customer's expanded default payment method is a card. Anything
+    else (no default, a legacy default_source, another type) is checked with a
+    card listing, so only cards count.
+    """
+    invoice_settings = customer.get('invoice_settings') or {}
+    payment_method = invoice_settings.get('default_payment_method')
+    return isinstance(payment_method, dict) and payment_method.get('type') == 'card'
+
+
+def payment_method_presence(customers, timer=None, max_workers=None):
+    """
+    Return {customer_id: bool} saying whether each customer has a card on file.
+
+    Customers whose default payment method came back expanded are answered
+    without another request; the rest are looked up on a bounded thread pool.
+    """
+    timer = timer or UpstreamTimer()
+    presence = {}
+    pending = []
+    for customer in customers:
+        if has_expanded_payment_method(customer):
+            presence[customer.id] = True
+        else:
+            pending.append(customer.id)
+
+    if not pending:
+        return presence
+
+    def lookup(customer_id):
+        payment_methods = timer.call(
+            stripe.PaymentMethod.list,
+            customer=customer_id,
+            type='card',
+            limit=1
+        )
+        return customer_id, len(payment_methods.data) > 0
+
+    workers = min(max_workers or LOOKUP_WORKERS, len(pending))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pm-lookup') as pool:
+        for customer_id, has_payment_method in pool.map(stripe_scheduler.bind(lookup), pending):
+            presence[customer_id] = has_payment_method
+
+    logger.info("Payment method lookup: %s from expansion, %s fetched", len(customers) - len(pending), len(pending))
+    return presence
@@ -0,0 +1,198 @@
+"""
+Outbound Stripe call scheduler.
+
+Every request the pooled client sends first takes a token from the read or
+write bucket. Calls made by customers (checkout, setup intents) are
+'interactive'. Admin fan-out, bulk jobs and background sync are 'batch'.
+A batch call waits while any interactive call is waiting for the same
+bucket, and it may not dip into a reserve kept for interactive calls. A 429
+closes the bucket until its Retry-After has passed.
+
+Budgets are per process; set them to Stripe's limit divided by the number
+of gunicorn workers.
+"""
+import os
+import time
+import asyncio
+import threading
+import contextlib
+from collections import deque
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, BATCH)
+
+READ_RATE = float(os.getenv('STRIPE_READ_RATE', 20))
+WRITE_RATE = float(os.getenv('STRIPE_WRITE_RATE', 20))
+# Share of each bucket only interactive calls may use
+INTERACTIVE_RESERVE = float(os.getenv('STRIPE_INTERACTIVE_RESERVE', 0.2))
+# Backoff for a 429 that carries no Retry-After
+DEFAULT_RETRY_AFTER = 1.0
+
+_local = threading.local()
+
+
+def current_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(name):
+    """Run the enclosed Stripe calls at the given priority on this thread."""
+    previous = current_priority()
+    _local.priority = name
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def bind(fn, name=None):
+    """Wrap fn to run at the caller's priority (or name) on another thread, e.g. in a pool."""
+    name = name or current_priority()
+
+    def bound(*args, **kwargs):
+        with priority(name):
+            return fn(*args, **kwargs)
+    return bound
+
+
+class TokenBucket:
+    def __init__(self, name, rate, reserve=INTERACTIVE_RESERVE):
+        self.name = name
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.reserve = self.capacity * reserve
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiting = {p: 0 for p in PRIORITIES}
+        self.acquired = {p: 0 for p in PRIORITIES}
+        self.waits = {p: deque(maxlen=1000) for p in PRIORITIES}
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self, priority, now):
+        """Seconds until this caller may take a token, or 0 if it may now."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        floor = 1.0
+        if priority == BATCH:
+            if self.waiting[INTERACTIVE]:
+                return 1.0 / self.rate
+            floor += self.reserve
+        if self.tokens >= floor:
+            return 0
+        return (floor - self.tokens) / self.rate
+
+    def _take(self, priority, start):
+        """Take a token for a caller that has been waiting since start; holds _cond."""
+        self.tokens -= 1
+        self.acquired[priority] += 1
+        waited = time.monotonic() - start
+        self.waits[priority].append(waited)
+        return waited
+
+    def acquire(self, priority=INTERACTIVE):
+        start = time.monotonic()
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = self._delay(priority, now)
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+            finally:
+                self.waiting[priority] -= 1
+            waited = self._take(priority, start)
+            # Let a waiting batch caller re-check once interactive demand drains
+            self._cond.notify_all()
+        return waited
+
+    async def acquire_async(self, priority=INTERACTIVE):
+        """acquire() for coroutines: sleeps on the event loop instead of blocking a thread."""
+        start = time.monotonic()
+        with self._cond:
+            self.waiting[priority] += 1
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = self._delay(priority, now)
+                    if delay <= 0:
+                        self.waiting[priority] -= 1
+                        waited = self._take(priority, start)
+                        self._cond.notify_all()
+                        return waited
+                await asyncio.sleep(delay)
+        except BaseException:
+            with self._cond:
+                self.waiting[priority] -= 1
+            raise
+
+    def throttle(self, retry_after=None):
+        """Stop handing out tokens after a 429, for Retry-After seconds."""
+        with self._cond:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + (retry_after or DEFAULT_RETRY_AFTER))
+            self.tokens = 0
+
+    def stats(self):
+        def summary(waits):
+            waits = sorted(waits)
+            if not waits:
+                return {'count': 0, 'avg_ms': None, 'p95_ms': None, 'max_ms': None}
+            return {
+                'count': len(waits),
+                'avg_ms': round(sum(waits) / len(waits) * 1000, 1),
+                'p95_ms': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1),
+                'max_ms': round(waits[-1] * 1000, 1)
+            }
+
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'rate_per_second': self.rate,
+                'tokens': round(self.tokens, 2),
+                'blocked_for_s': round(max(self.blocked_until - time.monotonic(), 0), 2),
+                'throttled': self.throttled,
+                'waiting': dict(self.waiting),
+                'acquired': dict(self.acquired),
+                'queue_wait': {p: summary(self.waits[p]) for p in PRIORITIES}
+            }
+
+
+class StripeScheduler:
+    def __init__(self, read_rate=READ_RATE, write_rate=WRITE_RATE):
+        self.buckets = {'read': TokenBucket('read', read_rate), 'write': TokenBucket('write', write_rate)}
+
+    def bucket(self, method):
+        return self.buckets['read' if method.lower() in ('get', 'head') else 'write']
+
+    def acquire(self, method):
+        return self.bucket(method).acquire(current_priority())
+
+    async def acquire_async(self, method, priority=INTERACTIVE):
+        # Coroutines share a thread, so the priority is passed, not thread-local
+        return await self.bucket(method).acquire_async(priority)
+
+    def throttle(self, method, retry_after=None):
+        self.bucket(method).throttle(retry_after)
+
+    def reset(self):
+        self.__init__(self.buckets['read'].rate, self.buckets['write'].rate)
+
+    def stats(self):
+        return {name: bucket.stats() for name, bucket in self.buckets.items()}
+
+
+scheduler = StripeScheduler()
+os.register_at_fork(after_in_child=scheduler.reset)
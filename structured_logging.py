@@ -0,0 +1,239 @@
+"""
+Logging setup: request threads only put records on a queue, and a background
+listener formats them as JSON lines, redacts PII and keys, and writes them.
+
+Records below WARNING can be sampled per route (LOG_SAMPLE_RATES), decided
+once per request so a sampled request keeps all of its lines.
+"""
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import traceback
+import logging.handlers
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# e.g. "/list-customers=0.01,/submit-quote=0.1,*=1"
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+
+REDACTED = '[redacted]'
+SENSITIVE_KEYS = frozenset({
+    'email', 'phone', 'address', 'name', 'password', 'authorization', 'cookie',
+    'stripe-signature', 'api_key', 'secret', 'token', 'private_key', 'card',
+    'client_secret', 'payment_method'
+})
+_SENSITIVE_PATTERNS = (
+    re.compile(r'\b(?:sk|rk|pk)_(?:live|test)_[A-Za-z0-9]+'),
+    re.compile(r'\bwhsec_[A-Za-z0-9]+'),
+    re.compile(r'\bseti_[A-Za-z0-9]+_secret_[A-Za-z0-9]+'),
+    re.compile(r'\bpi_[A-Za-z0-9]+_secret_[A-Za-z0-9]+'),
+    re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+'),
+    re.compile(r'-----BEGIN [A-Z ]+-----[\s\S]*?-----END [A-Z ]+-----'),
+)
+# LogRecord attributes that are not user supplied `extra` fields
+_RESERVED = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'route'}
+
+_state = {'listener': None, 'handler': None, 'pid': None}
+_counts = {'dropped': 0, 'sampled_out': 0}
+
+
+def redact_text(text):
+    for pattern in _SENSITIVE_PATTERNS:
+        text = pattern.sub(REDACTED, text)
+    return text
+
+
+def redact(value, depth=0):
+    """Copy of value with sensitive keys masked and secrets scrubbed from strings."""
+    if depth > 6:
+        return REDACTED
+    if isinstance(value, dict):
+        return {
+            k: REDACTED if str(k).lower() in SENSITIVE_KEYS else redact(v, depth + 1)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple, set)):
+        return [redact(v, depth + 1) for v in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return redact_text(str(value))
+
+
+def _parse_sample_rates(spec):
+    rates = {}
+    for part in spec.split(','):
+        if '=' in part:
+            route, rate = part.rsplit('=', 1)
+            rates[route.strip()] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+def _current_route():
+    try:
+        from flask import has_request_context, request
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    return request.path
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps WARNING and above always; keeps lower records for a request with
+    the route's sample rate. Runs on the request thread, before any
+    formatting, so dropped records cost almost nothing.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.default = rates.get('*', 1.0)
+
+    def filter(self, record):
+        route = _current_route()
+        record.route = route
+        if record.levelno >= logging.WARNING or not self.rates or route is None:
+            return True
+        from flask import g
+        keep = getattr(g, '_log_sampled', None)
+        if keep is None:
+            keep = random.random() < self.rates.get(route, self.default)
+            g._log_sampled = keep
+        if not keep:
+            _counts['sampled_out'] += 1
+        return keep
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks and defers formatting to the listener.
+    The stock prepare() formats on the calling thread; this one only
+    snapshots mutable arguments so they can't change before formatting.
+    """
+
+    def prepare(self, record):
+        if isinstance(record.args, dict):
+            record.args = dict(record.args)
+        elif record.args:
+            record.args = tuple(
+                a.copy() if isinstance(a, (dict, list, set)) else a for a in record.args
+            )
+        if record.exc_info:
+            # Tracebacks hold frames that keep request objects alive
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _counts['dropped'] += 1
+
+
+def _redact_args(record):
+    """Mask sensitive keys in container arguments before they are interpolated."""
+    if isinstance(record.args, dict):
+        record.args = redact(record.args)
+    elif record.args:
+        record.args = tuple(
+            redact(a) if isinstance(a, (dict, list, tuple, set)) else a for a in record.args
+        )
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with extras as fields and everything redacted."""
+
+    def format(self, record):
+        _redact_args(record)
+        try:
+            message = record.getMessage()
+        except Exception:
+            message = f'{record.msg} {record.args!r}'
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': redact_text(message)
+        }
+        route = getattr(record, 'route', None)
+        if route:
+            entry['route'] = route
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                entry[key] = REDACTED if key.lower() in SENSITIVE_KEYS else redact(value)
+        if record.exc_text:
+            entry['exc'] = redact_text(record.exc_text)
+        return json.dumps(entry, default=str)
+
+
+class RedactingFormatter(logging.Formatter):
+    """Plain text format for local development, still redacted."""
+
+    def format(self, record):
+        _redact_args(record)
+        return redact_text(super().format(record))
+
+
+def _start_listener():
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(RedactingFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    _state['listener'] = listener
+    _state['pid'] = os.getpid()
+    return log_queue
+
+
+def _after_fork():
+    # The listener thread does not survive fork; give the child its own
+    if _state['handler'] is not None:
+        _state['handler'].queue = _start_listener()
+
+
+def stop():
+    """Flush queued records and stop the listener."""
+    listener = _state['listener']
+    if listener is not None and _state['pid'] == os.getpid():
+        _state['listener'] = None
+        listener.stop()
+
+
+def setup_logging():
+    """Route all logging through the queue. Safe to call more than once."""
+    if _state['handler'] is not None:
+        return
+    handler = NonBlockingQueueHandler(_start_listener())
+    handler.addFilter(SamplingFilter(_parse_sample_rates(LOG_SAMPLE_RATES)))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    _state['handler'] = handler
+    atexit.register(stop)
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def stats():
+    handler = _state['handler']
+    return {
+        **_counts,
+        'queued': handler.queue.qsize() if handler is not None else 0,
+        'level': LOG_LEVEL,
+        'format': LOG_FORMAT,
+        'sample_rates': _parse_sample_rates(LOG_SAMPLE_RATES)
+    }
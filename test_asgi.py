@@ -0,0 +1,70 @@
+"""Smoke tests for the ASGI entry point, against the fake Stripe and Sheets."""
+import asyncio
+
+import httpx
+
+from conftest import FAKE_SHEETS, FAKE_STRIPE
+
+# The async Stripe client keeps its connections on one loop, as under uvicorn
+LOOP = asyncio.new_event_loop()
+
+
+def call(method, path, **kwargs):
+    import asgi
+
+    async def send():
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+            return await client.request(method, path, **kwargs)
+    return LOOP.run_until_complete(send())
+
+
+def test_flask_routes_pass_through(flask_app):
+    response = call('GET', '/health')
+    assert response.status_code == 200
+
+
+def test_list_customers_matches_flask(flask_app, customers):
+    response = call('GET', '/list-customers?source=stripe')
+    assert response.status_code == 200
+    expected = flask_app.app.test_client().get('/list-customers?source=stripe').get_json()
+    assert sorted(c['id'] for c in response.json()['customers']) == sorted(c['id'] for c in expected['customers'])
+
+
+def test_charge_writes_charged_date_and_refuses_duplicate(flask_app, customers):
+    from sheet_writes import sheet_writes
+
+    customer = customers[0]
+    response = call('POST', '/charge-customer', json={'customer_id': customer['id'], 'amount': 20})
+    assert response.status_code == 200
+    assert response.json()['status'] == 'succeeded'
+
+    again = call('POST', '/charge-customer', json={'customer_id': customer['id'], 'amount': 20})
+    assert again.status_code == 409
+
+    sheet_writes.flush()
+    row = next(row for row in FAKE_SHEETS.rows if row[2] == customer['email'])
+    assert row[8]
+
+
+def test_charge_requires_customer_and_amount(flask_app):
+    response = call('POST', '/charge-customer', json={'amount': 20})
+    assert response.status_code == 400
+
+
+def test_delete_clears_sheet_row(flask_app, customers):
+    customer = customers[1]
+    response = call('DELETE', f"/delete-customer/{customer['id']}")
+    assert response.status_code == 200
+    assert customer['id'] not in FAKE_STRIPE.customers
+    assert all(row[2] != customer['email'] for row in FAKE_SHEETS.rows if len(row) > 2)
+
+
+def test_charge_retry_with_the_same_key_returns_the_first_charge(flask_app, customers):
+    customer = customers[2]
+    body = {'customer_id': customer['id'], 'amount': 20, 'idempotency_key': 'charge-asgi-retry'}
+    first = call('POST', '/charge-customer', json=body)
+    FAKE_STRIPE.customers[customer['id']]['metadata']['service_type'] = 'MONTHLY'
+    again = call('POST', '/charge-customer', json=body)
+    assert first.status_code == again.status_code == 200
+    assert again.json()['payment_intent_id'] == first.json()['payment_intent_id']
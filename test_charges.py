@@ -0,0 +1,46 @@
+"""Charging twice under one idempotency key charges the customer once."""
+import pytest
+import stripe
+
+import charges
+import ledger
+from conftest import FAKE_STRIPE
+
+
+def test_retry_with_the_same_key_returns_the_first_charge(customers):
+    customer = customers[0]
+    key = charges.new_idempotency_key()
+    _, first, first_date = charges.charge_customer(customer['id'], 20, idempotency_key=key)
+    # The first charge stamped charge_date on the customer; the retry must not resend it
+    assert FAKE_STRIPE.customers[customer['id']]['metadata']['charge_date'] == first_date
+    _, again, again_date = charges.charge_customer(customer['id'], 20, idempotency_key=key)
+    assert again.id == first.id
+    assert again_date == first_date
+    assert ledger.get_charge(key)['status'] == 'succeeded'
+
+
+def test_retry_after_the_customer_changed_returns_the_first_charge(customers):
+    customer = customers[1]
+    key = charges.new_idempotency_key()
+    _, first, _ = charges.charge_customer(customer['id'], 20, idempotency_key=key)
+    FAKE_STRIPE.customers[customer['id']]['metadata']['service_type'] = 'MONTHLY'
+    _, again, _ = charges.charge_customer(customer['id'], 20, idempotency_key=key)
+    assert again.id == first.id
+    assert ledger.get_charge(key)['status'] == 'succeeded'
+
+
+def test_reused_key_with_other_parameters_is_refused(customers):
+    customer = customers[2]
+    key = charges.new_idempotency_key()
+    charges.charge_customer(customer['id'], 20, idempotency_key=key)
+    with pytest.raises(stripe.error.IdempotencyError):
+        stripe.PaymentIntent.create(amount=9900, currency='usd', customer=customer['id'], idempotency_key=key)
+
+
+def test_idempotency_error_is_not_recorded_as_a_decline(customers):
+    customer = customers[3]
+    key = charges.new_idempotency_key()
+    charges.charge_customer(customer['id'], 20, idempotency_key=key)
+    error = stripe.error.IdempotencyError('Keys for idempotent requests ...', http_status=400)
+    charges.record_charge_error(key, error)
+    assert ledger.get_charge(key)['status'] == 'succeeded'
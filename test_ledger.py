@@ -0,0 +1,61 @@
+"""The ledger refuses a second charge of the same amount inside the duplicate window."""
+import uuid
+
+import pytest
+import stripe
+
+import ledger
+
+
+@pytest.fixture
+def customer_id():
+    return f'cus_{uuid.uuid4().hex[:12]}'
+
+
+def key():
+    return f'charge-{uuid.uuid4().hex}'
+
+
+def test_retry_under_the_same_key_is_not_a_duplicate(customer_id):
+    first = key()
+    assert ledger.begin(first, customer_id, 2000) is True
+    assert ledger.begin(first, customer_id, 2000) is False
+
+
+def test_second_charge_in_window_is_refused(customer_id):
+    first = key()
+    ledger.begin(first, customer_id, 2000, email='a@example.com')
+    with pytest.raises(ledger.DuplicateChargeError) as refused:
+        ledger.begin(key(), customer_id, 2000)
+    assert refused.value.existing['idempotency_key'] == first
+    assert refused.value.existing['status'] == 'pending'
+
+
+def test_other_amounts_and_customers_are_allowed(customer_id):
+    ledger.begin(key(), customer_id, 2000)
+    assert ledger.begin(key(), customer_id, 2500) is True
+    assert ledger.begin(key(), f'{customer_id}_other', 2000) is True
+
+
+def test_window_of_zero_allows_duplicates(customer_id):
+    ledger.begin(key(), customer_id, 2000)
+    assert ledger.begin(key(), customer_id, 2000, duplicate_window=0) is True
+
+
+def test_failed_charge_does_not_block_a_new_attempt(customer_id):
+    first = key()
+    ledger.begin(first, customer_id, 2000)
+    ledger.record_failure(first, 'Your card was declined.')
+    assert ledger.begin(key(), customer_id, 2000) is True
+
+
+def test_failure_does_not_overwrite_a_succeeded_charge(customer_id):
+    first = key()
+    ledger.begin(first, customer_id, 2000)
+    ledger.record_result(first, stripe.PaymentIntent.construct_from(
+        {'id': f'pi_{uuid.uuid4().hex[:14]}', 'status': 'succeeded', 'created': 0}, 'sk_test'
+    ))
+    ledger.record_failure(first, 'Keys for idempotent requests can only be used with the same parameters')
+    assert ledger.get_charge(first)['status'] == 'succeeded'
+    with pytest.raises(ledger.DuplicateChargeError):
+        ledger.begin(key(), customer_id, 2000)
@@ -0,0 +1,57 @@
+"""Parcel areas and lookups on a small compiled dataset with a hole in it."""
+import json
+
+import pytest
+
+import parcels
+
+# A 0.0003 degree square on the equator with a 0.0001 degree hole in the
+# middle, and a second parcel filling the hole
+OUTER = [[0, 0], [0.0003, 0], [0.0003, 0.0003], [0, 0.0003], [0, 0]]
+HOLE = [[0.0001, 0.0001], [0.0002, 0.0001], [0.0002, 0.0002], [0.0001, 0.0002], [0.0001, 0.0001]]
+IN_RING = (0.00005, 0.00015)
+IN_HOLE = (0.00015, 0.00015)
+OUTSIDE = (0.001, 0.001)
+
+
+def planar_sqft(side_degrees):
+    side_m = side_degrees * parcels.EARTH_RADIUS_M * 3.141592653589793 / 180
+    return side_m ** 2 * parcels.SQ_FT_PER_SQ_M
+
+
+@pytest.fixture
+def index(tmp_path):
+    source = tmp_path / 'parcels.geojson'
+    source.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'id': 'ring', 'properties': {},
+         'geometry': {'type': 'Polygon', 'coordinates': [OUTER, HOLE]}},
+        {'type': 'Feature', 'id': 'island', 'properties': {},
+         'geometry': {'type': 'Polygon', 'coordinates': [HOLE]}},
+    ]}))
+    prefix = str(tmp_path / 'compiled' / 'parcels')
+    assert parcels.build(str(source), prefix) == 2
+    return parcels.ParcelIndex(prefix)
+
+
+def test_holes_are_subtracted_from_the_area(index):
+    ring_id, ring_area = index.lookup(*IN_RING)
+    island_id, island_area = index.lookup(*IN_HOLE)
+    assert (ring_id, island_id) == ('ring', 'island')
+    assert island_area == pytest.approx(planar_sqft(0.0001), rel=1e-3)
+    assert ring_area == pytest.approx(planar_sqft(0.0003) - planar_sqft(0.0001), rel=1e-3)
+
+
+def test_point_in_a_hole_is_not_in_the_parcel(index):
+    ring = index.ids.index('ring')
+    assert index.find(*IN_RING) == ring
+    assert index.find(*IN_HOLE) != ring
+    assert index.find(*OUTSIDE) is None
+
+
+def test_resolver_tiers_the_parcel_area(index):
+    points = {'ring': IN_RING, 'island': IN_HOLE, 'outside': OUTSIDE}
+    resolver = parcels.ParcelResolver(index, geocoder=lambda address: points.get(address))
+    assert resolver('ring') == 'LARGE'
+    assert resolver('island') == 'SMALL'
+    assert resolver('outside') is None
+    assert resolver('no match') is None
@@ -0,0 +1,41 @@
+"""The vectorised pricing paths must quote exactly what calculate_price does."""
+import math
+from itertools import product
+
+import pytest
+
+import pricing
+from pricing import LOT_SIZES, SERVICE_TYPES, calculate_price, lot_size_tier, price_columns, price_quotes
+
+BOUNDARY_SQFT = [0, 1, 4999.5, 5000, 5000.01, 9999, 10000, 10000.5, 15000, 15000.01, 250000]
+
+
+def test_price_columns_matches_calculate_price():
+    # Unknown names included, to check the fallbacks agree
+    pairs = list(product(LOT_SIZES + ('', 'HUGE'), SERVICE_TYPES + ('DAILY',)))
+    _, prices = price_columns([s for _, s in pairs], lot_sizes=[lot_size for lot_size, _ in pairs])
+    assert prices == [calculate_price(lot_size, s) for lot_size, s in pairs]
+
+
+@pytest.mark.parametrize('square_feet', BOUNDARY_SQFT)
+def test_tiers_from_square_feet_match_lot_size_tier(square_feet):
+    tiers, prices = price_columns(list(SERVICE_TYPES), square_feet=[square_feet] * len(SERVICE_TYPES))
+    assert tiers == [lot_size_tier(square_feet)] * len(SERVICE_TYPES)
+    assert prices == [calculate_price(lot_size_tier(square_feet), s) for s in SERVICE_TYPES]
+
+
+def test_square_feet_take_precedence_over_lot_size_names():
+    quotes = [
+        {'service_type': 'WEEKLY', 'lot_size': 'SMALL', 'square_feet': 12000},
+        {'service_type': 'BI_WEEKLY', 'lot_size': 'SMALL'},
+        {'service_type': 'MONTHLY', 'lot_size': 'LARGE', 'square_feet': None},
+        {'service_type': 'ONE_TIME', 'square_feet': math.nan},
+    ]
+    tiers, prices = price_quotes(quotes)
+    assert tiers == ['LARGE', 'SMALL', 'LARGE', 'XLARGE']
+    assert prices == [calculate_price(tier, q['service_type']) for tier, q in zip(tiers, quotes)]
+
+
+def test_price_grid_matches_calculate_price():
+    grid = pricing.price_grid()
+    assert grid == {lot_size: {s: calculate_price(lot_size, s) for s in SERVICE_TYPES} for lot_size in LOT_SIZES}
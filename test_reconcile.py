@@ -0,0 +1,48 @@
+"""Recognising and reordering sheet rows in the old column layout."""
+import sheet_format
+from conftest import sheet_row
+from reconcile import from_legacy, is_legacy
+
+
+def legacy_row(start_date='2024-01-08', charged_date=''):
+    # timestamp, name, email, phone, address, lot size, service type, price,
+    # start date, payment status, charged date
+    return ['2024-01-01 00:00:00', 'Customer', 'a@example.com', '555-0100', '1 Main St', 'SMALL', 'Bi-Weekly',
+            '55', start_date, 'Pending', charged_date]
+
+
+def test_is_legacy():
+    assert is_legacy(legacy_row())
+    assert not is_legacy(sheet_row('a@example.com'))
+    assert not is_legacy(['2024-01-01 00:00:00', 'Customer', 'a@example.com'])
+
+
+def test_from_legacy_reorders_into_headers():
+    fixed = dict(zip(sheet_format.HEADERS, from_legacy(legacy_row(charged_date='2024-02-01 10:00:00'))))
+    assert fixed == {
+        'Timestamp': '2024-01-01 00:00:00',
+        'Customer Name': 'Customer',
+        'Email': 'a@example.com',
+        'Service Type': 'Bi-Weekly',
+        'Phone Number': '555-0100',
+        'Address': '1 Main St',
+        'Lot Size': 'SMALL',
+        'Price ($)': '55',
+        'Charged Date': '2024-02-01 10:00:00',
+        'Start Date': '2024-01-08',
+        'Payment Status': 'Pending'
+    }
+    assert not is_legacy(from_legacy(legacy_row()))
+
+
+def test_charge_time_in_start_date_moves_to_charged_date():
+    fixed = dict(zip(sheet_format.HEADERS, from_legacy(legacy_row(start_date='2024-02-01 10:00:00'))))
+    assert fixed['Charged Date'] == '2024-02-01 10:00:00'
+    assert fixed['Start Date'] == ''
+
+
+def test_charged_date_column_wins_over_start_date_timestamp():
+    row = legacy_row(start_date='2024-02-01 10:00:00', charged_date='2024-03-01 09:00:00')
+    fixed = dict(zip(sheet_format.HEADERS, from_legacy(row)))
+    assert fixed['Charged Date'] == '2024-03-01 09:00:00'
+    assert fixed['Start Date'] == ''
@@ -0,0 +1,85 @@
+"""Range folding and partial-failure handling in the sheet write buffer."""
+import pytest
+
+from sheet_writes import SheetWriteBuffer, merge
+
+
+def test_single_cell():
+    assert merge({(4, 8): 'x'}) == [{'range': 'I4', 'values': [['x']]}]
+
+
+def test_adjacent_cells_in_a_row_become_one_run():
+    assert merge({(2, 3): 'a', (2, 4): 'b', (2, 5): 'c'}) == [{'range': 'D2:F2', 'values': [['a', 'b', 'c']]}]
+
+
+def test_runs_over_the_same_columns_in_consecutive_rows_become_one_block():
+    cells = {(2, 0): 'a', (2, 1): 'b', (3, 0): 'c', (3, 1): 'd', (4, 0): 'e', (4, 1): 'f'}
+    assert merge(cells) == [{'range': 'A2:B4', 'values': [['a', 'b'], ['c', 'd'], ['e', 'f']]}]
+
+
+def test_gaps_split_blocks():
+    cells = {(2, 8): 'a', (3, 8): 'b', (5, 8): 'c', (5, 10): 'd', (6, 9): 'e'}
+    assert merge(cells) == [
+        {'range': 'I2:I3', 'values': [['a'], ['b']]},
+        {'range': 'I5', 'values': [['c']]},
+        {'range': 'K5', 'values': [['d']]},
+        {'range': 'J6', 'values': [['e']]},
+    ]
+
+
+def test_columns_past_z():
+    assert merge({(1, 26): 'a', (1, 27): 'b'}) == [{'range': 'AA1:AB1', 'values': [['a', 'b']]}]
+
+
+def test_nothing_to_write():
+    assert merge({}) == []
+
+
+class FailingValues:
+    """Sheets values() resource whose batchUpdate fails for one value input option."""
+
+    def __init__(self, values, option):
+        self._values = values
+        self.option = option
+
+    def __getattr__(self, name):
+        return getattr(self._values, name)
+
+    def batchUpdate(self, spreadsheetId, body):
+        if body['valueInputOption'] == self.option:
+            raise RuntimeError('Sheets unavailable')
+        return self._values.batchUpdate(spreadsheetId=spreadsheetId, body=body)
+
+
+class FailingService:
+    def __init__(self, service, option):
+        self._service = service
+        self.option = option
+
+    def spreadsheets(self):
+        spreadsheets = self._service.spreadsheets()
+        spreadsheets.values = lambda: FailingValues(self._service.spreadsheets().values(), self.option)
+        return spreadsheets
+
+
+def test_partial_failure_settles_the_cells_already_written(monkeypatch, customers):
+    from conftest import FAKE_SHEETS
+    from sheets_client import get_sheets_service
+
+    service = get_sheets_service()
+    monkeypatch.setattr('sheet_writes.get_sheets_service', lambda: FailingService(service, 'USER_ENTERED'))
+    buffer = SheetWriteBuffer()
+    # RAW is sent before USER_ENTERED
+    written = buffer.write(customers[0]['email'], 'Charged Date', 'raw', 'RAW')
+    failed = buffer.write(customers[1]['email'], 'Charged Date', 'entered')
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    assert written.result(timeout=0) == 2
+    assert not failed.done()
+    assert buffer.pending() == 1
+
+    monkeypatch.setattr('sheet_writes.get_sheets_service', lambda: service)
+    buffer.flush()
+    assert failed.result(timeout=5) == 3
+    assert [row[8] for row in FAKE_SHEETS.rows[1:3]] == ['raw', 'entered']
+    assert buffer.stats()['unmatched_writes'] == 0
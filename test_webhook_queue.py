@@ -0,0 +1,54 @@
+"""Each Stripe event is handled once, however often it is delivered."""
+import json
+import time
+import uuid
+
+import webhook_queue
+
+calls = []
+webhook_queue.register(['test.delivered'], lambda event: calls.append(event['id']))
+
+
+def event():
+    return {
+        'id': f'evt_{uuid.uuid4().hex[:16]}',
+        'object': 'event',
+        'type': 'test.delivered',
+        'created': int(time.time()),
+        'data': {'object': {'object': 'customer', 'id': f'cus_{uuid.uuid4().hex[:12]}'}}
+    }
+
+
+def drain():
+    for lane in webhook_queue._state['lanes']:
+        lane.join()
+
+
+def status(event_id):
+    row = webhook_queue._conn().execute(
+        'SELECT status, attempts, lease_token FROM webhook_events WHERE id = ?', (event_id,)
+    ).fetchone()
+    return dict(row)
+
+
+def test_duplicate_delivery_is_handled_once():
+    delivered = event()
+    payload = json.dumps(delivered).encode('utf-8')
+    assert webhook_queue.enqueue(delivered, payload) is True
+    assert webhook_queue.enqueue(delivered, payload) is False
+    drain()
+    assert calls.count(delivered['id']) == 1
+    assert status(delivered['id'])['status'] == 'done'
+    assert status(delivered['id'])['attempts'] == 1
+
+
+def test_stale_dispatch_is_skipped():
+    delivered = event()
+    webhook_queue.enqueue(delivered, json.dumps(delivered))
+    drain()
+    token = status(delivered['id'])['lease_token']
+    skipped = webhook_queue._metrics['stale_dispatches']
+    # The same dispatch arriving again, e.g. after a sweep raced the lane
+    webhook_queue._process(delivered['id'], token)
+    assert calls.count(delivered['id']) == 1
+    assert webhook_queue._metrics['stale_dispatches'] == skipped + 1
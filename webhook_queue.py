@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import uuid
+import zlib
+from collections import deque
+
+import stripe
+
+import stripe_scheduler
+from db import get_connection, ensure_schema, ensure_column
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+# Queued and in-flight events are leased to the process whose lanes hold
+# them; its sweeper renews the leases every SWEEP_INTERVAL, so only a dead
+# process's events expire and are picked up by another. The sweeper also
+# dispatches retries once their backoff is over.
+LEASE_SECONDS = int(os.getenv('WEBHOOK_LEASE_SECONDS', 120))
+SWEEP_INTERVAL = int(os.getenv('WEBHOOK_SWEEP_INTERVAL', 10))
+# Stripe retries deliveries for up to three days; keep ids a bit longer
+# than that so late duplicates are still recognised.
+RETENTION_SECONDS = int(os.getenv('WEBHOOK_RETENTION_DAYS', 7)) * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    customer_id TEXT,
+    created INTEGER,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_until REAL,
+    lease_token TEXT,
+    next_attempt_at REAL,
+    last_error TEXT,
+    received_at REAL NOT NULL,
+    processed_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_events_status ON webhook_events (status, received_at);
+CREATE TABLE IF NOT EXISTS webhook_dead_letters (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    customer_id TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    error TEXT,
+    failed_at REAL NOT NULL
+);
+"""
+
+_handlers = {}
+_lock = threading.Lock()
+_state = {'pid': None, 'lanes': [], 'owner': None}
+_metrics = {
+    'received': 0,
+    'duplicates': 0,
+    'processed': 0,
+    'failed_attempts': 0,
+    'retries_scheduled': 0,
+    'stale_dispatches': 0,
+    'dead_lettered': 0
+}
+# Events that may be dispatched: new or due for a retry, or leased to a
+# process that stopped renewing
+_RUNNABLE = (
+    "((status IN ('pending', 'retry') AND COALESCE(next_attempt_at, 0) <= ?) "
+    "OR (status IN ('queued', 'processing') AND leased_until < ?))"
+)
+# (processed_at, queue lag, end-to-end lag) for recent events
+_recent = deque(maxlen=1000)
+
+
+def _conn():
+    ensure_schema('webhook_queue', SCHEMA)
+    ensure_column('webhook_events', 'lease_token', 'TEXT')
+    ensure_column('webhook_events', 'next_attempt_at', 'REAL')
+    return get_connection()
+
+
+def _new_token():
+    # Prefixed with the owning process, whose sweeper renews it
+    return f"{_state['owner']}:{uuid.uuid4().hex[:12]}"
+
+def handler(*event_types):
+    """Register a function for one or more event types. 'customer.*' matches a whole family."""
+    def decorator(fn):
+        for event_type in event_types:
+            _handlers.setdefault(event_type, []).append(fn)
+        return fn
+    return decorator
+
+
+def register(event_types, fn):
+    handler(*event_types)(fn)
+
+
+def _handlers_for(event_type):
+    family = event_type.split('.', 1)[0] + '.*'
+    return _handlers.get(event_type, []) + _handlers.get(family, [])
+
+
+def _customer_id(event):
+    obj = event['data']['object']
+    if obj.get('object') == 'customer':
+        return obj.get('id')
+    customer = obj.get('customer')
+    if isinstance(customer, dict):
+        customer = customer.get('id')
+    if not customer:
+        customer = (event['data'].get('previous_attributes') or {}).get('customer')
+    return customer
+
+
+# -- ingestion -------------------------------------------------------------
+
+def enqueue(event, payload):
+    """
+    Persist a verified event and hand it to a worker.
+    Returns False if the event id was already stored (a duplicate delivery).
+    """
+    start()
+    customer_id = _customer_id(event)
+    token = _new_token()
+    now = time.time()
+    conn = _conn()
+    with conn:
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO webhook_events '
+            '(id, type, customer_id, created, payload, status, attempts, leased_until, lease_token, received_at) '
+            "VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?)",
+            (
+                event['id'],
+                event['type'],
+                customer_id,
+                event.get('created'),
+                payload.decode('utf-8') if isinstance(payload, bytes) else payload,
+                now + LEASE_SECONDS,
+                token,
+                now
+            )
+        )
+    _metrics['received'] += 1
+    if cursor.rowcount == 0:
+        _metrics['duplicates'] += 1
+        logger.info("Ignoring duplicate webhook delivery %s", event['id'])
+        return False
+    _dispatch(event['id'], customer_id, token)
+    return True
+
+
+def _dispatch(event_id, customer_id, token):
+    # Every event for a customer goes to the same lane, so they are handled
+    # in the order they arrived.
+    lanes = _state['lanes']
+    key = (customer_id or event_id).encode('utf-8')
+    lanes[zlib.crc32(key) % len(lanes)].put((event_id, token))
+
+
+# -- processing ------------------------------------------------------------
+
+def _process(event_id, token):
+    """
+    Run an event's handlers once. The row is claimed with the token it was
+    dispatched under, so an event that is already finished, or was taken
+    over by another process, is skipped rather than handled twice.
+    """
+    conn = _conn()
+    with conn:
+        claimed = conn.execute(
+            "UPDATE webhook_events SET status = 'processing', leased_until = ? "
+            "WHERE id = ? AND lease_token = ? AND status = 'queued'",
+            (time.time() + LEASE_SECONDS, event_id, token)
+        ).rowcount
+    if not claimed:
+        _metrics['stale_dispatches'] += 1
+        return
+    row = conn.execute(
+        'SELECT id, type, customer_id, payload, attempts, received_at FROM webhook_events WHERE id = ?',
+        (event_id,)
+    ).fetchone()
+    event = stripe.Event.construct_from(json.loads(row['payload']), stripe.api_key)
+    attempts = row['attempts'] + 1
+
+    try:
+        for fn in _handlers_for(row['type']):
+            fn(event)
+    except Exception as e:
+        _metrics['failed_attempts'] += 1
+        logger.error("Webhook handler failed for %s (%s), attempt %s: %s", event_id, row['type'], attempts, e)
+        if attempts >= MAX_ATTEMPTS:
+            _dead_letter(row, attempts, str(e))
+            return
+        # The sweeper dispatches it again after the backoff; the lane moves on.
+        # Later events for the customer may be handled first, which the
+        # handlers tolerate (they compare event times).
+        with conn:
+            conn.execute(
+                "UPDATE webhook_events SET status = 'retry', attempts = ?, last_error = ?, next_attempt_at = ?, "
+                'leased_until = NULL, lease_token = NULL WHERE id = ? AND lease_token = ?',
+                (attempts, str(e), time.time() + min(2 ** (attempts - 1), 30), event_id, token)
+            )
+        _metrics['retries_scheduled'] += 1
+        return
+
+    processed_at = time.time()
+    with conn:
+        conn.execute(
+            "UPDATE webhook_events SET status = 'done', attempts = ?, processed_at = ?, leased_until = NULL "
+            'WHERE id = ? AND lease_token = ?',
+            (attempts, processed_at, event_id, token)
+        )
+    _metrics['processed'] += 1
+    _recent.append((
+        processed_at,
+        processed_at - row['received_at'],
+        processed_at - (event.get('created') or row['received_at'])
+    ))
+
+
+def _dead_letter(row, attempts, error):
+    conn = _conn()
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO webhook_dead_letters (id, type, customer_id, payload, attempts, error, failed_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (row['id'], row['type'], row['customer_id'], row['payload'], attempts, error, time.time())
+        )
+        conn.execute(
+            "UPDATE webhook_events SET status = 'dead', attempts = ?, last_error = ?, leased_until = NULL WHERE id = ?",
+            (attempts, error, row['id'])
+        )
+    _metrics['dead_lettered'] += 1
+    logger.error("Webhook event %s moved to dead letters after %s attempts", row['id'], attempts)
+
+
+def _lane_worker(lane):
+    # Handler side effects can queue behind checkout traffic
+    with stripe_scheduler.priority(stripe_scheduler.BATCH):
+        while True:
+            event_id, token = lane.get()
+            try:
+                _process(event_id, token)
+            except Exception as e:
+                logger.error("Error processing webhook event %s: %s", event_id, e)
+            finally:
+                lane.task_done()
+
+
+def sweep():
+    """
+    Renew this process's leases, dispatch new, due and abandoned events, and
+    drop old finished ones.
+    """
+    now = time.time()
+    conn = _conn()
+    with conn:
+        # Events waiting in this process's lanes are not abandoned, however
+        # long the backlog
+        conn.execute(
+            "UPDATE webhook_events SET leased_until = ? "
+            "WHERE lease_token LIKE ? AND status IN ('queued', 'processing')",
+            (now + LEASE_SECONDS, f"{_state['owner']}:%")
+        )
+        rows = conn.execute(
+            f'SELECT id, customer_id FROM webhook_events WHERE {_RUNNABLE} ORDER BY created, received_at',
+            (now, now)
+        ).fetchall()
+        claimed = []
+        for row in rows:
+            token = _new_token()
+            cursor = conn.execute(
+                "UPDATE webhook_events SET status = 'queued', leased_until = ?, lease_token = ? "
+                f'WHERE id = ? AND {_RUNNABLE}',
+                (now + LEASE_SECONDS, token, row['id'], now, now)
+            )
+            if cursor.rowcount:
+                claimed.append((row, token))
+        conn.execute(
+            "DELETE FROM webhook_events WHERE status = 'done' AND processed_at < ?",
+            (now - RETENTION_SECONDS,)
+        )
+    for row, token in claimed:
+        _dispatch(row['id'], row['customer_id'], token)
+    if claimed:
+        logger.info("Dispatched %s retried or unfinished webhook events", len(claimed))
+
+
+def _sweep_loop():
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            logger.error("Webhook sweep failed: %s", e)
+        time.sleep(SWEEP_INTERVAL)
+
+
+def start():
+    """Start the worker lanes and sweeper for this process (once per pid)."""
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        lanes = [queue.Queue() for _ in range(WORKERS)]
+        for i, lane in enumerate(lanes):
+            threading.Thread(target=_lane_worker, args=(lane,), name=f'webhook-{i}', daemon=True).start()
+        _state['lanes'] = lanes
+        _state['owner'] = uuid.uuid4().hex
+        _state['pid'] = os.getpid()
+        threading.Thread(target=_sweep_loop, name='webhook-sweep', daemon=True).start()
+
+
+# -- metrics ---------------------------------------------------------------
+
+def depth():
+    return sum(lane.qsize() for lane in _state['lanes'])
+
+
+def stats():
+    now = time.time()
+    recent = [entry for entry in _recent if now - entry[0] <= 60]
+    conn = _conn()
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM webhook_events GROUP BY status').fetchall())
+    dead_letters = conn.execute('SELECT COUNT(*) FROM webhook_dead_letters').fetchone()[0]
+    return {
+        'queue_depth': depth(),
+        'status_counts': counts,
+        'dead_letters': dead_letters,
+        'throughput_per_minute': len(recent),
+        'queue_lag_ms': {
+            'avg': round(sum(e[1] for e in recent) / len(recent) * 1000, 1) if recent else None,
+            'max': round(max(e[1] for e in recent) * 1000, 1) if recent else None
+        },
+        'event_lag_s': {
+            'avg': round(sum(e[2] for e in recent) / len(recent), 1) if recent else None,
+            'max': round(max(e[2] for e in recent), 1) if recent else None
+        },
+        **_metrics
+    }